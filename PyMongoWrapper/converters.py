@@ -0,0 +1,183 @@
+"""Converters for DbObject field values, registered once per type"""
+
+import datetime
+import functools
+import re
+from typing import Any, Callable, Dict, Optional, Union
+
+from bson import ObjectId
+from dateutil.parser import parser as DateParser
+
+HEX_PATTERN = re.compile(r'[0-9a-fA-F]+')
+OBJECTID_PATTERN = re.compile(r'[0-9a-fA-F]{24}')
+ISO_DATETIME_PATTERN = re.compile(
+    r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?([+-]\d{1,2}:\d{2})?Z?')
+
+# shared parser instance, for strings not in ISO 8601 format
+_date_parser = DateParser()
+
+_converters: Dict[type, Callable] = {}
+
+# JSON encoding functions by type, looked up along the MRO
+_json_encoders: Dict[type, Callable] = {}
+_json_dispatch: Dict[type, Optional[Callable]] = {}
+
+
+def register(typ: type, func: Optional[Callable] = None):
+    """Register a converter for the type, can also be used as a decorator
+
+    Args:
+        typ (type): Target type
+        func (Callable, optional): Converter accepting one optional argument,
+            returning a value of the type. A default value should be returned if
+            the argument is omitted.
+    """
+    if func is None:
+        return functools.partial(register, typ)
+    _converters[typ] = func
+    return func
+
+
+def get_converter(typ: type) -> Optional[Callable]:
+    """Get the converter registered for the type, None if not registered"""
+    return _converters.get(typ)
+
+
+def register_json(typ: type, func: Optional[Callable] = None):
+    """Register a function encoding values of the type (and subclasses) into JSON
+    serializable values, can also be used as a decorator
+
+    Args:
+        typ (type): Type of values
+        func (Callable, optional): Function accepting the value
+    """
+    if func is None:
+        return functools.partial(register_json, typ)
+    _json_encoders[typ] = func
+    _json_dispatch.clear()
+    return func
+
+
+def get_json_encoder(typ: type) -> Optional[Callable]:
+    """Get the JSON encoding function for the type, or for the nearest base class"""
+    try:
+        return _json_dispatch[typ]
+    except KeyError:
+        pass
+    func = next((_json_encoders[klass] for klass in typ.__mro__ if klass in _json_encoders), None)
+    _json_dispatch[typ] = func
+    return func
+
+
+def to_json(o: Any) -> Any:
+    """Encode the value into JSON serializable value, for use as `default` of JSON encoders
+
+    Raises:
+        TypeError: No encoding function registered for the type
+    """
+    func = get_json_encoder(type(o))
+    if func is None:
+        raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+    return func(o)
+
+
+register_json(bytes, bytes.hex)
+register_json(ObjectId, str)
+register_json(datetime.datetime, datetime.datetime.isoformat)
+
+
+def is_iso_datetime(text: str) -> bool:
+    """Check if the string is a datetime in ISO 8601 format, e.g. 2020-01-02T03:04:05Z"""
+    return len(text) >= 19 and text[10] == 'T' and text[4] == '-' \
+        and ISO_DATETIME_PATTERN.fullmatch(text) is not None
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_datetime(text: str) -> datetime.datetime:
+    """Parse datetime string, ISO 8601 formats first.
+    Results for repeated strings are memoized.
+
+    Args:
+        text (str): Datetime string
+
+    Raises:
+        ValueError: Unable to parse the string
+
+    Returns:
+        datetime.datetime: Parsed datetime
+    """
+    iso = text[:-1] + '+00:00' if text.endswith('Z') else text
+    try:
+        return datetime.datetime.fromisoformat(iso)
+    except ValueError:
+        pass
+    try:
+        return _date_parser.parse(text)
+    except (OverflowError, ValueError) as ex:
+        raise ValueError(f'Cannot convert {text} to datetime') from ex
+
+
+@register(bytes)
+def to_bytes(x: Union[str, bytes, int, None] = None) -> bytes:
+    """Convert hex string, string (utf-8) or int to bytes"""
+    if x is None:
+        return b''
+    if isinstance(x, bytes):
+        return x
+    elif isinstance(x, str):
+        if len(x) % 2 == 0 and HEX_PATTERN.fullmatch(x):
+            return bytes.fromhex(x)
+        return x.encode('utf-8')
+    elif isinstance(x, int):
+        return bytes.fromhex(f'{x:016x}')
+    raise TypeError(f'Cannot convert {x} to bytes')
+
+
+@register(ObjectId)
+def to_objectid(x: Union[str, bytes, ObjectId, None] = None) -> ObjectId:
+    """Convert hex string or 12 bytes to ObjectId, generate a new one for None"""
+    if x is None:
+        return ObjectId()
+    if isinstance(x, ObjectId):
+        return x
+    elif isinstance(x, str) and len(x) == 24 and OBJECTID_PATTERN.fullmatch(x):
+        return ObjectId(x)
+    elif isinstance(x, bytes) and len(x) == 12:
+        return ObjectId(x)
+    raise TypeError(f'Cannot convert {x} to ObjectId')
+
+
+@register(datetime.datetime)
+def to_datetime(x: Union[str, int, float, ObjectId, datetime.datetime,
+                         None] = None) -> datetime.datetime:
+    """Convert string, timestamp or ObjectId to datetime, current time for None"""
+    if x is None:
+        return datetime.datetime.utcnow()
+    if isinstance(x, datetime.datetime):
+        return x
+    elif isinstance(x, ObjectId):
+        return x.generation_time
+    elif isinstance(x, (float, int)):  # timestamp
+        return datetime.datetime.fromtimestamp(x, datetime.timezone.utc)
+    elif isinstance(x, str):
+        return parse_datetime(x)
+    raise TypeError(f'Cannot convert {x} of type {type(x)} to datetime')
+
+
+@register(int)
+def to_int(x: Any = None) -> int:
+    """Convert to int, via float for strings like '1.0'"""
+    if not x:
+        return 0
+    if type(x) is int:
+        return x
+    return int(float(x))
+
+
+def constructor(typ: type) -> Callable:
+    """Converter calling the type itself, with no argument for None"""
+
+    def _construct(x=None):
+        return typ() if x is None else typ(x)
+
+    return _construct
@@ -0,0 +1,199 @@
+"""Copy-on-write containers for field values shared with DbObject._orig
+
+Values kept in `DbObject._orig` are shared read-only. When a list or dict field is
+read, a shallow copy wrapping the shared value is handed out instead of a deep copy;
+nested lists and dicts are copied only when they are reached through the wrapper,
+i.e. right before they could possibly be mutated.
+"""
+
+from typing import Any
+
+
+def _is_plain(val) -> bool:
+    return type(val) is list or type(val) is dict
+
+
+def cow(val: Any) -> Any:
+    """Wrap a shared list or dict into a copy-on-write container
+
+    Args:
+        val (Any): Shared value
+
+    Returns:
+        Any: CowList or CowDict for lists and dicts, the value itself otherwise
+    """
+    if isinstance(val, (CowList, CowDict)):
+        return val.copy()
+    if isinstance(val, list):
+        return CowList(val)
+    if isinstance(val, dict):
+        return CowDict(val)
+    return val
+
+
+def snapshot(val: Any) -> Any:
+    """Copy a value to be shared read-only, reusing shared values
+    that are still untouched in copy-on-write containers
+
+    Args:
+        val (Any): Value
+
+    Returns:
+        Any: Plain lists and dicts safe to be kept in DbObject._orig
+    """
+    if isinstance(val, (CowList, CowDict)):
+        return val.snapshot()
+    if isinstance(val, list):
+        return [snapshot(ele) for ele in val]
+    if isinstance(val, dict):
+        return {key: snapshot(ele) for key, ele in val.items()}
+    return val
+
+
+def plain(val: Any) -> Any:
+    """Deep copy of a value in plain lists and dicts, unwrapping copy-on-write containers
+
+    Args:
+        val (Any): Value
+
+    Returns:
+        Any: Copy of lists and dicts, the value itself otherwise
+    """
+    if isinstance(val, list):
+        return [plain(ele) for ele in list.__iter__(val)]
+    if isinstance(val, dict):
+        return {key: plain(ele) for key, ele in dict.items(val)}
+    return val
+
+
+class CowList(list):
+    """A list sharing elements with a source list. Nested lists and dicts
+    are wrapped on access, so the source is never mutated"""
+
+    __slots__ = ('_source',)
+
+    def __init__(self, source=(), shared=None):
+        """
+        Args:
+            source (list): Shared source list
+            shared (list, optional): Source the elements are shared with. Defaults to source.
+        """
+        super().__init__(source)
+        self._source = source if shared is None else shared
+
+    def _wrap(self, index, val):
+        if _is_plain(val):
+            val = cow(val)
+            list.__setitem__(self, index, val)
+        return val
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CowList(list.__getitem__(self, index), self._source)
+        return self._wrap(index, list.__getitem__(self, index))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __reversed__(self):
+        for i in range(len(self) - 1, -1, -1):
+            yield self[i]
+
+    def __add__(self, another):
+        return CowList(list.__add__(self, another), self._source)
+
+    def __mul__(self, times):
+        return CowList(list.__mul__(self, times), self._source)
+
+    __rmul__ = __mul__
+
+    def pop(self, index=-1):
+        self[index]
+        return list.pop(self, index)
+
+    def copy(self):
+        return CowList(list.copy(self), self._source)
+
+    def snapshot(self) -> list:
+        """Plain copy of the list, sharing untouched source elements"""
+        shared = None
+        result = []
+        for ele in list.__iter__(self):
+            if _is_plain(ele):
+                if shared is None:
+                    shared = {id(_) for _ in self._source}
+                if id(ele) not in shared:
+                    ele = snapshot(ele)
+            else:
+                ele = snapshot(ele)
+            result.append(ele)
+        return result
+
+
+class CowDict(dict):
+    """A dict sharing values with a source dict. Nested lists and dicts
+    are wrapped on access, so the source is never mutated"""
+
+    __slots__ = ('_source',)
+
+    def __init__(self, source=None, shared=None):
+        """
+        Args:
+            source (dict): Shared source dict
+            shared (dict, optional): Source the values are shared with. Defaults to source.
+        """
+        super().__init__(source or {})
+        self._source = source if shared is None else shared
+
+    def _wrap(self, key, val):
+        if _is_plain(val):
+            val = cow(val)
+            dict.__setitem__(self, key, val)
+        return val
+
+    def __getitem__(self, key):
+        return self._wrap(key, dict.__getitem__(self, key))
+
+    def __iter__(self):
+        # overridden so that dict(...) and {**...} go through __getitem__
+        return dict.__iter__(self)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def pop(self, key, *default):
+        if key in self:
+            self[key]
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, val = dict.popitem(self)
+        return key, (cow(val) if _is_plain(val) else val)
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        dict.__setitem__(self, key, default)
+        return default
+
+    def copy(self):
+        return CowDict(dict.copy(self), self._source)
+
+    def snapshot(self) -> dict:
+        """Plain copy of the dict, sharing untouched source values"""
+        source = self._source or {}
+        result = {}
+        for key, val in dict.items(self):
+            if not _is_plain(val) or source.get(key) is not val:
+                val = snapshot(val)
+            result[key] = val
+        return result
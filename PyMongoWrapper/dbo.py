@@ -1,23 +1,34 @@
 """DBO module"""
 
-import base64
+import asyncio
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from collections.abc import Iterable as IterableClass
 import datetime
-import re
+import sys
 import threading
+import time
+import weakref
+from array import array
 from typing import (Any, Callable, Dict, Iterable, List, Optional, Tuple,
                     TypeVar, Union)
 
 import pymongo
 import pymongo.collection
-from bson import ObjectId
+import pymongo.errors
+from bson import Binary, ObjectId
 
+from . import converters
+from .cow import CowDict, CowList, cow, plain, snapshot
 from .mongofield import MongoField
 
 from .mongoaggregator import MongoAggregator
 from .mongobase import MongoOperand
-from .qxparser import QExprParser
+from .mongocache import QueryCache
+from .mongoexplain import ScanGuard
+from .mongomemory import MemoryClient
+from .mongoreplica import Replica
 from .mongoresultset import MongoResultSet
 
 
@@ -34,16 +45,51 @@ class classproperty(object):
 class MongoConnection:
     """Provide Mongo connection object"""
 
-    def __init__(self, connstr: str) -> None:
+    # client factories by scheme of connection strings, pymongo.MongoClient for others
+    backends: Dict[str, Callable] = {'memory': MemoryClient}
+
+    def __init__(self, connstr: str, max_workers: int = 8,
+                 query_cache: Optional[QueryCache] = None,
+                 scan_guard: Optional[ScanGuard] = None) -> None:
         """Initialize a MongoDB connection
 
         Args:
-            connstr (str): MongoDB connection string
+            connstr (str): MongoDB connection string, or `memory://<database>` for
+                the in-memory backend, see `register_backend`
+            max_workers (int, optional): Number of threads running async operations,
+                which bounds their concurrency. Defaults to 8.
+            query_cache (QueryCache, optional): Cache for results and counts of queries on
+                classes with `_cached` set, or result sets with `cached()`. Defaults to None.
+            scan_guard (ScanGuard, optional): Guard refusing or warning on queries of result
+                sets scanning large collections. Defaults to None.
         """
         self.connstr = connstr
         self.cursors = {}
-        self.db = pymongo.MongoClient(
-            self.connstr)[self.connstr.split('/')[-1]]
+        client_cls = self.backends.get(connstr.split('://', 1)[0], pymongo.MongoClient)
+        self.db = client_cls(self.connstr)[self.connstr.split('/')[-1]]
+        self._local = threading.local()
+        self.max_workers = max_workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self.query_cache = query_cache
+        self.scan_guard = scan_guard
+        self._replicas: Dict[str, Replica] = {}
+        # collection -> index name -> index information
+        self._index_info: Dict[str, Dict[str, Dict]] = {}
+        self._index_lock = threading.Lock()
+        # id of session -> lock serializing its use in the thread pool
+        self._session_locks: Dict[int, threading.Lock] = {}
+
+    @classmethod
+    def register_backend(cls, scheme: str, client_cls: Callable) -> None:
+        """Register a storage backend for connection strings with the scheme
+
+        Args:
+            scheme (str): Scheme of connection strings, e.g. `memory`
+            client_cls (Callable): Factory accepting the connection string, giving an object
+                compatible with `pymongo.MongoClient`, see `mongomemory.MemoryClient`
+        """
+        cls.backends = dict(cls.backends, **{scheme: client_cls})
 
     def __getitem__(self, name: str) -> pymongo.collection.Collection:
         """Get pymongo db collection object by name
@@ -71,6 +117,367 @@ class MongoConnection:
 
         return _BoundDbObject.bind(self)
 
+    def unit_of_work(self) -> 'UnitOfWork':
+        """Create a unit of work. Within its context, saving objects bound to this
+        connection only registers them, and all changes are flushed in bulk on exit
+
+        Returns:
+            UnitOfWork: Unit of work, to be used in a `with` statement
+        """
+        return UnitOfWork(self)
+
+    @contextmanager
+    def session(self, **session_kwargs):
+        """Start a session and bind it to the current thread. Within its context, queries,
+        aggregations and saves of objects bound to this connection run in the session;
+        otherwise implicit sessions are used. Sessions are not thread-safe: async operations
+        and `gather` in the session run one at a time in the thread pool, and the current
+        thread should not use the session while they are pending
+
+        Args:
+            session_kwargs (dict): Arguments for `pymongo.MongoClient.start_session`
+
+        Yields:
+            pymongo.client_session.ClientSession: Session
+        """
+        with self.db.client.start_session(**session_kwargs) as session:
+            if not hasattr(self._local, 'sessions'):
+                self._local.sessions = []
+            self._local.sessions.append(session)
+            self._session_locks[id(session)] = threading.Lock()
+            try:
+                yield session
+            finally:
+                self._local.sessions.remove(session)
+                self._session_locks.pop(id(session), None)
+
+    @property
+    def current_session(self):
+        """Get the innermost session bound to the current thread, None if not any"""
+        sessions = getattr(self._local, 'sessions', None)
+        return sessions[-1] if sessions else None
+
+    @property
+    def current_unit_of_work(self) -> Optional['UnitOfWork']:
+        """Get the innermost unit of work in progress in the current thread, None if not any"""
+        units = getattr(self._local, 'units', None)
+        return units[-1] if units else None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Thread pool running async operations, created on first use"""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers,
+                                                    thread_name_prefix='mongo')
+            return self._executor
+
+    def _with_current_session(self, func: Callable, *args, **kwargs) -> Callable:
+        """Wrap the call to run in another thread, with the session bound to the
+        current thread also bound to that thread during the call. Calls in the same
+        session run one at a time"""
+        session = self.current_session
+        if session is None:
+            return lambda: func(*args, **kwargs)
+        lock = self._session_locks[id(session)]
+
+        def _call():
+            if not hasattr(self._local, 'sessions'):
+                self._local.sessions = []
+            with lock:
+                self._local.sessions.append(session)
+                self._local.serialized = True
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self._local.serialized = False
+                    self._local.sessions.remove(session)
+
+        return _call
+
+    async def run_async(self, func: Callable, *args, **kwargs):
+        """Run the function in the thread pool without blocking the event loop.
+        The session bound to the current thread is also bound to the worker thread
+        during the call
+
+        Args:
+            func (Callable): Function to run
+            args, kwargs: Arguments for the function
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._with_current_session(func, *args, **kwargs))
+
+    @staticmethod
+    def _gather_call(item, max_time_ms: Optional[int]) -> Callable:
+        """Get the function running the item in `gather`, with the time limit applied if given"""
+        if isinstance(item, MongoResultSet):
+            if max_time_ms is not None:
+                item = item.max_time_ms(max_time_ms)
+            return item.as_list
+        if isinstance(item, MongoAggregator):
+            aggregator = MongoAggregator(item._performer, item.aggregators, item._raw,
+                                         item._session)
+            aggregator._options = dict(item._options)
+            if max_time_ms is not None:
+                aggregator._options['maxTimeMS'] = max_time_ms
+            return lambda: list(aggregator)
+        owner = getattr(item, '__self__', None)
+        if isinstance(owner, MongoResultSet) and max_time_ms is not None:
+            return getattr(owner.max_time_ms(max_time_ms), item.__name__)
+        assert callable(item), 'Items must be result sets, aggregators or callables'
+        return item
+
+    def gather(self, *items, timeout: Optional[float] = None) -> List:
+        """Run independent queries concurrently in the thread pool, so that the total latency
+        is that of the slowest query instead of the sum of all
+
+        Args:
+            items: Result sets and aggregators, fetched as lists; methods of result sets,
+                e.g. `Post.query(...).count`, or other callables accepting no argument
+            timeout (float, optional): Time limit in seconds, applied as `max_time_ms` on
+                the server for result sets, their methods and aggregators. Results not ready
+                within the limit from the call are replaced with
+                `concurrent.futures.TimeoutError`; such items are cancelled only if they
+                have not started, items already running are not stopped.
+                Defaults to None, no limit, keeping limits set on the items.
+
+        Returns:
+            List: Results in the order of the items, with exceptions raised by the items
+                in place of their results
+        """
+        max_time_ms = int(timeout * 1000) if timeout is not None else None
+        if getattr(self._local, 'serialized', False):
+            # called in the thread pool holding the session, which the items would wait for
+            results = []
+            for item in items:
+                try:
+                    results.append(self._gather_call(item, max_time_ms)())
+                except Exception as ex:
+                    results.append(ex)
+            return results
+        futures = [
+            self.executor.submit(self._with_current_session(self._gather_call(item, max_time_ms)))
+            for item in items
+        ]
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(
+                    None if deadline is None else max(deadline - time.monotonic(), 0)))
+            except FutureTimeoutError as ex:
+                future.cancel()
+                results.append(ex)
+            except Exception as ex:
+                results.append(ex)
+        return results
+
+    def invalidate_cache(self, *collections: str) -> None:
+        """Drop cached results read from the collections, or all cached results if not given,
+        and mark replicas of the collections stale, to be reloaded on their next queries.
+        Called after writing through objects and result sets bound to this connection"""
+        if self.query_cache is not None:
+            for collection in collections or (None,):
+                self.query_cache.invalidate(collection)
+        for collection in collections or list(self._replicas):
+            if collection in self._replicas:
+                self._replicas[collection].invalidate()
+
+    def index_information(self, collection: str, refresh=False) -> Dict[str, Dict]:
+        """Get information of indexes on the collection, fetched once and cached.
+        Indexes created or dropped other than through this connection are not noticed
+        until refreshed
+
+        Args:
+            collection (str): Collection name
+            refresh (bool, optional): Fetch from the server again. Defaults to False.
+
+        Returns:
+            Dict[str, Dict]: Index information by index name, as `index_information`
+                of pymongo collections
+        """
+        with self._index_lock:
+            if refresh or collection not in self._index_info:
+                self._index_info[collection] = self[collection].index_information()
+            return self._index_info[collection]
+
+    def create_indexes(self, collection: str, indexes: Iterable[pymongo.IndexModel]) -> List[str]:
+        """Create indexes missing from the collection in a single command, comparing keys
+        with cached index information, see `index_information`
+
+        Args:
+            collection (str): Collection name
+            indexes (Iterable[pymongo.IndexModel]): Indexes
+
+        Returns:
+            List[str]: Names of created indexes
+        """
+        existent = [_['key'] for _ in self.index_information(collection).values()]
+        missing = []
+        for index in indexes:
+            keys = list(index.document['key'].items())
+            if keys not in existent:
+                existent.append(keys)
+                missing.append(index)
+        if not missing:
+            return []
+        try:
+            names = self[collection].create_indexes(missing)
+        except pymongo.errors.OperationFailure:
+            # e.g. an index with the same name and different keys is found
+            with self._index_lock:
+                self._index_info.pop(collection, None)
+            raise
+        with self._index_lock:
+            info = self._index_info.setdefault(collection, {})
+            for name, index in zip(names, missing):
+                document = dict(index.document)
+                document.pop('name', None)
+                document['key'] = list(document['key'].items())
+                info[name] = document
+        if self.scan_guard is not None:
+            # plans may use the new indexes
+            self.scan_guard.clear()
+        return names
+
+    def sync_indexes(self, *classes: type) -> Dict[str, List[str]]:
+        """Create indexes declared in `_indexes` of DbObject classes, with a single
+        `create_indexes` command for each collection
+
+        Args:
+            classes (type): DbObject classes, defaults to all classes bound to this connection
+
+        Returns:
+            Dict[str, List[str]]: Names of created indexes by collection name
+        """
+        if not classes:
+            classes, pending = [], [DbObject]
+            while pending:
+                cls = pending.pop()
+                pending += cls.__subclasses__()
+                if cls._binding is self:
+                    classes.append(cls)
+
+        by_collection: Dict[str, List[pymongo.IndexModel]] = {}
+        for cls in classes:
+            if cls._indexes:
+                by_collection.setdefault(cls._collection_name(), []).extend(
+                    _index_model(_) for _ in cls._indexes)
+        return {
+            collection: self.create_indexes(collection, indexes)
+            for collection, indexes in by_collection.items()
+        }
+
+    def close(self) -> None:
+        """Stop reloading replicas, shut down the thread pool for async operations
+        and close the client"""
+        for replica in self._replicas.values():
+            replica.stop()
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+        self.db.client.close()
+
+
+class UnitOfWorkError(Exception):
+    """Raised when some of the objects in a unit of work failed to be written"""
+
+    def __init__(self, failures) -> None:
+        """
+        Args:
+            failures (List[Tuple[DbObject, Any]]): Failed objects and corresponding errors
+        """
+        self.failures = failures
+        super().__init__(f'{len(failures)} object(s) failed to be written')
+
+
+class UnitOfWork:
+    """Collect changes of objects and flush them with ordered bulk writes per collection"""
+
+    def __init__(self, conn: MongoConnection) -> None:
+        """
+        Args:
+            conn (MongoConnection): Connection which objects are bound to
+        """
+        self.conn = conn
+        self.failures = []
+        self._objects = []
+        self._registered = set()
+
+    def __enter__(self):
+        if not hasattr(self.conn._local, 'units'):
+            self.conn._local.units = []
+        self.conn._local.units.append(self)
+        return self
+
+    def __exit__(self, exc_type, *_):
+        try:
+            if exc_type is None:
+                # unsaved references register with this unit while building requests
+                self.flush()
+        finally:
+            self.conn._local.units.remove(self)
+        if exc_type is None and self.failures:
+            raise UnitOfWorkError(self.failures)
+
+    def register(self, obj: 'DbObject') -> None:
+        """Register an object to be saved. New objects are assigned client-generated
+        ObjectIds, so that references to them resolve before the actual insertion
+
+        Args:
+            obj (DbObject): Object to save
+        """
+        if obj._id is None and not obj._orig.get('_id'):
+            obj._id = ObjectId()
+        if id(obj) not in self._registered:
+            self._registered.add(id(obj))
+            self._objects.append(obj)
+
+    def flush(self) -> None:
+        """Write all registered changes, failed objects are appended to `failures`"""
+        batches = {}
+        # objects may register referenced objects while building requests
+        i = 0
+        while i < len(self._objects):
+            obj = self._objects[i]
+            i += 1
+            requests, doc = obj._save_requests()
+            coll = obj.db
+            batches.setdefault(coll.name, (coll, []))[1].append((obj, requests, doc))
+        self._objects = []
+        self._registered = set()
+
+        for coll, entries in batches.values():
+            requests, owners = [], []
+            for entry in entries:
+                requests += entry[1]
+                owners += [entry] * len(entry[1])
+
+            failed_index, errors = len(requests), {}
+            if requests:
+                try:
+                    coll.bulk_write(requests, ordered=True, session=self.conn.current_session)
+                except pymongo.errors.BulkWriteError as ex:
+                    for error in ex.details.get('writeErrors', []):
+                        errors[id(owners[error['index']][0])] = error
+                        failed_index = min(failed_index, error['index'])
+                except pymongo.errors.PyMongoError as ex:
+                    failed_index = 0
+                    errors = {id(obj): ex for obj, _, _ in entries}
+                finally:
+                    self.conn.invalidate_cache(coll.name)
+
+            executed = 0
+            for obj, obj_requests, doc in entries:
+                executed += len(obj_requests)
+                if executed <= failed_index:
+                    obj._saved(doc)
+                else:
+                    self.failures.append((obj, errors.get(id(obj), {
+                        'errmsg': 'not executed due to a previous error in the ordered batch'
+                    })))
+
 
 class DbObjectInitializer:
     """Initialize a field for DbObject"""
@@ -99,13 +506,129 @@ class DbObjectInitializer:
             raise ValueError(f'Unable to call initializer for {self.type}', ex)
 
 
+class DbObjectSchema:
+    """Schema metadata of a DbObject class, built once per class"""
+
+    def __init__(self, cls: type) -> None:
+        """
+        Args:
+            cls (type): DbObject class
+        """
+        self.cls = cls
+        self.initialized = False
+        self.fields = {}
+        for klass in reversed(cls.__mro__):
+            for key, val in vars(klass).items():
+                if not key.startswith('_') and isinstance(val, (type, DbObjectInitializer)):
+                    self.fields[key] = _DefaultInitializers.get(val)
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """Drop metadata derived from fields, called when fields are changed"""
+        self._types = None
+        self._extended_fields = None
+        self._json_fields = None
+
+    @property
+    def types(self) -> Dict[str, Optional[type]]:
+        """Target types of the fields, None for fields accepting any value"""
+        if self._types is None:
+            self._types = {key: val.type for key, val in self.fields.items()}
+        return self._types
+
+    @property
+    def extended_fields(self) -> Dict[str, type]:
+        """Fields that refers to other collections, and the referred DbObject classes"""
+        if self._extended_fields is None:
+            result = {}
+            for key, val in self.fields.items():
+                val_type = val.type
+                if val_type is DbObjectCollection:
+                    val_type = val.ele_type
+                if isinstance(val_type, type) and issubclass(val_type, DbObject):
+                    result[key] = val_type
+            self._extended_fields = result
+        return self._extended_fields
+
+    @property
+    def json_fields(self) -> Dict[str, Tuple[Union[Callable, type], bool]]:
+        """Fields to be converted when decoding JSON, with the converter for datetime,
+        ObjectId and bytes values (or the DbObject class for references), and whether
+        the field is a collection"""
+        if self._json_fields is None:
+            result = {'_id': (converters.to_objectid, False)}
+            for key, val in self.fields.items():
+                val_type, many = val.type, False
+                if val_type is DbObjectCollection:
+                    val_type, many = val.ele_type, True
+                if val_type in (datetime.datetime, ObjectId, bytes):
+                    result[key] = (converters.get_converter(val_type), many)
+                elif key in self.extended_fields:
+                    result[key] = (self.extended_fields[key], many)
+            self._json_fields = result
+        return self._json_fields
+
+    def describe(self) -> Dict[str, Dict[str, Any]]:
+        """Describe the fields in plain values, for tooling
+
+        Returns:
+            Dict[str, Dict[str, Any]]: Field names and their descriptions, with `type` for
+                the name of the field type, `element_type` for the name of element type of
+                collection fields, and `reference` for the collection referred to
+        """
+        result = {}
+        for key, typ in self.types.items():
+            desc = {'type': getattr(typ, '__name__', None)}
+            if typ is DbObjectCollection:
+                desc['element_type'] = getattr(self.fields[key].ele_type, '__name__', None)
+            if key in self.extended_fields:
+                desc['reference'] = self.extended_fields[key]._collection_name()
+            result[key] = desc
+        return result
+
+
+def _index_keys(fields) -> List[Tuple[str, Any]]:
+    """Parse index keys from a field name or a MongoField, `-` prefixed to names for
+    descending order, a (name, direction) tuple, or a sequence of them, e.g.
+    ('-score', 'created') or [('title', 'text')]"""
+    if not isinstance(fields, (list, tuple)) or \
+            (isinstance(fields, tuple) and len(fields) == 2 and isinstance(fields[1], int)):
+        fields = [fields]
+    keys = []
+    for field in fields:
+        if isinstance(field, tuple):
+            keys.append(field)
+        else:
+            keys += MongoField.parse_sort(field)
+    return keys
+
+
+def _index_model(spec) -> pymongo.IndexModel:
+    """Make IndexModel from index declaration in `DbObject._indexes`"""
+    if isinstance(spec, pymongo.IndexModel):
+        return spec
+    if isinstance(spec, dict):
+        options = dict(spec)
+        return pymongo.IndexModel(_index_keys(options.pop('keys')), **options)
+    return pymongo.IndexModel(_index_keys(spec))
+
+
 class DbObject:
     """Provide a base class for DB objects"""
 
-    _fields = None
-
     _binding = None
 
+    _join_strategy = 'lookup'
+
+    _cached = False
+
+    # indexes created by `sync_indexes`, each a field name, a tuple of field names as the
+    # arguments of `ensure_index`, a dict of `keys` and options of `create_index`, e.g.
+    # {'keys': 'created', 'expireAfterSeconds': 3600}, or a pymongo.IndexModel
+    _indexes = ()
+
+    _projection = None
+
     def __init__(self, copy=None, **kwargs):
         """Initialize the object fields"""
         self._orig = {}
@@ -113,10 +636,11 @@ class DbObject:
         self._unsets = {}
         if copy:
             if isinstance(copy, DbObject):
-                self._orig = DbObject._copy(copy._orig)
+                # values in _orig are shared read-only
+                self._orig = dict(copy._orig)
                 self._id = copy._id
             elif isinstance(copy, dict):
-                self._orig = DbObject._copy(copy)
+                self._orig = snapshot(copy)
                 self._id = copy['_id']
             else:
                 raise ValueError(f'Unable to copy from {type(copy).__name__}')
@@ -149,15 +673,22 @@ class DbObject:
         self._unsets[k] = 1
         self._orig.pop(k, None)
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._schema = DbObjectSchema(cls)
+
+    @classmethod
+    def _collection_name(cls) -> str:
+        """Get collection name for DbObject class"""
+        if hasattr(cls, '_collection'):
+            return cls._collection
+        return cls.__name__.lower()
+
     @classproperty
     def db(cls):
         """Get pymongo cursor for DbObject class"""
         assert cls._binding, 'DbObject must be bound to a MongoConnection instance. Use bind method before use.'
-        if hasattr(cls, '_collection'):
-            name = cls._collection
-        else:
-            name = cls.__name__.lower()
-        return cls._binding[name]
+        return cls._binding[cls._collection_name()]
 
     @classmethod
     def on_initialize(cls):
@@ -170,28 +701,38 @@ class DbObject:
         cls._binding = conn
         return cls
 
+    @classmethod
+    def _get_schema(cls) -> DbObjectSchema:
+        """Get schema of the class, calling `on_initialize` on first use"""
+        schema = cls.__dict__.get('_schema')
+        if schema is None:
+            schema = DbObjectSchema(cls)
+            cls._schema = schema
+        if not schema.initialized:
+            schema.initialized = True
+            cls.on_initialize()
+        return schema
+
     @classproperty
-    def fields(cls) -> List[str]:
-        """Get defined fields of the object"""
-        if not cls._fields:
-            cls._fields = {
-                k: _DefaultInitializers.get(getattr(cls, k))
-                for k in dir(cls) if not k.startswith('_') and k not in
-                ('db', 'fields', 'ensure_index', 'set_field', 'extended_fields'
-                 ) and isinstance(getattr(cls, k), (type, DbObjectInitializer))
-            }
+    def schema(cls) -> DbObjectSchema:
+        """Get schema metadata of the class"""
+        return cls._get_schema()
 
-            cls.on_initialize()
-        return cls._fields
+    @classproperty
+    def fields(cls) -> Dict[str, DbObjectInitializer]:
+        """Get defined fields of the object"""
+        return cls._get_schema().fields
 
     @classmethod
     def set_field(cls, field, initializer: Union[type, DbObjectInitializer,
                                                  None]):
         """Set initializer for field"""
+        schema = cls._get_schema()
 
         if initializer is None:
-            if field in cls.fields:
-                del cls.fields[field]
+            if field in schema.fields:
+                del schema.fields[field]
+                schema.invalidate()
             return
 
         if isinstance(initializer, type):
@@ -199,31 +740,41 @@ class DbObject:
         assert isinstance(initializer, DbObjectInitializer), \
             "initializer must be a type or a DbObjectInitializer, or None to unset."
 
-        cls.fields[field] = initializer
+        schema.fields[field] = initializer
+        schema.invalidate()
 
     @classproperty
     def extended_fields(cls) -> Dict[str, type]:
         """Find out fields that refers to other collection"""
-        result = {}
-        for key, val in cls.fields.items():
-            val_type = val.type
-            if val_type is DbObjectCollection:
-                val_type = val.ele_type
-            if not isinstance(val_type, type):
-                continue
-            if issubclass(val_type, DbObject):
-                result[key] = val_type
-        return result
+        return cls._get_schema().extended_fields
+
+    @classmethod
+    def ensure_index(cls, *fields: Union[str, MongoOperand], **options):
+        """Ensure index, unless an index with the same keys exists according to
+        index information cached by the connection
+
+        Args:
+            fields (Union[str, MongoOperand]): Fields, `-` prefixed for descending order
+            options: Options of `create_index`, e.g. unique, expireAfterSeconds,
+                partialFilterExpression
+        """
+        keys = _index_keys(fields)
+        if not keys:
+            return
+        collection = cls._collection_name()
+        if any(_['key'] == keys for _ in cls._binding.index_information(collection).values()):
+            return
+        cls._binding.create_indexes(collection, [pymongo.IndexModel(keys, **options)])
 
     @classmethod
-    def ensure_index(cls, *fields: Union[str, MongoOperand]):
-        """Ensure index"""
-        fields = MongoField.parse_sort(*fields)
-        if fields:
-            for existent in cls.db.index_information().values():
-                if existent['key'] == fields:
-                    return
-            cls.db.create_index(fields)
+    def sync_indexes(cls) -> List[str]:
+        """Create indexes declared in `_indexes` missing from the collection, in a single
+        command, see `MongoConnection.sync_indexes`
+
+        Returns:
+            List[str]: Names of created indexes
+        """
+        return cls._binding.sync_indexes(cls).get(cls._collection_name(), [])
 
     @property
     def id(self) -> Union[ObjectId, None]:
@@ -240,10 +791,36 @@ class DbObject:
     def fill_dict(self, filled_with: Dict):
         """Fill the values of the object from a dict"""
         if filled_with:
+            if isinstance(filled_with, CowDict):
+                filled_with = filled_with.snapshot()
             self._orig = filled_with
             self._id = filled_with.get('_id')
         return self
 
+    def _is_loaded(self, key: str) -> bool:
+        """Check if the field is loaded, for objects fetched with a projection"""
+        projection = self._projection
+        if not projection or key == '_id' or key in self._orig or key in self.__dict__:
+            return True
+        if any(projection.values()):
+            return any(_ == key or _.startswith(key + '.') for _ in projection)
+        return key not in projection
+
+    def _load_fields(self, *keys: str):
+        """Load fields not fetched with the projection from database"""
+        projection = dict(self._projection)
+        if self._id:
+            doc = self.db.find_one({'_id': self._id}, {k: 1 for k in keys}) or {}
+            for k in keys:
+                if k in doc:
+                    self._orig[k] = doc[k]
+        for k in keys:
+            if any(projection.values()):
+                projection[k] = 1
+            else:
+                projection.pop(k, None)
+        self._projection = projection
+
     def __getattribute__(self, key: str) -> Any:
         """Get field value of the object if exists, 
         otherwise call the function to initialize the field"""
@@ -254,20 +831,20 @@ class DbObject:
             return object.__getattribute__(self, key)
 
         # k is not set yet
-        if key in type(self).fields:
+        fields = type(self)._get_schema().fields
+        if key in fields:
             # field is defined
 
-            initializer = type(self).fields[key]
+            if not self._is_loaded(key):
+                self._load_fields(key)
+
+            initializer = fields[key]
             val = None
             try:
                 if self._orig and key in self._orig:
                     # field present in _orig, try convert it to correct type
-                    # make a copy first
-                    val = DbObject._copy(self._orig[key])
-                    if isinstance(val, list):
-                        val = list(val)
-                    elif isinstance(val, dict):
-                        val = dict(val)
+                    # the value is shared, wrap it to copy on write
+                    val = cow(self._orig[key])
 
                     if initializer.type and not isinstance(
                             val, initializer.type):
@@ -286,8 +863,8 @@ class DbObject:
 
         elif key in self._orig:
             # field is not defined, but existing in _orig, so just return it
-            val = self._orig[key]
-            self[key] = DbObject._copy(val)
+            val = cow(self._orig[key])
+            self[key] = val
             return val
 
         else:
@@ -299,26 +876,58 @@ class DbObject:
 
     def __setattr__(self, key: str, value: Any) -> None:
         """Set field value of the object"""
-        if key in type(self).fields:
-            # field is defined, so set it and convert to correct type if needed
-            initializer = type(self).fields[key]
-            if initializer.type and not isinstance(value, initializer.type):
-                value = initializer(value)
+        schema = type(self)._get_schema()
+        typ = schema.types.get(key)
+        if typ and not isinstance(value, typ):
+            # field is defined, so convert to correct type
+            value = schema.fields[key](value)
 
         object.__setattr__(self, key, value)
+        if key == '_id' and value is not None and '_holders' in self.__dict__:
+            # re-key in collections indexing the object while it was unsaved
+            for ref in self.__dict__.pop('_holders'):
+                holder = ref()
+                if holder is not None:
+                    holder._rekey(self, value)
 
-    @staticmethod
-    def _copy(x):
-        """Copy objects"""
-        if isinstance(x, list):
-            return [DbObject._copy(r) for r in x]
-        elif isinstance(x, dict):
-            return {k: DbObject._copy(v) for k, v in x.items()}
-        else:
-            return x
+    def as_dict(self, expand=False, depth: Optional[int] = None,
+                memo: Optional[Dict] = None) -> Dict:
+        """Export the object as a dict
 
-    def as_dict(self, expand=False) -> Dict:
-        """Export the object as a dict"""
+        Args:
+            expand (bool, optional): Expand referenced objects into dicts, otherwise
+                use their ids. Defaults to False.
+            depth (int, optional): Levels of references to expand, the rest are left
+                as ids (not saved if missing). Defaults to None, i.e. unlimited.
+            memo (dict, optional): Dicts already expanded, keyed by (class, _id),
+                shared across calls to reuse objects referenced many times.
+                Objects referencing themselves are left as ids.
+
+        Returns:
+            Dict: Exported dict
+        """
+        if expand:
+            if depth is not None and depth < 0:
+                return self._id
+            if memo is None:
+                memo = {}
+            key = (type(self), id(self) if self._id is None else self._id)
+            if key in memo:
+                cached_depth, cached = memo[key]
+                if cached is None:
+                    # cyclic reference
+                    return self._id
+                if cached_depth is None or (depth is not None and cached_depth >= depth):
+                    return cached
+            memo[key] = (depth, None)
+            d = self._as_dict(True, None if depth is None else depth - 1, memo)
+            memo[key] = (depth, d)
+            return d
+        return self._as_dict(False)
+
+    def _as_dict(self, expand: bool, depth: Optional[int] = None,
+                 memo: Optional[Dict] = None) -> Dict:
+        """Export the object as a dict, with references expanded to the depth"""
 
         d = dict(self._orig)
         d.update(**self.__dict__)
@@ -326,8 +935,8 @@ class DbObject:
         if '_id' in d and d['_id'] is None:
             del d['_id']
 
-        for k in type(self).fields:
-            if k not in d or expand:
+        for k in type(self)._get_schema().fields:
+            if (k not in d or expand) and self._is_loaded(k):
                 d[k] = self[k]
 
         d = {k: v for k, v in d.items() if not k.startswith('_') or k == '_id'}
@@ -335,49 +944,142 @@ class DbObject:
         for k, v in d.items():
             if isinstance(v, DbObject):
                 if expand:
-                    d[k] = v.as_dict(expand)
+                    d[k] = v.as_dict(expand, depth, memo)
                 else:
                     if not v.id:
                         v.save()
                     d[k] = v.id
+            elif isinstance(v, CowDict) or isinstance(v, CowList) and not any(
+                    isinstance(_, DbObject) for _ in list.__iter__(v)):
+                # plain containers, sharing untouched values with _orig unless expanded
+                d[k] = plain(v) if expand else v.snapshot()
             elif not isinstance(v,
                                 (str, dict, bytes)) and hasattr(v, '__iter__'):
                 # if iterable and not dict/str/bytes,
                 # convert to list and expand DbObjects if needed
-                d[k] = [(_.as_dict(expand) if expand else _.id) if isinstance(
-                    _, DbObject) else _ for _ in v]
+                d[k] = [(_.as_dict(expand, depth, memo) if expand else _.id) if isinstance(
+                    _, DbObject) else plain(_) for _ in v]
 
         return d
 
-    def save(self):
-        """Save the current object to database"""
+    def _save_operations(self) -> Tuple[List[Tuple], Dict]:
+        """Build write operations for saving the current object
+
+        Returns:
+            Tuple[List[Tuple], Dict]: Operations, each `('insert', document)` or
+                `('update', filter, update)`, and the document to be merged
+                into the object once the operations succeed
+        """
         d = self.as_dict()
+        operations = []
 
         if self._unsets and '_id' in self._orig:
-            self.db.update_one({'_id': self._orig['_id']}, {'$unset': self._unsets})
-            self._unsets = {}
+            operations.append(('update', {'_id': self._orig['_id']}, {'$unset': dict(self._unsets)}))
 
         if self._orig and self._orig.get('_id'):
             for k, v in self._orig.items():
                 if k in d and d[k] == v:
                     del d[k]
             if d:
-                self.db.update_one({'_id': self._orig['_id']}, {'$set': d})
+                operations.append(('update', {'_id': self._orig['_id']}, {'$set': dict(d)}))
             d['_id'] = self._orig['_id']
 
         else:
-            d['_id'] = self.db.insert_one(d).inserted_id
-            self._id = d['_id']
+            if d.get('_id') is None:
+                d['_id'] = ObjectId()
+            operations.append(('insert', d))
+
+        return operations, d
+
+    def _save_requests(self) -> Tuple[List, Dict]:
+        """Build write requests for saving the current object with `bulk_write`,
+        see `_save_operations`
+        """
+        operations, d = self._save_operations()
+        return [pymongo.InsertOne(*args) if kind == 'insert' else pymongo.UpdateOne(*args)
+                for kind, *args in operations], d
 
-        self._orig.update(**DbObject._copy(d))
+    def _saved(self, d: Dict):
+        """Merge saved document into the object"""
+        self._unsets = {}
+        self._id = d['_id']
+        self._orig.update(**snapshot(d))
+
+    def save(self):
+        """Save the current object to database,
+        or register it if a unit of work is in progress"""
+        uow = getattr(self._binding, 'current_unit_of_work', None)
+        if uow:
+            uow.register(self)
+            return self
+
+        operations, d = self._save_operations()
+        if operations:
+            session = getattr(self._binding, 'current_session', None)
+            try:
+                for kind, *args in operations:
+                    if kind == 'insert':
+                        self.db.insert_one(*args, session=session)
+                    else:
+                        self.db.update_one(*args, session=session)
+            finally:
+                self._written()
+        self._saved(d)
 
         return self
 
+    async def asave(self):
+        """Save the current object without blocking the event loop, see `save`"""
+        if getattr(self._binding, 'current_unit_of_work', None):
+            return self.save()
+        return await self._binding.run_async(self.save)
+
     def delete(self):
         """Delete the current object from database"""
-        self.db.delete_one({'_id': self.id})
+        try:
+            self.db.delete_one({'_id': self.id})
+        finally:
+            self._written()
         self._orig = {}
 
+    @classmethod
+    def replicate(cls, keys: Iterable[str] = (), refresh_interval: float = 60.0) -> Replica:
+        """Keep the whole collection in memory, for small collections read much more than
+        written. Queries with conditions supported by `mongoreplica.localize`, without
+        projections, are matched locally; others are sent to the server
+
+        Args:
+            keys (Iterable[str], optional): Secondary keys to index, besides `_id`
+            refresh_interval (float, optional): Seconds between reloads in the background.
+                Defaults to 60.0.
+
+        Returns:
+            Replica: Replica, loaded
+        """
+        replica = Replica(cls, keys, refresh_interval)
+        replica.load()
+        replica.start()
+        previous = cls._binding._replicas.get(cls.db.name)
+        if previous is not None:
+            previous.stop()
+            if previous.ele_cls.__dict__.get('_replica') is previous:
+                del previous.ele_cls._replica
+        cls._binding._replicas[cls.db.name] = replica
+        # kept in the class itself, not inherited by subclasses, see `_own_replica`
+        cls._replica = replica
+        return replica
+
+    @classmethod
+    def _own_replica(cls) -> Optional[Replica]:
+        """Replica of the class made by `replicate`, None if not replicated"""
+        return cls.__dict__.get('_replica')
+
+    @classmethod
+    def _written(cls):
+        """Invalidate cached results after writing to the collection"""
+        if cls._binding is not None:
+            cls._binding.invalidate_cache(cls.db.name)
+
     @classmethod
     def query(cls,
               *conds: Tuple[Union[Dict, MongoOperand]],
@@ -401,8 +1103,35 @@ class DbObject:
     @classmethod
     def first(cls, *conds: Tuple[Union[Dict, MongoOperand]]):
         """Return the first object in the database matching the condition, None if not found"""
-        for p in cls.query(*conds):
-            return p
+        if len(conds) == 1 and isinstance(conds[0], dict) and len(conds[0]) == 1 \
+                and isinstance(conds[0].get('_id'), ObjectId) \
+                and not (cls._cached and getattr(cls._binding, 'query_cache', None)) \
+                and cls._own_replica() is None:
+            return cls._first_by_id(conds[0]['_id'])
+        return cls.query(*conds).first()
+
+    @classmethod
+    async def afirst(cls, *conds: Tuple[Union[Dict, MongoOperand]]):
+        """Return the first object matching the condition without blocking the event loop,
+        see `first`"""
+        return await cls._binding.run_async(cls.first, *conds)
+
+    @classmethod
+    def _first_by_id(cls, oid: ObjectId):
+        """Load the object by id with find_one, unless reference fields are to be joined
+        with `$lookup`"""
+        ext_fields = cls.extended_fields
+        if ext_fields and cls._join_strategy != 'client':
+            return cls.query({'_id': oid}).first()
+
+        doc = cls.db.find_one({'_id': oid},
+                              session=getattr(cls._binding, 'current_session', None))
+        if doc is None:
+            return None
+        if ext_fields:
+            result_set = MongoResultSet(cls, {})
+            return result_set._resolve_references([doc], list(ext_fields))[0]
+        return cls().fill_dict(doc)
 
     @classproperty
     def aggregator(cls) -> MongoAggregator:
@@ -421,9 +1150,14 @@ Anything = DbObjectInitializer()
 class _DefaultInitializers:
     """Default initializers. Specifically, `None` means accept everything"""
 
+    # only for `None` and types with registered converters, other types (DbObject
+    # classes included) may be created dynamically and should not be kept alive
+    _cache = {}
+
     @staticmethod
     def get(t: Union[None, type, DbObjectInitializer]) -> DbObjectInitializer:
-        """Get initializer for given type
+        """Get initializer for given type, created once per type with a registered
+        converter
 
         Args:
             t (Union[None, type, DbObjectInitializer]): type
@@ -438,31 +1172,16 @@ class _DefaultInitializers:
         if isinstance(t, DbObjectInitializer):
             return t
 
-        def _to_bytes(x: Union[str, bytes, None] = None):
-            if x is None:
-                return b''
-            if isinstance(x, bytes):
-                return x
-            elif isinstance(x, str):
-                if re.match(r'^[a-f0-9]+$', x) and len(x) % 2 == 0:
-                    return bytes.fromhex(x)
-                else:
-                    return x.encode('utf-8')
-            elif isinstance(x, int):
-                return bytes.fromhex(f'{x:016x}')
-            else:
-                raise TypeError(f'Cannot convert {x} to bytes')
+        initializer = _DefaultInitializers._cache.get(t)
+        if initializer is None:
+            initializer = _DefaultInitializers._create(t)
+            if t is None or converters.get_converter(t):
+                _DefaultInitializers._cache[t] = initializer
+        return initializer
 
-        def _to_objid(x: Union[str, bytes, ObjectId, None] = None) -> ObjectId:
-            if x is None:
-                return ObjectId()
-            if isinstance(x, ObjectId):
-                return x
-            elif isinstance(x, str) and re.match(r'^[a-f0-9]{24}$', x):
-                return ObjectId(x)
-            elif isinstance(x, bytes) and len(bytes) == 12:
-                return ObjectId(x.hex())
-            raise TypeError(f'Cannot convert {x} to ObjectId')
+    @staticmethod
+    def _create(t: Union[None, type]) -> DbObjectInitializer:
+        """Create initializer for given type"""
 
         def _to_dbobj(cls: type,
                       x: Union[str, bytes, ObjectId, Dict, DbObject,
@@ -474,48 +1193,20 @@ class _DefaultInitializers:
             elif isinstance(x, dict):
                 return cls().fill_dict(x)
             try:
-                return cls.first({'_id': _to_objid(x)})
+                return cls.first({'_id': converters.to_objectid(x)})
             except TypeError:
                 raise TypeError(f'Cannot convert {x} to {cls.__name__}')
 
-        def _to_datetime(x: Union[str, int, float, ObjectId, datetime.datetime,
-                                  None] = None):
-            if x is None:
-                return datetime.datetime.utcnow()
-            if isinstance(x, datetime.datetime):
-                return x
-            elif isinstance(x, ObjectId):
-                return x.generation_time
-            elif isinstance(x, (float, int)):  # timestamp
-                return datetime.datetime.fromtimestamp(x,
-                                                       datetime.timezone.utc)
-            elif isinstance(x, str):
-                parser = QExprParser(allow_spacing=False)
-                return parser.parse_literal('d"' + x + '"')
-            else:
-                raise TypeError(
-                    f'Cannot convert {x} of type {type(x)} to datetime')
-                
-        def _to_int(x: str = None):
-            if not x: return 0
-            return int(float(x))
-
         if t is None:
             return DbObjectInitializer()
-        elif t is int:
-            return DbObjectInitializer(_to_int, int)
-        elif t is bytes:
-            return DbObjectInitializer(_to_bytes, bytes)
-        elif t is ObjectId:
-            return DbObjectInitializer(_to_objid, ObjectId)
-        elif t is datetime.datetime:
-            return DbObjectInitializer(_to_datetime, datetime.datetime)
+
+        func = converters.get_converter(t)
+        if func:
+            return DbObjectInitializer(func, t)
         elif issubclass(t, DbObject):
             return DbObjectInitializer(lambda *x: _to_dbobj(t, *x), t)
         else:
-            return DbObjectInitializer(
-                lambda *x: t(x[0])
-                if len(x) == 1 and x[0] is not None else t(), t)
+            return DbObjectInitializer(converters.constructor(t), t)
 
 
 class DbObjectCollection(DbObject, DbObjectInitializer):
@@ -523,12 +1214,27 @@ class DbObjectCollection(DbObject, DbObjectInitializer):
     Representing a collection of DbObjects. All elements should be of the same type.
     As a DbObject, it can be embedded in another DbObject.
     As a DbObjectInitializer, it can initialize an empty field, or do convertion by calling it.
+    Elements are indexed by their ids (or values), for constant time membership checks,
+    deduplication and removal by ObjectId.
+    Numeric elements may be kept unboxed in an `array.array` instead of a list, see `storage`.
     """
 
+    # BSON binary subtype for packed arrays
+    BINARY_SUBTYPE = 0x80
+
+    _typecodes = {int: 'q', float: 'd'}
+
+    # plain attribute access, no field handling as in DbObject
+    __getattribute__ = object.__getattribute__
+    __setattr__ = object.__setattr__
+
     def __init__(self,
                  ele_type: Union[type, DbObjectInitializer],
                  arr: Optional[List] = None,
-                 allow_duplicates=True):
+                 allow_duplicates=True,
+                 lazy=False,
+                 storage: Optional[str] = None,
+                 typecode: Optional[str] = None):
         """
         Args:
             ele_type (type): type of elements
@@ -536,38 +1242,204 @@ class DbObjectCollection(DbObject, DbObjectInitializer):
                 Defaults to None.
             allow_duplicates (bool, optional): Allow duplicate elements in the collection.
                 Defaults to True.
+            lazy (bool, optional): Keep ObjectIds of DbObject elements as they are, until
+                elements are accessed, when they are loaded in one query. Queries do not
+                join such fields unless prefetched or their sub-fields are projected.
+                Defaults to False.
+            storage (str, optional): Keep numeric elements in an `array.array`, saved as
+                a BSON array ('array') or packed into BSON binary ('binary'). Packed values
+                are read without copying, until modified. Defaults to None, i.e. a list.
+            typecode (str, optional): `array.array` typecode for storage, defaults to 'q'
+                for int and 'd' for float.
         """
         self.ele_type = ele_type
         self._checker = _DefaultInitializers.get(self.ele_type) if isinstance(
             self.ele_type, type) else self.ele_type
         self.type = DbObjectCollection
         self.allow_duplicates = allow_duplicates
+        self.lazy = lazy and isinstance(ele_type, type) and issubclass(ele_type, DbObject)
+        self.storage = storage
+        self.typecode = typecode
+        if storage:
+            if storage not in ('array', 'binary'):
+                raise ValueError(f'Unknown storage: {storage}')
+            self.typecode = typecode or self._typecodes.get(ele_type)
+            if not self.typecode:
+                raise ValueError(f'Please specify typecode for storage of {ele_type}')
+            self._index = None
+            self._orig = self._decode(arr)
+            if not self.allow_duplicates:
+                self._uniq()
+            return
         self._orig = []
         for i in arr or []:
-            x = self._checker(i)
+            x = self._check(i)
             if x:
                 self._orig.append(x)
         if not self.allow_duplicates:
             self._uniq()
+        else:
+            self._build_index()
 
     def __call__(self, arr: Optional[Iterable] = None):
         """Initialize a new collection of the same type"""
-        return DbObjectCollection(self.ele_type, arr, self.allow_duplicates)
+        return DbObjectCollection(self.ele_type, arr, self.allow_duplicates, self.lazy,
+                                  self.storage, self.typecode)
+
+    def _decode(self, arr) -> Union[array, memoryview]:
+        """Convert the value to typed storage. Packed bytes are cast, not copied"""
+        if arr is None:
+            return array(self.typecode)
+        if isinstance(arr, (bytes, bytearray, memoryview)):
+            view = memoryview(arr).cast('B')
+            if sys.byteorder == 'little':
+                return view.cast(self.typecode)
+            # packed values are little-endian
+            values = array(self.typecode)
+            values.frombytes(view)
+            values.byteswap()
+            return values
+        if isinstance(arr, DbObjectCollection):
+            arr = arr._orig
+        try:
+            return array(self.typecode, arr)
+        except TypeError:
+            return array(self.typecode, [self._checker(_) for _ in arr])
+
+    def _writable(self) -> array:
+        """Copy the values read from packed bytes before modification"""
+        if isinstance(self._orig, memoryview):
+            values = array(self.typecode)
+            values.frombytes(self._orig.cast('B'))
+            self._orig = values
+        return self._orig
+
+    def _encode(self) -> Union[list, Binary]:
+        """Encode typed storage for BSON"""
+        if self.storage == 'array':
+            return self._orig.tolist()
+        if isinstance(self._orig, memoryview) and isinstance(self._orig.obj, Binary) \
+                and self._orig.obj.subtype == self.BINARY_SUBTYPE:
+            # unmodified, reuse the value read from database
+            return self._orig.obj
+        if sys.byteorder == 'little':
+            data = self._orig.tobytes()
+        else:
+            values = array(self.typecode, self._orig)
+            values.byteswap()
+            data = values.tobytes()
+        return Binary(data, self.BINARY_SUBTYPE)
+
+    @property
+    def buffer(self) -> memoryview:
+        """Buffer of typed storage, e.g. for `numpy.frombuffer`"""
+        return memoryview(self._orig)
+
+    def _check(self, v):
+        """Check type of the element, keeping ObjectIds as they are for lazy collections"""
+        if self.lazy and isinstance(v, ObjectId):
+            return v
+        return self._checker(v)
+
+    @staticmethod
+    def _key(ele):
+        """Get the key of an element in the index, unsaved objects are keyed by identity"""
+        if isinstance(ele, DbObject):
+            # bypass DbObject.__getattribute__, _id is always set in __init__
+            eid = object.__getattribute__(ele, '_id')
+            return (DbObject, id(ele)) if eid is None else eid
+        return ele
+
+    def _build_index(self):
+        """Build the index of element keys, disabled for unhashable elements"""
+        self._index = {}
+        try:
+            for ele in self._orig:
+                self._index_add(ele)
+        except TypeError:
+            self._index = None
+
+    def _index_add(self, ele):
+        key = DbObjectCollection._key(ele)
+        count = self._index.get(key, 0)
+        if not count and isinstance(key, tuple) and isinstance(ele, DbObject):
+            # key of unsaved object changes when it gets an id, see `_rekey`
+            ele.__dict__.setdefault('_holders', []).append(weakref.ref(self))
+        self._index[key] = count + 1
+
+    def _rekey(self, ele, eid):
+        """Key the element by its id, once the unsaved element gets one"""
+        if self._index is None:
+            return
+        count = self._index.pop((DbObject, id(ele)), 0)
+        if count:
+            self._index[eid] = self._index.get(eid, 0) + count
+
+    def _index_remove(self, ele):
+        key = DbObjectCollection._key(ele)
+        count = self._index.get(key, 0) - 1
+        if count > 0:
+            self._index[key] = count
+        elif count == 0:
+            del self._index[key]
+        else:
+            self._build_index()
+
+    def _has_key(self, key) -> bool:
+        """Check if an element of the key exists"""
+        if self._index is None:
+            return key in [DbObjectCollection._key(_) for _ in self._orig]
+        try:
+            return key in self._index
+        except TypeError:
+            return False
+
+    def _materialize(self):
+        """Load DbObject elements stored as ObjectIds with one query"""
+        if not self.lazy:
+            return
+        ids = [_ for _ in self._orig if isinstance(_, ObjectId)]
+        if not ids:
+            return
+        loaded = {
+            doc['_id']: self.ele_type().fill_dict(doc)
+            for doc in self.ele_type.db.find({'_id': {'$in': ids}})
+        }
+        self._orig = [
+            loaded[_] if isinstance(_, ObjectId) else _
+            for _ in self._orig if not isinstance(_, ObjectId) or _ in loaded
+        ]
+        self._build_index()
 
     def append(self, v):
         """Append an element to the collection if it passes the type check"""
-        v = self._checker(v)
-        if self.allow_duplicates or v not in self._orig:
+        v = self._check(v)
+        if self.storage:
+            if self.allow_duplicates or v not in self._orig:
+                self._writable().append(v)
+            return
+        if self._index is None:
+            if self.allow_duplicates or v not in self._orig:
+                self._orig.append(v)
+            return
+        if self.allow_duplicates or not self._has_key(DbObjectCollection._key(v)):
             self._orig.append(v)
+            try:
+                self._index_add(v)
+            except TypeError:
+                self._index = None
 
     def clear(self):
         """Clear the collection"""
+        if self.storage:
+            self._orig = array(self.typecode)
+            return
         self._orig = list()
+        self._build_index()
 
     def __add__(self, lst: Iterable):
         """Combine an iterable (list, set, etc.) to a new collection"""
-        a = DbObjectCollection(self.ele_type, self._orig,
-                               self.allow_duplicates)
+        a = self(self._orig)
         for i in lst:
             a.append(i)
         return a
@@ -578,61 +1450,111 @@ class DbObjectCollection(DbObject, DbObjectInitializer):
 
     def __getitem__(self, idx: int):
         """Get an element from the collection according to index"""
+        self._materialize()
         return self._orig[idx]
 
     def __setitem__(self, idx: int, v: Union[ObjectId, Dict, DbObject]):
         """Set the element at the index to the value.
         Will raise TypeError if the type is not consistent"""
-        v = self._checker(v)
+        v = self._check(v)
+        if self.storage:
+            self._writable()[idx] = v
+            return
         if not v:
             raise TypeError(f'{v} is not of type {self.ele_type}')
+        if self._index is not None:
+            self._index_remove(self._orig[idx])
         self._orig[idx] = v
+        if self._index is not None:
+            try:
+                self._index_add(v)
+            except TypeError:
+                self._index = None
 
     def __iter__(self):
         """Iterate over the collection"""
+        self._materialize()
         return self._orig.__iter__()
 
     def __contains__(self, item):
-        """Check if the collection contains the item"""
-        return item in self._orig
+        """Check if the collection contains the item, or an element with the ObjectId"""
+        if self._index is None:
+            return item in self._orig
+        return self._has_key(DbObjectCollection._key(item))
 
     def __eq__(self, another):
+        if isinstance(another, DbObjectCollection):
+            another = another._orig
+        if self.storage or isinstance(another, (array, memoryview)):
+            return list(self._orig) == list(another) if isinstance(
+                another, (list, tuple, array, memoryview)) else False
         return self._orig == another
 
     def __ne__(self, another):
-        return self._orig != another
+        return not self == another
 
     def remove(self, item_or_index: Union[DbObject, ObjectId,
                                           Iterable[ObjectId], int]):
         """Remove the item or index or ObjectIds from the collection"""
+        if self.storage:
+            if isinstance(item_or_index, int):
+                del self._writable()[item_or_index]
+            elif isinstance(item_or_index, IterableClass):
+                values = set(item_or_index)
+                self._orig = array(self.typecode, [x for x in self._orig if x not in values])
+            else:
+                self._writable().remove(item_or_index)
+            return
         if isinstance(item_or_index, int):
             del self._orig[item_or_index]
+            self._build_index()
         elif isinstance(item_or_index, ObjectId):
-            self._orig = [x for x in self._orig if x.id != item_or_index]
+            if self._index is not None and not self._has_key(item_or_index):
+                return
+            self._orig = [x for x in self._orig
+                          if DbObjectCollection._key(x) != item_or_index]
+            self._build_index()
         elif isinstance(item_or_index, IterableClass):
-            self._orig = [x for x in self._orig if x.id not in item_or_index]
+            ids = set(item_or_index)
+            self._orig = [x for x in self._orig
+                          if DbObjectCollection._key(x) not in ids]
+            self._build_index()
         else:
             self._orig.remove(item_or_index)
+            if self._index is not None:
+                self._index_remove(item_or_index)
 
     @property
     def id(self):
         """Get the ids of elements in the collection, and save them if necessary"""
+        if self.storage:
+            return self._encode()
         if issubclass(self.ele_type, DbObject):
             for _ in self._orig:
-                if not _.id:
+                if isinstance(_, DbObject) and not _.id:
                     _.save()
-            return [_.id for _ in self._orig]
+            return [_ if isinstance(_, ObjectId) else _.id for _ in self._orig]
         else:
             return self._orig
 
     def _uniq(self):
+        if self.storage:
+            if len(set(self._orig)) < len(self._orig):
+                self._orig = array(self.typecode, dict.fromkeys(self._orig))
+            return
         results = []
-        ids = set()
-        for ele in self._orig:
-            eid = getattr(ele, 'id', ele)
-            if eid not in ids:
-                ids.add(eid)
-                results.append(ele)
+        self._index = {}
+        try:
+            for ele in self._orig:
+                if DbObjectCollection._key(ele) not in self._index:
+                    results.append(ele)
+                    self._index_add(ele)
+        except TypeError:
+            results = []
+            for ele in self._orig:
+                if ele not in results:
+                    results.append(ele)
+            self._index = None
         self._orig = results
 
     def save(self):
@@ -642,24 +1564,38 @@ class DbObjectCollection(DbObject, DbObjectInitializer):
         if not self.allow_duplicates:
             self._uniq()
         for _ in self._orig:
-            _.save()
+            if isinstance(_, DbObject):
+                _.save()
 
-    def as_dict(self, expand=False):
+    def as_dict(self, expand=False, depth: Optional[int] = None,
+                memo: Optional[Dict] = None):
         """Return a list of element ids (default), or dicts representing elements 
-        (expand set to True) in the collection"""
+        (expand set to True) in the collection, see `DbObject.as_dict`"""
         if not self.allow_duplicates:
             self._uniq()
+        if self.storage:
+            return self._orig.tolist() if expand else self._encode()
         if not issubclass(self.ele_type, DbObject):
             return self._orig
         if expand:
-            return [_.as_dict(True) for _ in self._orig]
+            if depth is not None and depth < 0:
+                return [_ if isinstance(_, ObjectId) else _._id for _ in self._orig]
+            if memo is None:
+                memo = {}
+            return [_.as_dict(True, depth, memo) for _ in self]
         else:
-            return [_.id for _ in self._orig]
+            return self.id
 
     def fill_dict(self, v: List):
         """Fill the collection with elements from a list of dicts, 
         check the type of each element"""
+        if self.storage:
+            self._orig = self._decode(v)
+            if not self.allow_duplicates:
+                self._uniq()
+            return self
         self._orig = []
+        self._build_index()
         for x in v:
             self.append(x)
         return self
@@ -685,19 +1621,42 @@ class BatchOper:
     def __exit__(self, *_):
         self.commit()
 
-    def add(self, obj) -> None:
-        """Add object to batch
+    async def __aenter__(self):
+        return self
 
-        Args:
-            obj (Union[dict, DbObject]): object
+    async def __aexit__(self, *_):
+        await self.acommit()
+
+    def _enqueue(self, obj) -> bool:
+        """Add object to the queue
+
+        Returns:
+            bool: Whether the queue is full and should be committed
         """
         if self._performer is None and isinstance(obj, DbObject):
             self._performer = type(obj)
         with self._lock:
             self._queue.append(obj)
-        if len(self._queue) > self.batch_size:
+        return len(self._queue) > self.batch_size
+
+    def add(self, obj) -> None:
+        """Add object to batch
+
+        Args:
+            obj (Union[dict, DbObject]): object
+        """
+        if self._enqueue(obj):
             self.commit()
 
+    async def aadd(self, obj) -> None:
+        """Add object to batch, committing without blocking the event loop
+
+        Args:
+            obj (Union[dict, DbObject]): object
+        """
+        if self._enqueue(obj):
+            await self.acommit()
+
     def pop_queue(self):
         with self._lock:
             res = list(self._queue)
@@ -709,6 +1668,13 @@ class BatchOper:
         """
         pass
 
+    async def acommit(self):
+        """Commit batch in the thread pool of the performer's connection
+        """
+        if self._performer is None or not self._queue:
+            return
+        await self._performer._binding.run_async(self.commit)
+
     @property
     def has_results(self) -> bool:
         """Check if there are any results generated from commit
@@ -752,9 +1718,12 @@ class BatchSave(BatchOper):
                 ids = [o['_id'] for o in objs]
                 self._performer.query({'_id': {'$in': ids}}).delete()
 
-            self._performer.db.insert_many(objs,
-                                           ordered=False,
-                                           bypass_document_validation=True)
+            try:
+                self._performer.db.insert_many(objs,
+                                               ordered=False,
+                                               bypass_document_validation=True)
+            finally:
+                self._performer._written()
 
 
 class BatchQuery(BatchOper):
@@ -788,6 +1757,9 @@ class BatchQuery(BatchOper):
         return self._results
 
 
+converters.register_json(DbObject, lambda o: o.as_dict(True))
+
+
 def create_dbo_json_encoder(base_cls):
     """Create a JSON encoder for DbObjects"""
 
@@ -796,44 +1768,69 @@ def create_dbo_json_encoder(base_cls):
         """
 
         def default(self, o):
-            """Overwrite default encoding function"""
-            if isinstance(o, bytes):
-                return o.hex()
-            if isinstance(o, ObjectId):
-                return str(o)
-            elif isinstance(o, DbObject):
-                return o.as_dict(True)
-            elif isinstance(o, datetime.datetime):
-                return o.isoformat()
-            elif isinstance(o, bytes):
-                return f'{base64.b64encode(o).decode("ascii")}'
-            else:
-                return base_cls.default(self, o)
+            """Overwrite default encoding function, see `converters.register_json`"""
+            func = converters.get_json_encoder(type(o))
+            if func is not None:
+                return func(o)
+            return base_cls.default(self, o)
 
     return DBOJsonEncoder
 
 
-def create_dbo_json_decoder(base_cls):
-    """Create a JSON decoder for DbObjects, currently handles only datetime, 
-    for other parts are handled by fill_dict"""
+def _decode_json_value(target: Union[Callable, type], val: Any) -> Any:
+    if isinstance(target, type):
+        # reference, either expanded or an id
+        if isinstance(val, dict):
+            return _decode_json_fields(target, val)
+        target = converters.to_objectid
+    if isinstance(val, str):
+        try:
+            return target(val)
+        except (TypeError, ValueError):
+            pass
+    return val
+
+
+def _decode_json_fields(cls: type, d: Dict) -> Dict:
+    """Convert values in the decoded dict, according to fields declared by the class"""
+    for key, (target, many) in cls._get_schema().json_fields.items():
+        val = d.get(key)
+        if val is None:
+            continue
+        if many:
+            if isinstance(val, list):
+                d[key] = [_decode_json_value(target, _) for _ in val]
+        else:
+            d[key] = _decode_json_value(target, val)
+    return d
+
+
+def create_dbo_json_decoder(base_cls, dbo_cls: Optional[type] = None):
+    """Create a JSON decoder for DbObjects. Strings in ISO 8601 format are converted to
+    datetime; or, if `dbo_cls` is specified, only values of fields declared as datetime,
+    ObjectId or bytes in the class (and in classes it refers to) are converted.
+    Other parts are handled by fill_dict"""
 
     class JsonDecoder(base_cls):
 
         def __init__(self, *args, **kargs):
             _ = kargs.pop('object_hook', None)
-            super().__init__(object_hook=self.decoder, *args, **kargs)
+            if dbo_cls is None:
+                kargs['object_hook'] = self.decoder
+            super().__init__(*args, **kargs)
 
         def decoder(self, d):
-            import dateutil.parser
-            updt = {}
             for k, v in d.items():
-                if isinstance(v, str):
-                    if re.match(
-                            r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(|[+-]\d{1,2}:\d{2})?Z?$',
-                            v):
-                        updt[k] = dateutil.parser.isoparse(v)
-            if updt:
-                d.update(**updt)
+                if isinstance(v, str) and converters.is_iso_datetime(v):
+                    d[k] = converters.parse_datetime(v)
             return d
 
+        def decode(self, s, *args, **kwargs):
+            obj = super().decode(s, *args, **kwargs)
+            if dbo_cls is not None:
+                for d in (obj if isinstance(obj, list) else [obj]):
+                    if isinstance(d, dict):
+                        _decode_json_fields(dbo_cls, d)
+            return obj
+
     return JsonDecoder
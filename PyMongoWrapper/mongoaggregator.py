@@ -1,6 +1,9 @@
 """Aggregation"""
 
+from bson.son import SON
+
 from .mongobase import MongoOperand
+from .mongoexplain import explain
 from .mongofield import MongoField, MongoFunction
 
 
@@ -31,18 +34,66 @@ class MongoAggregator:
         self._performer = performer
         self._raw = raw
         self._session = session
+        self._options = {}
         self.aggregators = aggregators or list()
 
     def __getattr__(self, name):
         return MongoAggregatingFunction(name, self)
 
     def __iter__(self):
+        cursor = self.cursor()
+        try:
+            for result in cursor:
+                if self._raw:
+                    yield result
+                else:
+                    yield self._performer().fill_dict(result)
+        finally:
+            cursor.close()
+
+    def cursor(self):
+        """Run the aggregation and return the raw command cursor, to be closed by the caller
+
+        Returns:
+            pymongo.command_cursor.CommandCursor: Cursor
+        """
         assert self._performer, 'Must assign a performer'
-        for result in self._performer.db.aggregate(self.aggregators, allowDiskUse=True, session=self._session):
-            if self._raw:
-                yield result
-            else:
-                yield self._performer().fill_dict(result)
+        session = self._session or getattr(self._performer._binding, 'current_session', None)
+        return self._performer.db.aggregate(
+            self.aggregators, allowDiskUse=True, session=session, **self._options)
+
+    def _command(self):
+        """The aggregate command run by `cursor`"""
+        command = SON([('aggregate', self._performer.db.name), ('pipeline', self.aggregators),
+                       ('cursor', {}), ('allowDiskUse', True)])
+        if 'maxTimeMS' in self._options:
+            command['maxTimeMS'] = self._options['maxTimeMS']
+        return command
+
+    def explain(self, verbosity='executionStats'):
+        """Explain the aggregation, including `$lookup` stages
+
+        Args:
+            verbosity (str, optional): Verbosity, see `mongoexplain.explain`.
+                Defaults to 'executionStats'.
+
+        Returns:
+            Dict: Summarized plan, see `mongoexplain.summarize`
+        """
+        assert self._performer, 'Must assign a performer'
+        session = self._session or getattr(self._performer._binding, 'current_session', None)
+        return explain(self._performer.db, self._command(), verbosity, session)
+
+    def options(self, batch_size=None, max_time_ms=None):
+        """Set cursor options
+
+        Args:
+            batch_size (int, optional): Number of documents in each batch from the server
+            max_time_ms (int, optional): Time limit in milliseconds for the server
+        """
+        self._options = {key: val for key, val in (
+            ('batchSize', batch_size), ('maxTimeMS', max_time_ms)) if val is not None}
+        return self
 
     def perform(self, performer=None, raw=None):
         """Perform aggregation
@@ -65,7 +116,7 @@ class MongoAggregator:
         self._raw = raw
 
     def session(self, session=None):
-        """Set session"""
+        """Set session, defaults to the one bound by `MongoConnection.session`"""
         self._session = session
 
     def __len__(self):
@@ -85,7 +136,10 @@ class MongoAggregator:
         agg = list(self.aggregators)
         agg.append({'$group': {'_id': 1, 'count': {'$sum': 1}}})
         try:
-            a = next(self._performer.db.aggregate(agg, allowDiskUse=True))
+            session = self._session or getattr(self._performer._binding, 'current_session', None)
+            kwargs = {'maxTimeMS': self._options['maxTimeMS']} if 'maxTimeMS' in self._options else {}
+            a = next(self._performer.db.aggregate(agg, allowDiskUse=True, session=session,
+                                                  **kwargs))
             return a['count']
         except StopIteration:
             return 0
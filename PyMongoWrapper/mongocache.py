@@ -0,0 +1,347 @@
+"""Query result cache, and invalidation on changes made by other processes"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import bson
+import pymongo.errors
+from bson.son import SON
+
+
+def _normalize(val, query=False):
+    """Sort keys of queries and operator documents, keeping literal documents as is,
+    since matching embedded documents depends on their key order"""
+    if isinstance(val, dict) and val and \
+            (query or all(isinstance(k, str) and k.startswith('$') for k in val)):
+        return SON((k, _normalize_operand(k, val[k])) for k in sorted(val, key=str))
+    return val
+
+
+def _normalize_operand(key, val):
+    if key in ('$and', '$or', '$nor') and isinstance(val, list):
+        return [_normalize(_, True) for _ in val]
+    if key == '$elemMatch':
+        return _normalize(val, True)
+    return _normalize(val)
+
+
+def normalize_cond(cond: Optional[Dict]) -> SON:
+    """Normalize the query condition, so that conditions differing only in the order
+    of fields or operators are considered the same"""
+    return _normalize(cond or {}, True) or SON()
+
+
+def fingerprint(*parts) -> str:
+    """Canonical fingerprint of the parts of a query, which must be BSON encodable"""
+    return hashlib.sha1(bson.encode({'_': list(parts)})).hexdigest()
+
+
+class QueryCache:
+    """LRU cache of query results with a time-to-live, invalidated per collection
+    when writing to it"""
+
+    def __init__(self, ttl: float = 60, maxsize: int = 1024) -> None:
+        """
+        Args:
+            ttl (float, optional): Seconds before cached results expire. Defaults to 60.
+            maxsize (int, optional): Maximum number of cached results. Defaults to 1024.
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # key -> (expiry, collections, value, ids)
+        self._entries: OrderedDict = OrderedDict()
+        self._keys_by_collection: Dict[str, set] = {}
+        # keys of results without `_id`s recorded for the collection
+        self._keys_without_ids: Dict[str, set] = {}
+        self._keys_by_id: Dict[Tuple[str, Any], set] = {}
+        self._versions: Dict[str, int] = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def _version(self, collections: Iterable[str]) -> Tuple[int, ...]:
+        return (self._epoch,) + tuple(self._versions.get(_, 0) for _ in collections)
+
+    def version(self, collections: Iterable[str]) -> Tuple[int, ...]:
+        """Current version of the collections, to be passed to `set` for results
+        read from them afterwards"""
+        with self._lock:
+            return self._version(collections)
+
+    def _remove(self, key) -> None:
+        _, collections, _, ids = self._entries.pop(key)
+        for collection in collections:
+            for index in (self._keys_by_collection, self._keys_without_ids):
+                keys = index.get(collection)
+                if keys:
+                    keys.discard(key)
+        for item in ids:
+            keys = self._keys_by_id.get(item)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_id[item]
+
+    def get(self, key: str) -> Any:
+        """Get cached value, None if not cached or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: Any, collections: Iterable[str],
+            version: Optional[Tuple[int, ...]] = None, ttl: Optional[float] = None,
+            ids: Optional[Dict[str, Iterable]] = None) -> bool:
+        """Cache the value
+
+        Args:
+            key (str): Key, see `fingerprint`
+            value (Any): Value, must not be None
+            collections (Iterable[str]): Names of collections the value is read from
+            version (Tuple[int, ...], optional): Version of the collections before reading
+                the value. The value is not cached if any of them is written to since.
+            ttl (float, optional): Seconds before expiry. Defaults to `ttl` of the cache.
+            ids (Dict[str, Iterable], optional): `_id`s of all documents in the value, by
+                collection, so that changes of other documents in these collections do not
+                evict the value, see `invalidate`
+
+        Returns:
+            bool: Whether the value is cached
+        """
+        collections = tuple(collections)
+        id_items = []
+        for collection, collection_ids in (ids or {}).items():
+            id_items += [(collection, _) for _ in collection_ids]
+        try:
+            id_items = frozenset(id_items)
+        except TypeError:
+            # unhashable _id, evicted on any change of the collections
+            id_items, ids = frozenset(), None
+        with self._lock:
+            if version is not None and version != self._version(collections):
+                return False
+            if key in self._entries:
+                self._remove(key)
+            expiry = time.monotonic() + (self.ttl if ttl is None else ttl)
+            self._entries[key] = (expiry, collections, value, id_items)
+            for collection in collections:
+                self._keys_by_collection.setdefault(collection, set()).add(key)
+                if not ids or collection not in ids:
+                    self._keys_without_ids.setdefault(collection, set()).add(key)
+            for item in id_items:
+                self._keys_by_id.setdefault(item, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            return True
+
+    def invalidate(self, collection: Optional[str] = None, _id: Any = None) -> None:
+        """Drop cached results read from the collection, or all results if not given
+
+        Args:
+            collection (str, optional): Collection name
+            _id (Any, optional): Drop only results containing the document with the `_id`,
+                and results not recording `_id`s of the collection, e.g. counts.
+                Results which the document starts to match after the change are not dropped,
+                so this suits changes not affecting which queries match the document.
+        """
+        with self._lock:
+            if collection is None:
+                self._epoch += 1
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                self._keys_by_collection.clear()
+                self._keys_without_ids.clear()
+                self._keys_by_id.clear()
+                return
+            self._versions[collection] = self._versions.get(collection, 0) + 1
+            try:
+                keys = self._keys_by_collection.get(collection, ()) if _id is None else \
+                    self._keys_without_ids.get(collection, set()) | \
+                    self._keys_by_id.get((collection, _id), set())
+            except TypeError:
+                # unhashable _id
+                keys = self._keys_by_collection.get(collection, ())
+            for key in list(keys):
+                if key in self._entries:
+                    self._remove(key)
+                    self.invalidations += 1
+
+    @property
+    def collections(self) -> List[str]:
+        """Names of collections which cached results are read from"""
+        with self._lock:
+            return sorted(name for name, keys in self._keys_by_collection.items() if keys)
+
+    def clear(self) -> None:
+        """Drop all cached results and reset statistics"""
+        self.invalidate()
+        with self._lock:
+            self._versions.clear()
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Numbers of hits, misses, evictions by size limit, invalidated results,
+        cached results, and the hit ratio"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self._entries)
+            }
+
+
+class InvalidationListener:
+    """Drop cached results of a connection on changes made by other processes, by tailing
+    the change stream of the database, or by polling collections when change streams are
+    not available, i.e. on standalone servers"""
+
+    def __init__(self, conn, collections: Optional[Iterable[str]] = None, per_id=False,
+                 method='auto', poll_interval=1.0, timestamp_field: Optional[str] = None) -> None:
+        """
+        Args:
+            conn (MongoConnection): Connection with a query cache
+            collections (Iterable[str], optional): Names of collections to watch.
+                Defaults to None, all collections, or when polling, collections which
+                cached results are read from.
+            per_id (bool, optional): Drop only results containing the changed document on
+                updates and replacements, see `QueryCache.invalidate`, which suits changes
+                never making documents start to match cached queries. Otherwise all results
+                of the collection are dropped, as on insertions. Deletions always drop only
+                results containing the document, and counts. Defaults to False.
+            method (str, optional): `change_stream`, `poll`, or `auto` to poll if change
+                streams are not supported. Defaults to 'auto'.
+            poll_interval (float, optional): Seconds between polls, also the longest time
+                to wait for change events before checking if stopped. Defaults to 1.0.
+            timestamp_field (str, optional): Field holding the last modified time,
+                to find updated documents when polling. Defaults to None, in which case
+                polling only detects insertions and deletions by `_id` and count.
+        """
+        assert method in ('auto', 'change_stream', 'poll'), \
+            'method must be `auto`, `change_stream` or `poll`'
+        self.conn = conn
+        self.collections = list(collections) if collections else None
+        self.per_id = per_id
+        self.method = method
+        self.poll_interval = poll_interval
+        self.timestamp_field = timestamp_field
+        self.resume_token = None
+        self._watermarks: Dict[str, Dict[str, Any]] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def process_event(self, event: Dict) -> None:
+        """Drop cached results affected by the change event
+
+        Args:
+            event (Dict): Change event, as from change streams
+        """
+        cache = self.conn.query_cache
+        if cache is None:
+            return
+        op = event.get('operationType')
+        ns = event.get('ns') or {}
+        if ns.get('db', self.conn.db.name) != self.conn.db.name:
+            return
+        collection = ns.get('coll')
+        if op in ('dropDatabase', 'invalidate') or collection is None:
+            cache.invalidate()
+        elif self.collections and collection not in self.collections:
+            return
+        elif 'documentKey' in event and \
+                (op == 'delete' or self.per_id and op in ('update', 'replace')):
+            cache.invalidate(collection, event['documentKey'].get('_id'))
+        else:
+            cache.invalidate(collection)
+
+    def poll(self) -> None:
+        """Check watched collections for changes once. The first poll of a collection
+        records its watermark, i.e. the greatest `_id`, count, and latest timestamp"""
+        cache = self.conn.query_cache
+        if cache is None:
+            return
+        for name in self.collections or cache.collections:
+            coll = self.conn[name]
+            last = coll.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+            state = {'last_id': last['_id'] if last else None,
+                     'count': coll.estimated_document_count()}
+            previous = self._watermarks.get(name)
+
+            if self.timestamp_field:
+                state['timestamp'] = previous.get('timestamp') if previous else None
+                cond = {self.timestamp_field: {'$gt': state['timestamp']}} \
+                    if state['timestamp'] is not None else {}
+                for doc in coll.find(cond, {'_id': 1, self.timestamp_field: 1}):
+                    stamp = doc.get(self.timestamp_field)
+                    if stamp is not None and (state['timestamp'] is None or stamp > state['timestamp']):
+                        state['timestamp'] = stamp
+                    if previous is not None:
+                        self.process_event({'operationType': 'update', 'ns': {'coll': name},
+                                            'documentKey': {'_id': doc['_id']}})
+
+            if previous is not None and (previous['last_id'] != state['last_id']
+                                         or previous['count'] != state['count']):
+                cache.invalidate(name)
+            self._watermarks[name] = state
+
+    def _watch(self) -> None:
+        pipeline = [{'$match': {'ns.coll': {'$in': self.collections}}}] if self.collections else []
+        with self.conn.db.watch(pipeline, resume_after=self.resume_token,
+                                max_await_time_ms=int(self.poll_interval * 1000)) as stream:
+            while not self._stop.is_set():
+                event = stream.try_next()
+                if event is not None:
+                    self.process_event(event)
+                self.resume_token = stream.resume_token
+
+    def _run(self) -> None:
+        method = self.method
+        while not self._stop.is_set():
+            try:
+                if method == 'poll':
+                    self.poll()
+                    self._stop.wait(self.poll_interval)
+                else:
+                    self._watch()
+            except pymongo.errors.OperationFailure:
+                if method != 'auto':
+                    raise
+                # change streams require replica sets
+                method = 'poll'
+            except pymongo.errors.PyMongoError:
+                # changes may be missed while disconnected
+                self.conn.invalidate_cache()
+                self._stop.wait(self.poll_interval)
+
+    def start(self) -> 'InvalidationListener':
+        """Start listening in a background thread"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='cache_invalidation',
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop listening and wait for the background thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,239 @@
+"""Query plans, and guarding against collection scans"""
+
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from bson.son import SON
+
+from .mongocache import fingerprint
+
+# parts of commands whose values do not change the query shape
+_LITERAL_KEYS = ('filter', '$match', 'skip', 'limit', '$skip', '$limit', '$sample',
+                 'batchSize', 'maxTimeMS')
+
+
+class CollectionScanError(Exception):
+    """Raised by `ScanGuard` for queries scanning large collections"""
+
+
+class CollectionScanWarning(UserWarning):
+    """Warned by `ScanGuard` for queries scanning large collections"""
+
+
+def _add(items: List, item) -> None:
+    if item is not None and item not in items:
+        items.append(item)
+
+
+def _collection(namespace: Optional[str]) -> Optional[str]:
+    """Collection name of the namespace, i.e. `<database>.<collection>`"""
+    return namespace.split('.', 1)[-1] if namespace else None
+
+
+def _totals(stats: Dict, summary: Dict) -> None:
+    for key, field in (('docs_examined', 'totalDocsExamined'),
+                       ('keys_examined', 'totalKeysExamined')):
+        if field in stats:
+            summary[key] = (summary[key] or 0) + stats[field]
+    if summary['returned'] is None and 'nReturned' in stats:
+        summary['returned'] = stats['nReturned']
+    if 'executionTimeMillis' in stats:
+        summary['time_ms'] = max(summary['time_ms'] or 0, stats['executionTimeMillis'])
+
+
+def _walk(node, namespace: Optional[str], summary: Dict) -> None:
+    if isinstance(node, list):
+        for item in node:
+            _walk(item, namespace, summary)
+        return
+    if not isinstance(node, dict):
+        return
+
+    if isinstance(node.get('queryPlanner'), dict):
+        namespace = node['queryPlanner'].get('namespace', namespace)
+    stage = node.get('stage')
+    if stage == 'COLLSCAN':
+        _add(summary['scanned'], _collection(namespace))
+    elif stage == 'EQ_LOOKUP' and 'Indexed' not in node.get('strategy', ''):
+        # nested loop and hash joins scan the foreign collection
+        _add(summary['scanned'], _collection(node.get('foreignCollection')))
+    elif node.get('indexName'):
+        _add(summary['indexes'], node['indexName'])
+
+    if isinstance(node.get('$lookup'), dict):
+        if node.get('collectionScans'):
+            _add(summary['scanned'], node['$lookup'].get('from'))
+        for name in node.get('indexesUsed') or []:
+            _add(summary['indexes'], name)
+        _totals({key: node[key] for key in ('totalDocsExamined', 'totalKeysExamined')
+                 if key in node}, summary)
+    if 'executionTimeMillisEstimate' in node:
+        summary['time_ms'] = max(summary['time_ms'] or 0, node['executionTimeMillisEstimate'])
+
+    for key, val in node.items():
+        if key in ('rejectedPlans', 'allPlansExecution'):
+            continue
+        if key == 'executionStats':
+            _totals(val, summary)
+        else:
+            _walk(val, namespace, summary)
+
+
+def summarize(raw: Dict) -> Dict[str, Any]:
+    """Summarize the output of the explain command
+
+    Args:
+        raw (Dict): Output of the explain command, for find or aggregate commands
+
+    Returns:
+        Dict[str, Any]: Summary, with
+            `index`: name of the first index used by the winning plan, None if not any,
+            `indexes`: names of all indexes used, including those for `$lookup`,
+            `collscan`: whether any collection is scanned,
+            `scanned`: names of collections scanned,
+            `docs_examined`, `keys_examined`, `returned`: numbers of documents and index
+                keys examined and documents returned, None if not executed,
+            `time_ms`: execution time in milliseconds, None if not executed,
+            `raw`: the output as is
+    """
+    summary = {'index': None, 'indexes': [], 'collscan': False, 'scanned': [],
+               'docs_examined': None, 'keys_examined': None, 'returned': None,
+               'time_ms': None, 'raw': raw}
+    _walk(raw, None, summary)
+    summary['index'] = summary['indexes'][0] if summary['indexes'] else None
+    summary['collscan'] = bool(summary['scanned'])
+    stages = raw.get('stages')
+    if stages and isinstance(stages[-1], dict) and 'nReturned' in stages[-1]:
+        summary['returned'] = stages[-1]['nReturned']
+    return summary
+
+
+def explain(collection, command: Dict, verbosity='executionStats', session=None) -> Dict[str, Any]:
+    """Run the explain command and summarize the output
+
+    Args:
+        collection (pymongo.collection.Collection): Collection queried
+        command (Dict): Find or aggregate command to explain
+        verbosity (str, optional): `queryPlanner` to only choose the plan, or
+            `executionStats` or `allPlansExecution` to also execute it.
+            Defaults to 'executionStats'.
+        session (ClientSession, optional): Session. Defaults to None.
+
+    Returns:
+        Dict[str, Any]: Summary, see `summarize`
+    """
+    return summarize(collection.database.command(
+        SON([('explain', command), ('verbosity', verbosity)]), session=session))
+
+
+def _mask(val):
+    if isinstance(val, dict):
+        return SON((key, _mask(item)) for key, item in val.items())
+    if isinstance(val, (list, tuple)):
+        if not any(isinstance(_, dict) for _ in val):
+            return 'array'
+        return [_mask(_) for _ in val]
+    return type(val).__name__
+
+
+def shape(command):
+    """The command with literal values in conditions, skips and limits replaced by
+    their type names, so that commands differing only in these values share plans"""
+    if isinstance(command, dict):
+        return SON((key, _mask(val) if key in _LITERAL_KEYS else shape(val))
+                   for key, val in command.items())
+    if isinstance(command, (list, tuple)):
+        return [shape(_) for _ in command]
+    return command
+
+
+class ScanGuard:
+    """Refuse or warn on queries scanning whole collections larger than the threshold.
+    Each query shape is explained once, without executing it, and its plan is remembered.
+    Sizes of scanned collections are estimated at most once per `size_ttl` seconds."""
+
+    def __init__(self, threshold: int = 10000, action='raise', maxsize: int = 1024,
+                 size_ttl: float = 60) -> None:
+        """
+        Args:
+            threshold (int, optional): Largest number of documents in collections allowed
+                to be scanned. Defaults to 10000.
+            action (str, optional): `raise` to raise `CollectionScanError`, or `warn`
+                to warn with `CollectionScanWarning`. Defaults to 'raise'.
+            maxsize (int, optional): Maximum number of query shapes remembered.
+                Defaults to 1024.
+            size_ttl (float, optional): Seconds before estimated collection sizes are
+                refreshed. Defaults to 60.
+        """
+        assert action in ('raise', 'warn'), 'action must be `raise` or `warn`'
+        self.threshold = threshold
+        self.action = action
+        self.maxsize = maxsize
+        self.size_ttl = size_ttl
+        self.explained = 0
+        # shape fingerprint -> names of collections scanned
+        self._scans: OrderedDict = OrderedDict()
+        # (database name, collection name) -> (expiry, estimated number of documents)
+        self._sizes: Dict[Tuple[str, str], Tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    def check(self, collection, scanned: Iterable[str]) -> None:
+        """Raise or warn if any of the scanned collections is larger than the threshold
+
+        Args:
+            collection (pymongo.collection.Collection): Collection queried
+            scanned (Iterable[str]): Names of collections scanned, see `summarize`
+        """
+        for name in scanned:
+            size = self._size(collection.database, name)
+            if size <= self.threshold:
+                continue
+            message = f'Query on `{collection.name}` scans collection `{name}` ' \
+                f'of {size} documents, more than {self.threshold}'
+            if self.action == 'raise':
+                raise CollectionScanError(message)
+            warnings.warn(message, CollectionScanWarning, stacklevel=4)
+
+    def _size(self, database, name: str) -> int:
+        """Estimated number of documents in the collection, refreshed after `size_ttl`"""
+        key = (database.name, name)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sizes.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        size = database[name].estimated_document_count()
+        with self._lock:
+            self._sizes[key] = (now + self.size_ttl, size)
+        return size
+
+    def inspect(self, collection, command: Dict, session=None) -> None:
+        """Check the command before running it, see `check`
+
+        Args:
+            collection (pymongo.collection.Collection): Collection queried
+            command (Dict): Find or aggregate command
+            session (ClientSession, optional): Session. Defaults to None.
+        """
+        key = fingerprint(shape(command))
+        with self._lock:
+            scanned = self._scans.get(key)
+            if scanned is not None:
+                self._scans.move_to_end(key)
+        if scanned is None:
+            scanned = explain(collection, command, 'queryPlanner', session)['scanned']
+            with self._lock:
+                self.explained += 1
+                self._scans[key] = scanned
+                while len(self._scans) > self.maxsize:
+                    self._scans.popitem(last=False)
+        self.check(collection, scanned)
+
+    def clear(self) -> None:
+        """Forget plans of query shapes and collection sizes, e.g. after creating indexes"""
+        with self._lock:
+            self._scans.clear()
+            self._sizes.clear()
@@ -0,0 +1,1344 @@
+"""In-memory storage backend, implementing the subset of the pymongo client, database
+and collection API used by PyMongoWrapper, for tests and benchmarks without a server.
+
+Queries are matched and aggregation expressions evaluated with `QExprEvaluator`.
+Transactions are not isolated, and data is lost when the client is closed."""
+
+import datetime
+import itertools
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import bson
+import pymongo
+import pymongo.errors
+from bson import ObjectId
+from bson.regex import Regex
+from bson.son import SON
+from pymongo.results import (BulkWriteResult, DeleteResult, InsertManyResult,
+                             InsertOneResult, UpdateResult)
+
+from .qxeval import QExprEvaluator
+
+_MISSING = object()
+
+_REGEX_TYPES = (re.Pattern, Regex)
+
+
+def _copy(doc: Dict) -> Dict:
+    """Deep copy through BSON, which also validates the document like a server does"""
+    return bson.decode(bson.encode(doc))
+
+
+def _type_rank(val) -> int:
+    """Rank of the value type in the BSON comparison order"""
+    if val is None:
+        return 1
+    if isinstance(val, bool):
+        return 8
+    if isinstance(val, (int, float, bson.Int64, bson.Decimal128)):
+        return 2
+    if isinstance(val, str):
+        return 3
+    if isinstance(val, dict):
+        return 4
+    if isinstance(val, list):
+        return 5
+    if isinstance(val, (bytes, bson.Binary)):
+        return 6
+    if isinstance(val, ObjectId):
+        return 7
+    if isinstance(val, datetime.datetime):
+        return 9
+    if isinstance(val, _REGEX_TYPES):
+        return 11
+    return 12
+
+
+def _order_key(val) -> Tuple:
+    """Key for sorting values of any types in the BSON comparison order"""
+    rank = _type_rank(val)
+    if rank == 1:
+        return (rank, 0)
+    if rank == 2 and isinstance(val, bson.Decimal128):
+        return (rank, val.to_decimal())
+    if rank == 4:
+        return (rank, bson.encode(val))
+    if rank == 5:
+        return (rank, tuple(_order_key(_) for _ in val))
+    if rank >= 11:
+        return (rank, str(val))
+    return (rank, val)
+
+
+def _hash_key(val):
+    """Hashable key for the value, distinguishing values MongoDB does not consider equal"""
+    rank = _type_rank(val)
+    if rank in (4, 5):
+        return (rank, bson.encode({'v': val}))
+    return (rank, val)
+
+
+def _equals(a, b) -> bool:
+    return _type_rank(a) == _type_rank(b) and a == b
+
+
+def _get_values(doc, path: str) -> List:
+    """Values at the dotted path, traversing arrays of embedded documents like MongoDB"""
+    if '.' not in path:
+        return [doc[path]] if path in doc else []
+    parts = path.split('.')
+
+    def _walk(val, i):
+        if i == len(parts):
+            return [val]
+        key = parts[i]
+        if isinstance(val, dict):
+            return _walk(val[key], i + 1) if key in val else []
+        if isinstance(val, list):
+            results = []
+            if key.isdigit():
+                if int(key) < len(val):
+                    results += _walk(val[int(key)], i + 1)
+            else:
+                for ele in val:
+                    if isinstance(ele, dict):
+                        results += _walk(ele, i)
+            return results
+        return []
+
+    return _walk(doc, 0)
+
+
+def _get_path(doc, path: str, default=_MISSING):
+    """Value at the dotted path, without traversing arrays"""
+    val = doc
+    for key in path.split('.'):
+        if isinstance(val, dict) and key in val:
+            val = val[key]
+        elif isinstance(val, list) and key.isdigit() and int(key) < len(val):
+            val = val[int(key)]
+        else:
+            return default
+    return val
+
+
+def _set_path(doc, path: str, val) -> None:
+    parts = path.split('.')
+    target = doc
+    for key in parts[:-1]:
+        if isinstance(target, list) and key.isdigit():
+            target = target[int(key)]
+        else:
+            target = target.setdefault(key, {})
+    key = parts[-1]
+    if isinstance(target, list) and key.isdigit():
+        index = int(key)
+        target.extend([None] * (index + 1 - len(target)))
+        target[index] = val
+    else:
+        target[key] = val
+
+
+def _unset_path(doc, path: str) -> None:
+    parts = path.split('.')
+    target = _get_path(doc, '.'.join(parts[:-1])) if len(parts) > 1 else doc
+    if isinstance(target, dict):
+        target.pop(parts[-1], None)
+    elif isinstance(target, list) and parts[-1].isdigit() and int(parts[-1]) < len(target):
+        target[int(parts[-1])] = None
+
+
+def _regex(operand, options='') -> re.Pattern:
+    if isinstance(operand, Regex):
+        operand = operand.try_compile()
+    if isinstance(operand, re.Pattern):
+        if not options:
+            return operand
+        operand = operand.pattern
+    flags = 0
+    for option in options or '':
+        flags |= {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}.get(option, 0)
+    return re.compile(operand, flags)
+
+
+class _Operands(list):
+    """Operands of `$in` with their hash keys, prepared once for matching many documents"""
+
+    def __init__(self, operands: Iterable) -> None:
+        super().__init__(operands)
+        self.patterns = [_ for _ in self if isinstance(_, _REGEX_TYPES)]
+        self.keys = {_hash_key(_) for _ in self if not isinstance(_, _REGEX_TYPES)}
+
+
+class MemoryMatcher(QExprEvaluator):
+    """Query matching and expression evaluation for the in-memory backend.
+    Query operators follow MongoDB semantics on arrays, missing fields and types,
+    `$expr` and aggregation expressions are evaluated by `QExprEvaluator`."""
+
+    def _compare(self, operator, *args):
+        """Compare values of any types in the BSON comparison order"""
+        op_a, op_b = (_order_key(_) for _ in args)
+        return {
+            '$eq': op_a == op_b, '$ne': op_a != op_b,
+            '$gt': op_a > op_b, '$gte': op_a >= op_b,
+            '$lt': op_a < op_b, '$lte': op_a <= op_b,
+        }[operator]
+
+    def prepare(self, cond: Optional[Dict]) -> Dict:
+        """Prepare the query condition for matching many documents"""
+        prepared = {}
+        for key, val in (cond or {}).items():
+            if key in ('$and', '$or', '$nor'):
+                val = [self.prepare(_) for _ in val]
+            elif not key.startswith('$') and isinstance(val, dict):
+                val = {op: _Operands(operand) if op in ('$in', '$nin') else
+                       self.prepare(operand) if op == '$elemMatch' and isinstance(operand, dict) else
+                       operand
+                       for op, operand in val.items()}
+            prepared[key] = val
+        return prepared
+
+    def match(self, cond: Optional[Dict], doc: Dict) -> bool:
+        """Check if the document matches the query condition"""
+        for key, val in (cond or {}).items():
+            if key == '$and':
+                if not all(self.match(_, doc) for _ in val):
+                    return False
+            elif key == '$or':
+                if not any(self.match(_, doc) for _ in val):
+                    return False
+            elif key == '$nor':
+                if any(self.match(_, doc) for _ in val):
+                    return False
+            elif key == '$expr':
+                if not self.value(val, doc):
+                    return False
+            elif key.startswith('$'):
+                raise pymongo.errors.OperationFailure(f'unknown top level operator: {key}', 2)
+            elif not self._match_field(_get_values(doc, key), val):
+                return False
+        return True
+
+    def _match_field(self, values: List, cond) -> bool:
+        if isinstance(cond, dict) and cond and all(str(_).startswith('$') for _ in cond):
+            options = cond.get('$options', '')
+            return all(self._match_operator(values, op, operand, options)
+                       for op, operand in cond.items() if op != '$options')
+        if isinstance(cond, _REGEX_TYPES):
+            return self._match_operator(values, '$regex', cond, '')
+        return self._match_operator(values, '$eq', cond, '')
+
+    @staticmethod
+    def _expand(values: List) -> List:
+        """Values and elements of array values"""
+        expanded = []
+        for val in values:
+            expanded.append(val)
+            if isinstance(val, list):
+                expanded += val
+        return expanded
+
+    def _match_operator(self, values: List, op: str, operand, options: str) -> bool:
+        if op == '$eq':
+            if operand is None and not values:
+                return True
+            if isinstance(operand, _REGEX_TYPES):
+                return self._match_operator(values, '$regex', operand, '')
+            if len(values) == 1 and not isinstance(values[0], list):
+                return _equals(values[0], operand)
+            return any(_equals(_, operand) for _ in self._expand(values))
+        if op == '$ne':
+            return not self._match_operator(values, '$eq', operand, options)
+        if op in ('$gt', '$gte', '$lt', '$lte'):
+            if operand is None and op in ('$gte', '$lte'):
+                return self._match_operator(values, '$eq', None, options)
+            rank, key = _type_rank(operand), _order_key(operand)
+            compare = {
+                '$gt': lambda a: _order_key(a) > key,
+                '$gte': lambda a: _order_key(a) >= key,
+                '$lt': lambda a: _order_key(a) < key,
+                '$lte': lambda a: _order_key(a) <= key,
+            }[op]
+            return any(_type_rank(_) == rank and compare(_) for _ in self._expand(values))
+        if op == '$in':
+            if not isinstance(operand, _Operands):
+                operand = _Operands(operand)
+            if not values and _hash_key(None) in operand.keys:
+                return True
+            return any(_hash_key(_) in operand.keys for _ in self._expand(values)) or \
+                any(self._match_operator(values, '$regex', _, '') for _ in operand.patterns)
+        if op == '$nin':
+            return not self._match_operator(values, '$in', operand, options)
+        if op == '$exists':
+            return bool(values) == bool(operand)
+        if op == '$regex':
+            pattern = _regex(operand, options)
+            return any(isinstance(_, str) and pattern.search(_) is not None
+                       for _ in self._expand(values))
+        if op == '$size':
+            return any(isinstance(_, list) and len(_) == operand for _ in values)
+        if op == '$all':
+            return bool(operand) and all(self._match_operator(values, '$eq', _, options)
+                                         for _ in operand)
+        if op == '$elemMatch':
+            return any(isinstance(val, list) and any(self._match_element(ele, operand) for ele in val)
+                       for val in values)
+        if op == '$not':
+            return not self._match_field(values, operand)
+        if op == '$mod':
+            divisor, remainder = operand
+            return any(_type_rank(_) == 2 and not isinstance(_, bool) and _ % divisor == remainder
+                       for _ in self._expand(values))
+        raise pymongo.errors.OperationFailure(f'unknown operator: {op}', 2)
+
+    def _match_element(self, ele, cond) -> bool:
+        if isinstance(cond, dict) and cond and all(str(_).startswith('$') for _ in cond) \
+                and not any(_ in cond for _ in ('$and', '$or', '$nor', '$expr')):
+            return self._match_field([ele], cond)
+        return isinstance(ele, dict) and self.match(cond, ele)
+
+    def value(self, expr, doc: Dict):
+        """Evaluate the aggregation expression in the context of the document"""
+        if isinstance(expr, str) and expr.startswith('$'):
+            if expr in ('$$ROOT', '$$CURRENT'):
+                return doc
+            if expr.startswith('$$'):
+                raise pymongo.errors.OperationFailure(f'unsupported variable: {expr}', 17276)
+            val = _get_path(doc, expr[1:], None)
+            if val is None and '.' in expr:
+                # paths through arrays give arrays of values
+                values = _get_values(doc, expr[1:])
+                return values if values else None
+            return val
+        if isinstance(expr, list):
+            return [self.value(_, doc) for _ in expr]
+        if isinstance(expr, dict):
+            if len(expr) == 1:
+                (key, val), = expr.items()
+                if key == '$literal':
+                    return val
+                if key.startswith('$'):
+                    try:
+                        return self.evaluate(expr, doc)
+                    except (TypeError, ValueError) as ex:
+                        raise pymongo.errors.OperationFailure(f'{key}: {ex}', 2) from ex
+            return {key: self.value(val, doc) for key, val in expr.items()}
+        return expr
+
+
+def _project(doc: Dict, projection: Optional[Dict], matcher: MemoryMatcher) -> Dict:
+    """Apply inclusion, exclusion or computed fields of the projection to a copy of the document"""
+    if not projection:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = {_: 1 for _ in projection}
+    include_id = projection.get('_id', 1)
+    fields = {k: v for k, v in projection.items() if k != '_id'}
+    inclusive = any(not isinstance(v, (bool, int, float)) or v for v in fields.values()) \
+        if fields else bool(include_id)
+    if not inclusive:
+        for path in fields:
+            _exclude_path(doc, path.split('.'))
+        if not include_id:
+            doc.pop('_id', None)
+        return doc
+
+    result = {}
+    if include_id and '_id' in doc:
+        result['_id'] = doc['_id'] if isinstance(include_id, (bool, int, float)) \
+            else matcher.value(include_id, doc)
+    elif not isinstance(include_id, (bool, int, float)):
+        result['_id'] = matcher.value(include_id, doc)
+    for path, spec in fields.items():
+        if isinstance(spec, (bool, int, float)):
+            _include_path(doc, result, path.split('.'))
+        else:
+            _set_path(result, path, matcher.value(spec, doc))
+    return result
+
+
+def _exclude_path(doc, parts: List[str]) -> None:
+    """Remove the path from the document, and from documents in arrays on the path"""
+    if isinstance(doc, list):
+        for ele in doc:
+            _exclude_path(ele, parts)
+    elif isinstance(doc, dict) and parts[0] in doc:
+        if len(parts) == 1:
+            del doc[parts[0]]
+        else:
+            _exclude_path(doc[parts[0]], parts[1:])
+
+
+def _include_path(src, dst: Dict, parts: List[str]) -> None:
+    key = parts[0]
+    if not isinstance(src, dict) or key not in src:
+        return
+    if len(parts) == 1:
+        dst[key] = src[key]
+        return
+    val = src[key]
+    if isinstance(val, dict):
+        _include_path(val, dst.setdefault(key, {}), parts[1:])
+    elif isinstance(val, list):
+        projected = dst.setdefault(key, [{} for _ in val if isinstance(_, dict)])
+        for ele, target in zip([_ for _ in val if isinstance(_, dict)], projected):
+            _include_path(ele, target, parts[1:])
+
+
+def _sort_key(doc: Dict, key: str, direction: int) -> Tuple:
+    """Key for sorting the document by the path, using the least element of arrays
+    in ascending order and the greatest in descending order"""
+    values = _get_values(doc, key)
+    expanded = []
+    for val in values:
+        expanded += val if isinstance(val, list) and val else [val]
+    if not expanded:
+        return _order_key(None)
+    keys = [_order_key(_) for _ in expanded]
+    return min(keys) if direction > 0 else max(keys)
+
+
+def _sort_docs(docs: List[Dict], sort: Iterable[Tuple[str, int]]) -> List[Dict]:
+    for key, direction in reversed(list(sort)):
+        docs.sort(key=lambda doc, key=key, direction=direction: _sort_key(doc, key, direction),
+                  reverse=direction < 0)
+    return docs
+
+
+def _normalize_sort(key_or_list, direction=None) -> List[Tuple[str, int]]:
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return [tuple(_) for _ in key_or_list or []]
+
+
+class MemoryCursor:
+    """Cursor over results of `find`, evaluated on the first iteration"""
+
+    def __init__(self, collection: 'MemoryCollection', filter=None, projection=None,
+                 skip=0, limit=0, sort=None, **_) -> None:
+        self.collection = collection
+        self._filter = filter or {}
+        self._projection = projection
+        self._skip = skip or 0
+        self._limit = limit or 0
+        self._sort = _normalize_sort(sort) if sort else []
+        self._results = None
+        self._killed = False
+
+    def sort(self, key_or_list, direction=None) -> 'MemoryCursor':
+        self._sort = _normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, skip: int) -> 'MemoryCursor':
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int) -> 'MemoryCursor':
+        self._limit = limit
+        return self
+
+    def batch_size(self, _) -> 'MemoryCursor':
+        return self
+
+    def max_time_ms(self, _) -> 'MemoryCursor':
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Dict:
+        if self._killed:
+            raise StopIteration
+        if self._results is None:
+            self._results = iter(self.collection._find(
+                self._filter, self._projection, self._sort, self._skip, self._limit))
+        return next(self._results)
+
+    next = __next__
+
+    @property
+    def alive(self) -> bool:
+        return not self._killed
+
+    def close(self) -> None:
+        self._killed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class MemoryCommandCursor(MemoryCursor):
+    """Cursor over results of `aggregate`"""
+
+    def __init__(self, results: List[Dict]) -> None:
+        self._results = iter(results)
+        self._killed = False
+
+
+class _Index:
+    """Hash index on the keys of the declared index"""
+
+    def __init__(self, keys: List[Tuple[str, Any]], name: str, unique=False, sparse=False,
+                 partialFilterExpression=None, expireAfterSeconds=None, **options) -> None:
+        self.keys = keys
+        self.name = name
+        self.unique = unique
+        self.sparse = sparse
+        self.partial = partialFilterExpression
+        self.expire_after = expireAfterSeconds
+        self.options = options
+        self.entries: Dict[Tuple, set] = {}
+
+    def info(self) -> Dict:
+        info = {'v': 2, 'key': list(self.keys)}
+        if self.unique:
+            info['unique'] = True
+        if self.sparse:
+            info['sparse'] = True
+        if self.partial is not None:
+            info['partialFilterExpression'] = self.partial
+        if self.expire_after is not None:
+            info['expireAfterSeconds'] = self.expire_after
+        info.update(self.options)
+        return info
+
+    def entry_keys(self, doc: Dict, matcher: MemoryMatcher) -> List[Tuple]:
+        if self.partial is not None and not matcher.match(self.partial, doc):
+            return []
+        per_field = []
+        for field, _ in self.keys:
+            values = MemoryMatcher._expand(_get_values(doc, field))
+            values = [_ for _ in values if not isinstance(_, list) or not _] or []
+            if not values:
+                if self.sparse:
+                    return []
+                values = [None]
+            per_field.append({_hash_key(_): None for _ in values})
+        return [tuple(_) for _ in itertools.product(*per_field)]
+
+
+class MemoryCollection:
+    """Collection stored in memory"""
+
+    def __init__(self, database: 'MemoryDatabase', name: str) -> None:
+        self.database = database
+        self.name = name
+        self.full_name = f'{database.name}.{name}'
+        self._lock = threading.RLock()
+        self._matcher = database.client._matcher
+        self._clear()
+
+    def __getattr__(self, name: str) -> 'MemoryCollection':
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.database[f'{self.name}.{name}']
+
+    def __getitem__(self, name: str) -> 'MemoryCollection':
+        return self.database[f'{self.name}.{name}']
+
+    def __repr__(self) -> str:
+        return f'MemoryCollection({self.full_name!r})'
+
+    def with_options(self, **_) -> 'MemoryCollection':
+        return self
+
+    # storage
+
+    def _clear(self) -> None:
+        """Remove all documents and indexes, keeping this object usable by holders"""
+        with self._lock:
+            self._docs: Dict[Tuple, Dict] = {}
+            self._seq: Dict[Tuple, int] = {}
+            self._counter = itertools.count()
+            self._indexes: Dict[str, _Index] = {'_id_': _Index([('_id', 1)], '_id_', unique=True)}
+
+    def _expire(self) -> None:
+        """Remove documents expired according to TTL indexes"""
+        for index in self._indexes.values():
+            if index.expire_after is None:
+                continue
+            deadline = datetime.datetime.utcnow() - datetime.timedelta(seconds=index.expire_after)
+            field = index.keys[0][0]
+            for key, doc in list(self._docs.items()):
+                stamps = [_.replace(tzinfo=None) for _ in _get_values(doc, field)
+                          if isinstance(_, datetime.datetime)]
+                if stamps and min(stamps) < deadline:
+                    self._remove(key)
+
+    def _plan(self, cond: Dict) -> Tuple[Optional[_Index], Iterable[Dict]]:
+        """Index used and documents possibly matching the condition, narrowed down with
+        the index if the condition has equality or `$in` clauses on all of its fields"""
+        values = {}
+        for key, val in cond.items():
+            if key.startswith('$'):
+                continue
+            if isinstance(val, dict) and val and all(str(_).startswith('$') for _ in val):
+                if len(val) != 1 or not ('$eq' in val or '$in' in val):
+                    continue
+                if '$in' in val:
+                    operands = val['$in']
+                else:
+                    operands = [val['$eq']]
+            else:
+                operands = [val]
+            if any(isinstance(_, (dict, list) + _REGEX_TYPES) or _ is None for _ in operands):
+                continue
+            values[key] = [_hash_key(_) for _ in operands]
+
+        for index in self._indexes.values():
+            if index.partial is not None or index.sparse or \
+                    not all(field in values for field, _ in index.keys):
+                continue
+            keys = set()
+            for entry in itertools.product(*[values[field] for field, _ in index.keys]):
+                keys.update(index.entries.get(entry, ()))
+            return index, [self._docs[_] for _ in sorted(keys, key=self._seq.__getitem__)]
+        return None, self._docs.values()
+
+    def _join_index(self, field: str) -> Optional[_Index]:
+        """Index on the field alone for joining with `$lookup`, None if not any"""
+        with self._lock:
+            self._expire()
+            for index in self._indexes.values():
+                if index.partial is None and not index.sparse and \
+                        [key for key, _ in index.keys] == [field]:
+                    return index
+        return None
+
+    def _fetch(self, index: _Index, values: Iterable) -> List[Dict]:
+        """Documents with any of the values in the index on a single field"""
+        keys = set()
+        with self._lock:
+            for val in values:
+                if not isinstance(val, list) or not val:
+                    keys.update(index.entries.get((_hash_key(val),), ()))
+            return [self._docs[_] for _ in sorted(keys, key=self._seq.__getitem__)]
+
+    def _index_entries(self, doc: Dict) -> Dict[str, List[Tuple]]:
+        return {name: index.entry_keys(doc, self._matcher) for name, index in self._indexes.items()}
+
+    def _check_unique(self, doc_key, entries: Dict[str, List[Tuple]]) -> None:
+        """Check unique indexes for entries of the document, replacing the document
+        with the key if given"""
+        for name, keys in entries.items():
+            index = self._indexes[name]
+            if not index.unique:
+                continue
+            for key in keys:
+                if index.entries.get(key, set()) - {doc_key}:
+                    dup = ', '.join(f'{field}: {val[1]!r}' for (field, _), val in zip(index.keys, key))
+                    raise pymongo.errors.DuplicateKeyError(
+                        f'E11000 duplicate key error collection: {self.full_name} '
+                        f'index: {name} dup key: {{ {dup} }}', 11000)
+
+    def _store(self, doc: Dict, previous: Optional[Dict] = None) -> None:
+        """Store the document, replacing the previous version"""
+        doc_key = _hash_key(doc['_id'])
+        entries = self._index_entries(doc)
+        self._check_unique(doc_key if previous is not None else None, entries)
+        if previous is not None:
+            self._unindex(doc_key, previous)
+        else:
+            self._seq[doc_key] = next(self._counter)
+        for name, keys in entries.items():
+            for key in keys:
+                self._indexes[name].entries.setdefault(key, set()).add(doc_key)
+        self._docs[doc_key] = doc
+        self.database._created(self.name)
+
+    def _unindex(self, doc_key, doc: Dict) -> None:
+        for name, keys in self._index_entries(doc).items():
+            entries = self._indexes[name].entries
+            for key in keys:
+                if key in entries:
+                    entries[key].discard(doc_key)
+                    if not entries[key]:
+                        del entries[key]
+
+    def _remove(self, doc_key) -> None:
+        doc = self._docs.pop(doc_key)
+        self._seq.pop(doc_key)
+        self._unindex(doc_key, doc)
+
+    def _iter_matching(self, cond: Optional[Dict]) -> Iterable[Dict]:
+        """Documents matching the condition, among candidates taken when called.
+        Stored documents are replaced rather than modified, so matching them
+        needs no lock, and they are copied only when handed out"""
+        cond = self._matcher.prepare(cond)
+        with self._lock:
+            self._expire()
+            _, candidates = self._plan(cond)
+            candidates = list(candidates)
+        return (_ for _ in candidates if self._matcher.match(cond, _))
+
+    def _matching(self, cond: Optional[Dict]) -> List[Dict]:
+        return list(self._iter_matching(cond))
+
+    def _find(self, cond, projection, sort, skip, limit) -> Iterable[Dict]:
+        end = skip + limit if limit else None
+        if sort:
+            docs = _sort_docs(self._matching(cond), sort)[skip:end]
+        else:
+            docs = itertools.islice(self._iter_matching(cond), skip, end)
+        return (_project(_copy(_), projection, self._matcher) for _ in docs)
+
+    # queries
+
+    def find(self, filter=None, projection=None, skip=0, limit=0, sort=None,
+             session=None, **kwargs) -> MemoryCursor:
+        return MemoryCursor(self, filter, projection, skip, limit, sort, **kwargs)
+
+    def find_one(self, filter=None, *args, **kwargs) -> Optional[Dict]:
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        kwargs['limit'] = 1
+        return next(iter(self.find(filter, *args, **kwargs)), None)
+
+    def count_documents(self, filter: Dict, session=None, skip=0, limit=0, **_) -> int:
+        count = max(len(self._matching(filter)) - (skip or 0), 0)
+        return min(count, limit) if limit else count
+
+    def estimated_document_count(self, **_) -> int:
+        with self._lock:
+            self._expire()
+            return len(self._docs)
+
+    def distinct(self, key: str, filter=None, session=None, **_) -> List:
+        values = {}
+        for doc in self._matching(filter):
+            for val in MemoryMatcher._expand(_get_values(doc, key)):
+                if not isinstance(val, list):
+                    values.setdefault(_hash_key(val), val)
+        return [_copy({'v': _})['v'] for _ in values.values()]
+
+    def aggregate(self, pipeline: List[Dict], session=None, **_) -> MemoryCommandCursor:
+        if pipeline and '$match' in pipeline[0]:
+            docs = self._matching(pipeline[0]['$match'])
+            pipeline = pipeline[1:]
+        else:
+            docs = self._matching({})
+        docs = [_copy(_) for _ in docs]
+        return MemoryCommandCursor(self.database._aggregate(docs, pipeline))
+
+    def watch(self, *_, **__):
+        raise pymongo.errors.OperationFailure(
+            'The $changeStream stage is only supported on replica sets', 40573)
+
+    @staticmethod
+    def _plan_stage(index: Optional[_Index]) -> Dict:
+        if index is None:
+            return {'stage': 'COLLSCAN', 'direction': 'forward'}
+        return {'stage': 'FETCH', 'inputStage': {
+            'stage': 'IXSCAN', 'indexName': index.name, 'keyPattern': dict(index.keys),
+            'isUnique': index.unique
+        }}
+
+    def explain(self, command: Dict, verbosity='executionStats') -> Dict:
+        """Explain the find or aggregate command in the output format of MongoDB, for plans
+        of this backend, i.e. fetching by an index or scanning the collection"""
+        start = time.perf_counter()
+        pipeline = None
+        if 'find' in command:
+            cond = command.get('filter') or {}
+        else:
+            pipeline = list(command['pipeline'])
+            cond = pipeline.pop(0)['$match'] if pipeline and '$match' in pipeline[0] else {}
+        with self._lock:
+            self._expire()
+            index, candidates = self._plan(self._matcher.prepare(cond))
+            examined = len(candidates)
+
+        cursor = {'queryPlanner': {'namespace': self.full_name, 'rejectedPlans': [],
+                                   'winningPlan': self._plan_stage(index)}}
+        executed = verbosity != 'queryPlanner'
+        if executed:
+            if pipeline is None:
+                docs = list(self.find(cond, command.get('projection'), command.get('skip', 0),
+                                      command.get('limit', 0), command.get('sort')))
+            else:
+                docs = [_copy(_) for _ in self._matching(cond)]
+            cursor['executionStats'] = {
+                'nReturned': len(docs),
+                'executionTimeMillis': int((time.perf_counter() - start) * 1000),
+                'totalKeysExamined': examined if index else 0,
+                'totalDocsExamined': examined
+            }
+        if pipeline is None:
+            return dict(cursor, ok=1.0)
+
+        stages = [{'$cursor': cursor}]
+        for stage in pipeline:
+            explained = dict(stage)
+            lookup = stage.get('$lookup')
+            index = None
+            if lookup is not None:
+                foreign = self.database[lookup['from']]
+                index = foreign._join_index(lookup['foreignField']) \
+                    if 'localField' in lookup else None
+                explained.update(collectionScans=0 if index else 1,
+                                 indexesUsed=[index.name] if index else [])
+            if executed:
+                if lookup is not None:
+                    count = foreign.estimated_document_count()
+                docs = self.database._aggregate(docs, [stage])
+                if lookup is not None:
+                    examined = sum(len(_get_values(_, lookup['as'])[0]) for _ in docs) \
+                        if index else count
+                    explained.update(totalDocsExamined=examined,
+                                     totalKeysExamined=examined if index else 0)
+                explained.update(nReturned=len(docs), executionTimeMillisEstimate=int(
+                    (time.perf_counter() - start) * 1000))
+            stages.append(explained)
+        return {'stages': stages, 'ok': 1.0}
+
+    # writes
+
+    def _insert(self, doc: Dict) -> Any:
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        stored = _copy(doc)
+        with self._lock:
+            self._store(stored)
+        return doc['_id']
+
+    def insert_one(self, document: Dict, bypass_document_validation=False,
+                   session=None, **_) -> InsertOneResult:
+        return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents: Iterable[Dict], ordered=True,
+                    bypass_document_validation=False, session=None, **_) -> InsertManyResult:
+        requests = [pymongo.InsertOne(_) for _ in documents]
+        self.bulk_write(requests, ordered=ordered)
+        return InsertManyResult([_._doc['_id'] for _ in requests], True)
+
+    def _apply_update(self, doc: Dict, update: Union[Dict, List], inserting=False) -> Dict:
+        """Apply the update to a copy of the document"""
+        if isinstance(update, list):
+            result = self.database._aggregate([_copy(doc)], update)[0]
+        elif not any(str(_).startswith('$') for _ in update):
+            result = dict(update)
+            if '_id' in doc:
+                result = {'_id': doc['_id'], **{k: v for k, v in result.items() if k != '_id'}}
+        else:
+            result = _copy(doc)
+            for op, fields in update.items():
+                for path, val in fields.items():
+                    self._apply_operator(result, op, path, val, inserting)
+        if '_id' in doc and not _equals(result.get('_id'), doc['_id']):
+            raise pymongo.errors.WriteError(
+                "Performing an update on the path '_id' would modify the immutable field '_id'", 66)
+        return _copy(result)
+
+    def _apply_operator(self, doc: Dict, op: str, path: str, val, inserting: bool) -> None:
+        current = _get_path(doc, path)
+        if op == '$set':
+            _set_path(doc, path, val)
+        elif op == '$setOnInsert':
+            if inserting:
+                _set_path(doc, path, val)
+        elif op == '$unset':
+            _unset_path(doc, path)
+        elif op == '$inc':
+            _set_path(doc, path, (0 if current is _MISSING else current) + val)
+        elif op == '$mul':
+            _set_path(doc, path, (0 if current is _MISSING else current) * val)
+        elif op in ('$min', '$max'):
+            if current is _MISSING or \
+                    (_order_key(val) < _order_key(current)) == (op == '$min') and \
+                    not _equals(val, current):
+                _set_path(doc, path, val)
+        elif op == '$currentDate':
+            now = datetime.datetime.utcnow()
+            _set_path(doc, path, now.replace(microsecond=now.microsecond // 1000 * 1000))
+        elif op == '$rename':
+            if current is not _MISSING:
+                _unset_path(doc, path)
+                _set_path(doc, val, current)
+        elif op in ('$push', '$addToSet', '$pull', '$pullAll', '$pop'):
+            arr = [] if current is _MISSING else current
+            if not isinstance(arr, list):
+                raise pymongo.errors.WriteError(f'The field {path} must be an array', 2)
+            if op == '$push':
+                if isinstance(val, dict) and '$each' in val:
+                    position = val.get('$position', len(arr))
+                    arr[position:position] = val['$each']
+                    if '$sort' in val:
+                        spec = val['$sort']
+                        if isinstance(spec, dict):
+                            _sort_docs(arr, spec.items())
+                        else:
+                            arr.sort(key=_order_key, reverse=spec < 0)
+                    if '$slice' in val:
+                        arr[:] = arr[:val['$slice']] if val['$slice'] >= 0 else arr[val['$slice']:]
+                else:
+                    arr.append(val)
+            elif op == '$addToSet':
+                for item in val['$each'] if isinstance(val, dict) and '$each' in val else [val]:
+                    if not any(_equals(_, item) for _ in arr):
+                        arr.append(item)
+            elif op == '$pull':
+                arr[:] = [_ for _ in arr if not (
+                    self._matcher._match_element(_, val) if isinstance(val, dict)
+                    else self._matcher._match_field([_], val))]
+            elif op == '$pullAll':
+                arr[:] = [_ for _ in arr if not any(_equals(_, item) for item in val)]
+            elif op == '$pop':
+                if arr:
+                    arr.pop(0 if val < 0 else -1)
+            _set_path(doc, path, arr)
+        else:
+            raise pymongo.errors.WriteError(f'Unknown modifier: {op}', 9)
+
+    def _upsert_doc(self, cond: Dict) -> Dict:
+        """Document to insert for upserts, from equality conditions"""
+        doc = {}
+        for key, val in cond.items():
+            if key == '$and':
+                for sub in val:
+                    doc.update(self._upsert_doc(sub))
+            elif key.startswith('$'):
+                continue
+            elif isinstance(val, dict) and val and all(str(_).startswith('$') for _ in val):
+                if '$eq' in val:
+                    _set_path(doc, key, val['$eq'])
+            else:
+                _set_path(doc, key, val)
+        return doc
+
+    def _update(self, cond: Dict, update, upsert: bool, multi: bool,
+                replace=False) -> Dict[str, Any]:
+        if replace and any(str(_).startswith('$') for _ in update):
+            raise ValueError('replacement can not include $ operators')
+        with self._lock:
+            docs = self._matching(cond)
+            if not multi:
+                docs = docs[:1]
+            modified = 0
+            for doc in docs:
+                updated = self._apply_update(doc, update)
+                if updated != doc or list(updated) != list(doc):
+                    self._store(updated, doc)
+                    modified += 1
+            result = {'n': len(docs), 'nModified': modified, 'upserted': None}
+            if not docs and upsert:
+                doc = self._upsert_doc(cond)
+                updated = self._apply_update(doc, update, inserting=True)
+                if '_id' not in updated:
+                    updated = {'_id': doc.get('_id', ObjectId()), **updated}
+                self._store(_copy(updated))
+                result.update(n=1, upserted=updated['_id'])
+            return result
+
+    def update_one(self, filter: Dict, update, upsert=False, session=None, **_) -> UpdateResult:
+        return UpdateResult(self._update(filter, update, upsert, False), True)
+
+    def update_many(self, filter: Dict, update, upsert=False, session=None, **_) -> UpdateResult:
+        return UpdateResult(self._update(filter, update, upsert, True), True)
+
+    def replace_one(self, filter: Dict, replacement: Dict, upsert=False,
+                    session=None, **_) -> UpdateResult:
+        return UpdateResult(self._update(filter, replacement, upsert, False, True), True)
+
+    def _delete(self, cond: Dict, multi: bool) -> int:
+        with self._lock:
+            docs = self._matching(cond)
+            if not multi:
+                docs = docs[:1]
+            for doc in docs:
+                self._remove(_hash_key(doc['_id']))
+            return len(docs)
+
+    def delete_one(self, filter: Dict, session=None, **_) -> DeleteResult:
+        return DeleteResult({'n': self._delete(filter, False)}, True)
+
+    def delete_many(self, filter: Dict, session=None, **_) -> DeleteResult:
+        return DeleteResult({'n': self._delete(filter, True)}, True)
+
+    def bulk_write(self, requests: List, ordered=True, bypass_document_validation=False,
+                   session=None, **_) -> BulkWriteResult:
+        details = {'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0, 'nUpserted': 0,
+                   'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        for i, request in enumerate(requests):
+            cond = getattr(request, '_filter', None)
+            doc = getattr(request, '_doc', None)
+            upsert = bool(getattr(request, '_upsert', False))
+            try:
+                if isinstance(request, pymongo.InsertOne):
+                    self._insert(doc)
+                    details['nInserted'] += 1
+                    continue
+                if isinstance(request, (pymongo.DeleteOne, pymongo.DeleteMany)):
+                    details['nRemoved'] += self._delete(cond, isinstance(request, pymongo.DeleteMany))
+                    continue
+                result = self._update(cond, doc, upsert, isinstance(request, pymongo.UpdateMany),
+                                      isinstance(request, pymongo.ReplaceOne))
+                if result['upserted'] is not None:
+                    details['nUpserted'] += 1
+                    details['upserted'].append({'index': i, '_id': result['upserted']})
+                else:
+                    details['nMatched'] += result['n']
+                    details['nModified'] += result['nModified']
+            except pymongo.errors.PyMongoError as ex:
+                details['writeErrors'].append({
+                    'index': i, 'code': getattr(ex, 'code', None) or 2,
+                    'errmsg': str(ex), 'op': doc if doc is not None else cond
+                })
+                if ordered:
+                    break
+        if details['writeErrors']:
+            raise pymongo.errors.BulkWriteError(details)
+        return BulkWriteResult(details, True)
+
+    # indexes
+
+    def create_index(self, keys, name=None, **kwargs) -> str:
+        keys = _normalize_sort(keys, 1)
+        name = name or '_'.join(f'{field}_{direction}' for field, direction in keys)
+        kwargs.pop('background', None)
+        with self._lock:
+            existent = self._indexes.get(name)
+            if existent is not None:
+                if existent.keys != keys:
+                    raise pymongo.errors.OperationFailure(
+                        f'An existing index has the same name as the requested index: {name}', 86)
+                return name
+            for other in self._indexes.values():
+                if other.keys == keys:
+                    raise pymongo.errors.OperationFailure(
+                        f'Index already exists with a different name: {other.name}', 85)
+            index = _Index(keys, name, **kwargs)
+            for doc_key, doc in self._docs.items():
+                for key in index.entry_keys(doc, self._matcher):
+                    if index.unique and index.entries.get(key):
+                        raise pymongo.errors.DuplicateKeyError(
+                            f'E11000 duplicate key error collection: {self.full_name} '
+                            f'index: {name}', 11000)
+                    index.entries.setdefault(key, set()).add(doc_key)
+            self._indexes[name] = index
+            self.database._created(self.name)
+        return name
+
+    def create_indexes(self, indexes: List[pymongo.IndexModel], session=None, **_) -> List[str]:
+        names = []
+        for model in indexes:
+            document = dict(model.document)
+            keys = list(document.pop('key').items())
+            names.append(self.create_index(keys, **document))
+        return names
+
+    def index_information(self, session=None, **_) -> Dict[str, Dict]:
+        with self._lock:
+            return {name: index.info() for name, index in self._indexes.items()}
+
+    def list_indexes(self, session=None, **_) -> MemoryCommandCursor:
+        return MemoryCommandCursor([
+            dict(info, key=SON(info['key']), name=name)
+            for name, info in self.index_information().items()
+        ])
+
+    def drop_index(self, index_or_name, session=None, **_) -> None:
+        name = index_or_name
+        if not isinstance(name, str):
+            keys = _normalize_sort(index_or_name)
+            name = next((_.name for _ in self._indexes.values() if _.keys == keys), None)
+        with self._lock:
+            if name == '_id_' or name not in self._indexes:
+                raise pymongo.errors.OperationFailure(f'index not found with name [{name}]', 27)
+            del self._indexes[name]
+
+    def drop_indexes(self, session=None, **_) -> None:
+        with self._lock:
+            for name in [_ for _ in self._indexes if _ != '_id_']:
+                del self._indexes[name]
+
+    def drop(self, session=None, **_) -> None:
+        self.database.drop_collection(self.name)
+
+
+class MemoryDatabase:
+    """Database stored in memory"""
+
+    def __init__(self, client: 'MemoryClient', name: str) -> None:
+        self.client = client
+        self.name = name
+        self._collections: Dict[str, MemoryCollection] = {}
+        self._existing = set()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self, name)
+            return self._collections[name]
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __repr__(self) -> str:
+        return f'MemoryDatabase({self.name!r})'
+
+    def _created(self, name: str) -> None:
+        self._existing.add(name)
+
+    def get_collection(self, name: str, **_) -> MemoryCollection:
+        return self[name]
+
+    def create_collection(self, name: str, **_) -> MemoryCollection:
+        if name in self._existing:
+            raise pymongo.errors.CollectionInvalid(f'collection {name} already exists')
+        self._created(name)
+        return self[name]
+
+    def list_collection_names(self, session=None, **_) -> List[str]:
+        return sorted(self._existing)
+
+    def drop_collection(self, name_or_collection, session=None, **_) -> None:
+        name = getattr(name_or_collection, 'name', name_or_collection)
+        with self._lock:
+            collection = self._collections.get(name)
+            self._existing.discard(name)
+        if collection is not None:
+            collection._clear()
+
+    def with_options(self, **_) -> 'MemoryDatabase':
+        return self
+
+    def watch(self, *_, **__):
+        raise pymongo.errors.OperationFailure(
+            'The $changeStream stage is only supported on replica sets', 40573)
+
+    def command(self, command, *_, **__) -> Dict:
+        if command in ('ping', {'ping': 1}):
+            return {'ok': 1.0}
+        if isinstance(command, dict) and 'explain' in command:
+            explained = command['explain']
+            name = explained.get('find', explained.get('aggregate'))
+            return self[name].explain(explained, command.get('verbosity', 'allPlansExecution'))
+        raise pymongo.errors.OperationFailure(f'unsupported command: {command}', 59)
+
+    # aggregation
+
+    def _aggregate(self, docs: List[Dict], pipeline: List[Dict]) -> List[Dict]:
+        matcher = self.client._matcher
+        for stage in pipeline:
+            (op, arg), = stage.items()
+            if op == '$match':
+                docs = [_ for _ in docs if matcher.match(arg, _)]
+            elif op == '$project':
+                docs = [_project(_, arg, matcher) for _ in docs]
+            elif op in ('$addFields', '$set'):
+                for doc in docs:
+                    for path, expr in [(k, matcher.value(v, doc)) for k, v in arg.items()]:
+                        _set_path(doc, path, expr)
+            elif op == '$unset':
+                for doc in docs:
+                    for path in [arg] if isinstance(arg, str) else arg:
+                        _exclude_path(doc, path.split('.'))
+            elif op == '$sort':
+                docs = _sort_docs(docs, arg.items())
+            elif op == '$skip':
+                docs = docs[arg:]
+            elif op == '$limit':
+                docs = docs[:arg]
+            elif op == '$sample':
+                docs = random.sample(docs, min(arg['size'], len(docs)))
+            elif op == '$count':
+                docs = [{arg: len(docs)}] if docs else []
+            elif op == '$unwind':
+                docs = self._unwind(docs, arg)
+            elif op == '$group':
+                docs = self._group(docs, arg)
+            elif op == '$lookup':
+                docs = self._lookup(docs, arg)
+            elif op in ('$replaceRoot', '$replaceWith'):
+                root = arg['newRoot'] if op == '$replaceRoot' else arg
+                docs = [matcher.value(root, _) for _ in docs]
+            else:
+                raise pymongo.errors.OperationFailure(f'Unrecognized pipeline stage name: {op}', 40324)
+        return docs
+
+    @staticmethod
+    def _unwind(docs: List[Dict], arg) -> List[Dict]:
+        if isinstance(arg, str):
+            arg = {'path': arg}
+        path = arg['path'][1:]
+        preserve = arg.get('preserveNullAndEmptyArrays', False)
+        index_field = arg.get('includeArrayIndex')
+        results = []
+        for doc in docs:
+            val = _get_path(doc, path)
+            if isinstance(val, list) and val:
+                for i, ele in enumerate(val):
+                    unwound = _copy(doc)
+                    _set_path(unwound, path, ele)
+                    if index_field:
+                        unwound[index_field] = i
+                    results.append(unwound)
+            elif isinstance(val, list) or val is _MISSING or val is None:
+                if preserve:
+                    if index_field:
+                        doc[index_field] = None
+                    results.append(doc)
+            else:
+                if index_field:
+                    doc[index_field] = None
+                results.append(doc)
+        return results
+
+    def _group(self, docs: List[Dict], arg: Dict) -> List[Dict]:
+        matcher = self.client._matcher
+        groups: Dict[Any, Dict] = {}
+        values: Dict[Any, Dict[str, List]] = {}
+        for doc in docs:
+            group_id = matcher.value(arg['_id'], doc)
+            key = _hash_key(group_id)
+            if key not in groups:
+                groups[key] = {'_id': group_id}
+                values[key] = {field: [] for field in arg if field != '_id'}
+            for field, spec in arg.items():
+                if field == '_id':
+                    continue
+                (acc, expr), = spec.items()
+                values[key][field].append(1 if acc == '$count' else matcher.value(expr, doc))
+
+        for key, result in groups.items():
+            for field, spec in arg.items():
+                if field == '_id':
+                    continue
+                acc = next(iter(spec))
+                items = values[key][field]
+                numbers = [_ for _ in items if _type_rank(_) == 2]
+                present = [_ for _ in items if _ is not None]
+                if acc in ('$sum', '$count'):
+                    result[field] = sum(numbers)
+                elif acc == '$avg':
+                    result[field] = sum(numbers) / len(numbers) if numbers else None
+                elif acc in ('$min', '$max'):
+                    result[field] = (min if acc == '$min' else max)(
+                        present, key=_order_key) if present else None
+                elif acc == '$first':
+                    result[field] = items[0] if items else None
+                elif acc == '$last':
+                    result[field] = items[-1] if items else None
+                elif acc == '$push':
+                    result[field] = items
+                elif acc == '$addToSet':
+                    result[field] = list({_hash_key(_): _ for _ in items}.values())
+                else:
+                    raise pymongo.errors.OperationFailure(f'unknown group operator: {acc}', 15952)
+        return list(groups.values())
+
+    def _lookup(self, docs: List[Dict], arg: Dict) -> List[Dict]:
+        if 'let' in arg:
+            raise pymongo.errors.OperationFailure('$lookup with let is not supported', 2)
+        foreign = self[arg['from']]
+        index = foreign._join_index(arg['foreignField']) if 'localField' in arg else None
+        if index is not None:
+            for doc in docs:
+                local = MemoryMatcher._expand(_get_values(doc, arg['localField'])) or [None]
+                joined = [_copy(_) for _ in foreign._fetch(index, local)]
+                if arg.get('pipeline'):
+                    joined = self._aggregate(joined, arg['pipeline'])
+                _set_path(doc, arg['as'], joined)
+            return docs
+
+        foreign_docs = [_copy(_) for _ in foreign._matching({})]
+        by_key: Dict[Any, List[Dict]] = {}
+        if 'localField' in arg:
+            for foreign_doc in foreign_docs:
+                values = MemoryMatcher._expand(_get_values(foreign_doc, arg['foreignField'])) or [None]
+                for val in values:
+                    by_key.setdefault(_hash_key(val), []).append(foreign_doc)
+        for doc in docs:
+            if 'localField' in arg:
+                local = MemoryMatcher._expand(_get_values(doc, arg['localField'])) or [None]
+                matched = {}
+                for val in local:
+                    for foreign_doc in by_key.get(_hash_key(val), ()):
+                        matched[id(foreign_doc)] = foreign_doc
+                joined = [_copy(_) for _ in sorted(matched.values(), key=foreign_docs.index)]
+            else:
+                joined = [_copy(_) for _ in foreign_docs]
+            if arg.get('pipeline'):
+                joined = self._aggregate(joined, arg['pipeline'])
+            _set_path(doc, arg['as'], joined)
+        return docs
+
+
+class MemorySession:
+    """Session of the in-memory backend, transactions are not isolated"""
+
+    def __init__(self, client: 'MemoryClient', **options) -> None:
+        self.client = client
+        self.options = options
+        self.has_ended = False
+
+    @contextmanager
+    def start_transaction(self, **_):
+        yield self
+
+    def with_transaction(self, callback: Callable, **_):
+        return callback(self)
+
+    def end_session(self) -> None:
+        self.has_ended = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.end_session()
+
+
+class MemoryClient:
+    """Client of the in-memory backend, for connection strings like `memory://<database>`.
+    Each client has its own databases."""
+
+    def __init__(self, host: str = 'memory://', **_) -> None:
+        self.host = host
+        self._databases: Dict[str, MemoryDatabase] = {}
+        self._lock = threading.Lock()
+        self._matcher = MemoryMatcher()
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = MemoryDatabase(self, name)
+            return self._databases[name]
+
+    def __getattr__(self, name: str) -> MemoryDatabase:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_database(self, name: str, **_) -> MemoryDatabase:
+        return self[name]
+
+    def list_database_names(self, session=None) -> List[str]:
+        return sorted(name for name, db in self._databases.items() if db.list_collection_names())
+
+    def drop_database(self, name_or_database, session=None) -> None:
+        name = getattr(name_or_database, 'name', name_or_database)
+        with self._lock:
+            database = self._databases.get(name)
+        if database is not None:
+            for collection in list(database._collections):
+                database.drop_collection(collection)
+
+    def start_session(self, **options) -> MemorySession:
+        return MemorySession(self, **options)
+
+    def close(self) -> None:
+        self._databases.clear()
@@ -0,0 +1,292 @@
+"""Parallel scan and background reading of result sets"""
+
+import datetime
+import itertools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from bson import ObjectId
+
+from .mongobase import MongoOperand
+
+
+_DONE = object()
+
+
+def _put(target: queue.Queue, item, stop: threading.Event) -> bool:
+    """Put the item into the bounded queue, unless stopped while waiting
+
+    Returns:
+        bool: Whether the item is put
+    """
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def read_ahead(iterable: Iterable, depth=2, batch_size=100) -> Iterator:
+    """Iterate over the iterable in a background thread, keeping up to `depth` batches
+    buffered while the consumer works on the current one. The thread is stopped and
+    joined when the consumer finishes, stops early or raises
+
+    Args:
+        iterable (Iterable): Iterable, e.g. a cursor
+        depth (int, optional): Number of batches buffered. Defaults to 2.
+        batch_size (int, optional): Number of items in each batch. Defaults to 100.
+    """
+    batches = queue.Queue(depth)
+    stop = threading.Event()
+
+    def _produce():
+        try:
+            iterator = iter(iterable)
+            while not stop.is_set():
+                batch = list(itertools.islice(iterator, batch_size))
+                if not batch:
+                    break
+                if not _put(batches, batch, stop):
+                    return
+            _put(batches, _DONE, stop)
+        except BaseException as ex:
+            _put(batches, ex, stop)
+
+    thread = threading.Thread(target=_produce, name='read_ahead', daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is _DONE:
+                return
+            if isinstance(batch, BaseException):
+                raise batch
+            yield from batch
+    finally:
+        stop.set()
+        thread.join()
+
+
+class ScanPartition:
+    """A range of `_id`, scanned by one cursor in ascending order of `_id`"""
+
+    def __init__(self, index: int, lower=None, upper=None, last_id=None,
+                 processed=0, done=False) -> None:
+        """
+        Args:
+            index (int): Index of the partition
+            lower (Any, optional): Inclusive lower bound of `_id`, None for unbounded
+            upper (Any, optional): Exclusive upper bound of `_id`, None for unbounded
+            last_id (Any, optional): Last `_id` processed, to resume from
+            processed (int, optional): Number of results processed
+            done (bool, optional): All results in the partition are processed
+        """
+        self.index = index
+        self.lower = lower
+        self.upper = upper
+        self.last_id = last_id
+        self.processed = processed
+        self.done = done
+
+    def condition(self) -> Dict:
+        """Condition for results not processed yet in the partition"""
+        cond = {}
+        if self.last_id is not None:
+            cond['$gt'] = self.last_id
+        elif self.lower is not None:
+            cond['$gte'] = self.lower
+        if self.upper is not None:
+            cond['$lt'] = self.upper
+        return {'_id': cond} if cond else {}
+
+    def advance(self, obj) -> None:
+        """Record the object as processed"""
+        self.last_id = obj.id
+        self.processed += 1
+
+    def as_dict(self) -> Dict:
+        """Export the state of the partition, as a checkpoint"""
+        return {
+            'lower': self.lower,
+            'upper': self.upper,
+            'last_id': self.last_id,
+            'processed': self.processed,
+            'done': self.done
+        }
+
+    def __repr__(self) -> str:
+        return f'ScanPartition({self.index}, {self.lower}, {self.upper}, processed={self.processed}, done={self.done})'
+
+
+class ParallelScan:
+    """Scan a result set with several cursors in parallel, one for each `_id` range.
+    Results are processed at least once: on resuming from a checkpoint, results handed out
+    but not yet finished when the checkpoint was taken are scanned again."""
+
+    def __init__(self, result_set, n: int, method='sample',
+                 resume: Optional[List[Dict]] = None, queue_size=1000) -> None:
+        """
+        Args:
+            result_set (MongoResultSet): Result set to scan, without sorting, skip or limit
+            n (int): Number of partitions, also the number of threads
+            method (str, optional): How partitions are found, `sample` to split at quantiles
+                of sampled `_id`s, or `time` to split the time range of ObjectIds evenly.
+                Defaults to 'sample'.
+            resume (List[Dict], optional): Checkpoint to resume from, see `checkpoint`
+            queue_size (int, optional): Results buffered when merging. Defaults to 1000.
+        """
+        assert result_set._skip is None and result_set._limit is None, \
+            'Cannot scan with skip or limit in parallel'
+        assert method in ('sample', 'time'), 'method must be `sample` or `time`'
+        self.result_set = result_set
+        self.workers = n
+        self.method = method
+        self.queue_size = queue_size
+        self._partitions = None
+        if resume is not None:
+            self._partitions = [ScanPartition(i, **state) for i, state in enumerate(resume)]
+
+    @property
+    def partitions(self) -> List[ScanPartition]:
+        """Partitions of the scan, found on first access"""
+        if self._partitions is None:
+            bounds = self._time_bounds() if self.method == 'time' else self._sample_bounds()
+            bounds = [None] + bounds + [None]
+            self._partitions = [
+                ScanPartition(i, lower, upper)
+                for i, (lower, upper) in enumerate(zip(bounds[:-1], bounds[1:]))
+            ]
+        return self._partitions
+
+    def _match_stage(self) -> List[Dict]:
+        cond = self.result_set.mongo_cond()
+        if not cond or self.result_set._filtered_reference_fields():
+            # conditions on referenced documents cannot be matched on the raw collection
+            return []
+        return [{'$match': cond}]
+
+    def _sample_bounds(self) -> List:
+        """Split at quantiles of sampled `_id`s"""
+        if self.workers < 2:
+            return []
+        pipeline = self._match_stage() + [
+            {'$sample': {'size': self.workers * 20}},
+            {'$project': {'_id': 1}}
+        ]
+        ids = sorted({doc['_id'] for doc in self.result_set.ele_cls.db.aggregate(pipeline)})
+        if len(ids) < self.workers:
+            return ids[1:]
+        step = len(ids) / self.workers
+        return sorted({ids[int(step * i)] for i in range(1, self.workers)})
+
+    def _time_bounds(self) -> List:
+        """Split the time range of ObjectIds evenly"""
+        if self.workers < 2:
+            return []
+        db = self.result_set.ele_cls.db
+        cond = self._match_stage()
+        cond = cond[0]['$match'] if cond else {}
+        first = db.find_one(cond, {'_id': 1}, sort=[('_id', 1)])
+        last = db.find_one(cond, {'_id': 1}, sort=[('_id', -1)])
+        if first is None or not isinstance(first['_id'], ObjectId) \
+                or not isinstance(last['_id'], ObjectId):
+            return self._sample_bounds()
+        start = first['_id'].generation_time
+        step = (last['_id'].generation_time - start) / self.workers
+        if step < datetime.timedelta(seconds=1):
+            return []
+        return [ObjectId.from_datetime(start + step * i) for i in range(1, self.workers)]
+
+    def _partition_result_set(self, partition: ScanPartition):
+        cond = self.result_set.mongo_cond()
+        range_cond = partition.condition()
+        if cond and range_cond:
+            cond = {'$and': [cond, range_cond]}
+        else:
+            cond = cond or range_cond
+        return self.result_set._derive(mongo_cond=MongoOperand(cond), sort=[('_id', 1)],
+                                       cached=False)
+
+    def _iterate(self, partition: ScanPartition) -> Iterator:
+        """Iterate over the partition, recording progress when each result is
+        handed back, i.e. processed"""
+        with self._partition_result_set(partition) as result_set:
+            for obj in result_set:
+                yield obj
+                partition.advance(obj)
+        partition.done = True
+
+    def __iter__(self) -> Iterator:
+        """Iterate over results of all partitions, in no particular order"""
+        results = queue.Queue(self.queue_size)
+        stop = threading.Event()
+
+        def _scan(partition):
+            try:
+                with self._partition_result_set(partition) as result_set:
+                    for obj in result_set:
+                        if not _put(results, (partition, obj), stop):
+                            return
+                _put(results, (partition, _DONE), stop)
+            except BaseException as ex:
+                _put(results, (partition, ex), stop)
+
+        pending = [_ for _ in self.partitions if not _.done]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for partition in pending:
+                pool.submit(_scan, partition)
+            try:
+                remaining = len(pending)
+                while remaining:
+                    partition, item = results.get()
+                    if item is _DONE:
+                        partition.done = True
+                        remaining -= 1
+                    elif isinstance(item, BaseException):
+                        raise item
+                    else:
+                        yield item
+                        partition.advance(item)
+            finally:
+                stop.set()
+
+    def run(self, worker: Callable[[ScanPartition, Iterator], Any]) -> List:
+        """Hand each partition to the worker in a thread pool
+
+        Args:
+            worker (Callable[[ScanPartition, Iterator], Any]): Function accepting the partition
+                and an iterator over its results
+
+        Raises:
+            Exception: The first exception raised by the workers, after all workers finish
+
+        Returns:
+            List: Values returned by the worker, for each partition not done before
+        """
+        pending = [_ for _ in self.partitions if not _.done]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(lambda p: worker(p, self._iterate(p)), partition)
+                       for partition in pending]
+        return [_.result() for _ in futures]
+
+    @property
+    def progress(self) -> Dict[str, int]:
+        """Numbers of processed results, finished partitions, and all partitions"""
+        partitions = self.partitions
+        return {
+            'processed': sum(_.processed for _ in partitions),
+            'done': sum(1 for _ in partitions if _.done),
+            'partitions': len(partitions)
+        }
+
+    def checkpoint(self) -> List[Dict]:
+        """Export the states of partitions, to be passed as `resume` later
+
+        Returns:
+            List[Dict]: States of partitions, with only BSON types
+        """
+        return [_.as_dict() for _ in self.partitions]
@@ -0,0 +1,238 @@
+"""In-memory replicas of small collections"""
+
+import datetime
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+import bson
+from bson import ObjectId
+
+from .mongomemory import MemoryMatcher, _hash_key, _sort_key
+
+# operators matched locally, other conditions are sent to the server
+LOCAL_OPERATORS = ('$eq', '$gt', '$gte', '$lt', '$lte', '$in')
+
+_SCALARS = (str, int, float, bool, ObjectId, datetime.datetime)
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _is_scalar(val) -> bool:
+    return isinstance(val, _SCALARS)
+
+
+def localize(cond: Dict) -> Optional[Dict]:
+    """Rewrite the condition for matching with `ReplicaMatcher`, into one operator per clause
+
+    Args:
+        cond (Dict): MongoDB query condition
+
+    Returns:
+        Optional[Dict]: Condition for local matching, None if not supported
+    """
+    try:
+        return _localize(cond)
+    except _Unsupported:
+        return None
+
+
+def _localize(cond: Dict) -> Dict:
+    clauses = []
+    for key, val in cond.items():
+        if key in ('$and', '$or'):
+            if not isinstance(val, list) or not val:
+                raise _Unsupported()
+            clauses.append({key: [_localize(_) for _ in val]})
+        elif key.startswith('$') or '.' in key:
+            # dotted keys may traverse arrays of embedded documents
+            raise _Unsupported()
+        elif isinstance(val, dict):
+            if not val:
+                raise _Unsupported()
+            for op, operand in val.items():
+                if op not in LOCAL_OPERATORS:
+                    raise _Unsupported()
+                if op == '$in':
+                    if not isinstance(operand, (list, tuple)) or \
+                            not all(_ is None or _is_scalar(_) for _ in operand):
+                        raise _Unsupported()
+                    clauses.append({key: {'$in': list(operand)}})
+                elif op == '$eq':
+                    if operand is not None and not _is_scalar(operand):
+                        raise _Unsupported()
+                    clauses.append({key: operand})
+                elif _is_scalar(operand):
+                    clauses.append({key: {op: operand}})
+                else:
+                    raise _Unsupported()
+        elif val is None or _is_scalar(val):
+            clauses.append({key: val})
+        else:
+            raise _Unsupported()
+    return clauses[0] if len(clauses) == 1 else {'$and': clauses}
+
+
+class ReplicaMatcher(MemoryMatcher):
+    """Query matcher comparing values in the BSON order like MongoDB, for conditions
+    rewritten by `localize`, so that queries served locally give the same results"""
+
+
+class _Snapshot:
+    """Documents of the collection, indexed by `_id` and secondary keys"""
+
+    def __init__(self, docs: List[Dict], keys: Iterable[str]) -> None:
+        self.docs = docs
+        self.raw = [bson.encode(doc) for doc in docs]
+        self.indexes: Dict[str, Dict[Any, List[int]]] = {}
+        for key in ('_id',) + tuple(keys):
+            index = {}
+            for i, doc in enumerate(docs):
+                val = doc.get(key)
+                for item in (val if isinstance(val, list) else [val]):
+                    # keyed like MongoDB compares, e.g. True and 1 differ
+                    index.setdefault(_hash_key(item), []).append(i)
+            self.indexes[key] = index
+
+    def candidates(self, cond: Dict) -> Iterable[int]:
+        """Positions of documents possibly matching the localized condition,
+        narrowed with an index if the condition has an equality or `$in` clause on an indexed key"""
+        for clause in cond['$and'] if '$and' in cond else [cond]:
+            if len(clause) != 1:
+                continue
+            (key, val), = clause.items()
+            if key not in self.indexes or val is None:
+                continue
+            values = val['$in'] if isinstance(val, dict) and '$in' in val else \
+                [val] if not isinstance(val, dict) else None
+            if values is None or None in values:
+                continue
+            index = self.indexes[key]
+            positions = set()
+            for item in values:
+                positions.update(index.get(_hash_key(item), ()))
+            return sorted(positions)
+        return range(len(self.docs))
+
+
+class Replica:
+    """A whole collection kept in memory, to run queries locally without round trips
+    to the server. The collection is reloaded in the background periodically, and
+    on the next query after writes through objects and result sets bound to the same
+    connection."""
+
+    def __init__(self, ele_cls, keys: Iterable[str] = (), refresh_interval: float = 60.0) -> None:
+        """
+        Args:
+            ele_cls (type): DbObject class of the collection
+            keys (Iterable[str], optional): Secondary keys to index, besides `_id`
+            refresh_interval (float, optional): Seconds between reloads in the background,
+                0 or None to reload only after local writes. Defaults to 60.0.
+        """
+        self.ele_cls = ele_cls
+        self.keys = tuple(keys)
+        self.refresh_interval = refresh_interval
+        self.local_queries = 0
+        self.fallbacks = 0
+        self._matcher = ReplicaMatcher()
+        self._snapshot: Optional[_Snapshot] = None
+        self._stale = False
+        self._load_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def load(self) -> None:
+        """Load the whole collection, replacing the snapshot in use once loaded"""
+        with self._load_lock:
+            self._load()
+
+    def _load(self) -> None:
+        # writes from now on mark the snapshot being loaded stale again
+        self._stale = False
+        try:
+            self._snapshot = _Snapshot(list(self.ele_cls.db.find({})), self.keys)
+        except Exception:
+            self._stale = True
+            raise
+
+    def invalidate(self) -> None:
+        """Mark the snapshot stale after writes, so that it is reloaded once on the next query
+        instead of on every write"""
+        self._stale = True
+
+    def _current(self) -> Optional[_Snapshot]:
+        """Snapshot in use, reloaded first if stale"""
+        if self._stale:
+            with self._load_lock:
+                if self._stale:
+                    self._load()
+        return self._snapshot
+
+    def _match(self, result_set, snapshot: Optional[_Snapshot],
+               ordered=True) -> Optional[List[int]]:
+        """Positions of matched documents, sorted if ordered, None if not supported locally"""
+        if snapshot is None or result_set._projection or self.ele_cls.extended_fields:
+            return None
+        cond = localize(result_set.mongo_cond() or {})
+        if cond is None:
+            return None
+        prepared = self._matcher.prepare(cond)
+        positions = [i for i in snapshot.candidates(cond)
+                     if self._matcher.match(prepared, snapshot.docs[i])]
+
+        for key, direction in reversed((ordered and result_set._sort) or []):
+            if key == 'random':
+                return None
+            positions.sort(key=lambda i: _sort_key(snapshot.docs[i], key, direction),
+                           reverse=direction < 0)
+        return positions
+
+    def find(self, result_set) -> Optional[List[Dict]]:
+        """Raw results of the result set, decoded afresh from the snapshot
+
+        Returns:
+            Optional[List[Dict]]: Results, None if the query is not supported locally
+        """
+        snapshot = self._current()
+        positions = self._match(result_set, snapshot)
+        if positions is None:
+            self.fallbacks += 1
+            return None
+        self.local_queries += 1
+        start = result_set._skip or 0
+        end = start + result_set._limit if result_set._limit else None
+        return [bson.decode(snapshot.raw[i]) for i in positions[start:end]]
+
+    def count(self, result_set) -> Optional[int]:
+        """Count results of the result set regardless of skip and limit, None if the
+        query is not supported locally"""
+        positions = self._match(result_set, self._current(), ordered=False)
+        if positions is None:
+            self.fallbacks += 1
+            return None
+        self.local_queries += 1
+        return len(positions)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.load()
+            except Exception:
+                # keep serving the previous snapshot
+                pass
+
+    def start(self) -> 'Replica':
+        """Start reloading in the background"""
+        if self.refresh_interval and (self._thread is None or not self._thread.is_alive()):
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='replica', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop reloading in the background"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
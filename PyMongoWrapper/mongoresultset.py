@@ -1,11 +1,21 @@
 """Result set"""
 
-from typing import Union
+import asyncio
+import base64
+import copy
+import itertools
+import json
+from typing import Iterator, List, Optional, Tuple, Union
+import bson
+from bson import ObjectId
 from bson.son import SON
-import pymongo.cursor
 from .mongobase import MongoOperand
 from .mongofield import MongoField
 from .mongoaggregator import MongoAggregator
+from .mongocache import fingerprint, normalize_cond
+from .mongoexplain import explain
+from .mongoparallel import ParallelScan, read_ahead
+from . import converters
 
 
 class MongoResultSet:
@@ -30,24 +40,38 @@ class MongoResultSet:
         self._sort = sort
         self._limit = limit
         self._skip = skip
+        self._prefetch = ()
+        self._prefetch_size = 100
+        self._join = None
+        self._projection = None
+        self._session = None
+        self._cursor_options = {}
+        self._cursors = []
+        self._read_ahead = None
+        self._cached = None
+        self._cache_ttl = None
 
-    def build_raw_rs(self):
-        """Build up raw pymongo cursor
+    def _derive(self, **attrs):
+        """Copy the current result set, overriding given attributes
+
+        Args:
+            attrs (dict): Attributes to override, `mongo_cond` or names without the leading underscore
         """
+        derived = copy.copy(self)
+        derived._cursors = []
+        for key, val in attrs.items():
+            setattr(derived, key if key == 'mongo_cond' else '_' + key, val)
+        return derived
 
-        def _examine_fields(cond, prefix='', targets=None):
-            """Examine whether query condition refers to external collections
+    def _filtered_reference_fields(self):
+        """Examine whether query condition refers to external collections
 
-            Args:
-                cond (dict): MongoDB query
-                prefix (str, optional): prefix
-                targets (list, optional): targets
+        Returns:
+            Iterable[str]: Fields that refers to external collection
+        """
+        targets = set(self.ele_cls.extended_fields.keys())
 
-            Returns:
-                Iterable[str]: Fields that refers to external collection
-            """
-            targets = set(self.ele_cls.extended_fields.keys()
-                          ) if not targets else targets
+        def _examine_fields(cond, prefix=''):
             ext_fields = []
             if not isinstance(cond, dict):
                 return []
@@ -66,62 +90,431 @@ class MongoResultSet:
                     ext_fields.append(key)
             return set(ext_fields)
 
-        client = self.ele_cls.db.database.client
-        with client.start_session() as session:
-            result_set = self.ele_cls.db.find(
-                self.mongo_cond(), session=session)
-
-            ext_fields = self.ele_cls.extended_fields
-            if ext_fields:
-                # extended query
-                ext_before = list(_examine_fields(self.mongo_cond()))
-                ext_after = [_ for _ in ext_fields if _ not in ext_before]
-                aggregation = self.ele_cls.aggregator
-                for field in ext_before:
-                    aggregation.lookup(
-                        from_=ext_fields[field].db.name, localField=field, foreignField='_id', as_=field)
-                if self.mongo_cond():
-                    aggregation.match(self.mongo_cond())
-                for field in ext_after:
-                    aggregation.lookup(
-                        from_=ext_fields[field].db.name, localField=field, foreignField='_id', as_=field)
-
-                aggregation.raw(True)
-                aggregation.session(session)
-                result_set = aggregation
+        if not targets:
+            return []
+        return list(_examine_fields(self.mongo_cond()))
 
-            if self._sort is not None:
-                if self._sort == [('random', 1)]:
-                    if not isinstance(result_set, MongoAggregator):
-                        result_set = self.ele_cls.aggregator.match(
-                            self.mongo_cond())
-                    result_set.sample(size=self._limit)
-                    self._limit = None
-                else:
-                    if isinstance(result_set, pymongo.cursor.Cursor):
-                        result_set.sort(self._sort)
-                    else:
-                        result_set.sort(SON(self._sort))
+    def _client_joined_fields(self):
+        """Reference fields to be resolved client-side in batches
+
+        Returns:
+            List[str]: Field names
+        """
+        fields = list(self._prefetch)
+        if (self._join or self.ele_cls._join_strategy) == 'client':
+            filtered = self._filtered_reference_fields()
+            lazy = self._lazy_fields()
+            fields += [_ for _ in self.ele_cls.extended_fields
+                       if _ not in filtered and _ not in fields and _ not in lazy]
+        return [_ for _ in fields if self._is_projected(_)]
+
+    def _lazy_fields(self):
+        """Reference fields of lazy collections, left as ids to be loaded on access,
+        unless prefetched or their sub-fields are projected
+
+        Returns:
+            List[str]: Field names
+        """
+        fields = self.ele_cls.fields
+        return [_ for _ in self.ele_cls.extended_fields
+                if getattr(fields[_], 'lazy', False) and _ not in self._prefetch
+                and not self._sub_projection(_)]
+
+    def _is_projected(self, field):
+        """Check whether a top-level field is included by the projection
+
+        Args:
+            field (str): Field name
+        """
+        if not self._projection or field == '_id':
+            return True
+        if any(self._projection.values()):
+            return any(_ == field or _.startswith(field + '.') for _ in self._projection)
+        return field not in self._projection
+
+    def _sub_projection(self, field):
+        """Get projection for documents referred by the field
+
+        Args:
+            field (str): Reference field name
+
+        Returns:
+            Optional[dict]: Projection, None if documents are to be fully loaded
+        """
+        if not self._projection:
+            return None
+        prefix = field + '.'
+        return {
+            k[len(prefix):]: v for k, v in self._projection.items() if k.startswith(prefix)
+        } or None
+
+    def _main_projection(self):
+        """Get projection for the main query, where reference fields are kept whole,
+        i.e. as ids for client joins, or as documents projected in `$lookup`
+        """
+        if not self._projection:
+            return None
+        ext_fields = self.ele_cls.extended_fields
+        projection = {}
+        for key, val in self._projection.items():
+            field = key.split('.')[0]
+            if field in ext_fields and field != key:
+                if not val:
+                    continue
+                key = field
+            projection[key] = val
+        return projection or None
+
+    def _get_session(self):
+        """Session explicitly set, or bound to the current thread by `MongoConnection.session`.
+        None for implicit sessions"""
+        return self._session or getattr(self.ele_cls._binding, 'current_session', None)
+
+    def _replica(self):
+        """Replica of the collection for matching locally, None if not replicated"""
+        replica = self.ele_cls._own_replica()
+        if replica is None or self._get_session() is not None:
+            return None
+        return replica
+
+    def _query_cache(self):
+        """Query cache of the connection, None if results are not to be cached"""
+        cached = self.ele_cls._cached if self._cached is None else self._cached
+        if not cached or self._sort == [('random', 1)] or self._get_session() is not None:
+            return None
+        return getattr(self.ele_cls._binding, 'query_cache', None)
+
+    def _cache_collections(self):
+        """Names of collections results are read from"""
+        names = {self.ele_cls.db.name}
+        names.update(_.db.name for _ in self.ele_cls.extended_fields.values())
+        return sorted(names)
+
+    def _cache_key(self, kind):
+        """Key of cached values, distinguishing results of different raw shapes, i.e.
+        reference fields joined with `$lookup` or left as ids to be resolved client-side"""
+        cond = normalize_cond(self.mongo_cond())
+        if kind == 'count':
+            return fingerprint(kind, self.ele_cls.db.name, cond)
+        projection = SON(sorted(self._projection.items())) if self._projection else None
+        return fingerprint(kind, self.ele_cls.db.name,
+                           f'{self.ele_cls.__module__}.{self.ele_cls.__qualname__}',
+                           self._join or self.ele_cls._join_strategy, sorted(self._prefetch),
+                           sorted(self._client_joined_fields()),
+                           cond, self._sort, self._skip, self._limit, projection)
+
+    def _through_cache(self, kind, fetch):
+        """Get the value from the query cache, or fetch and cache it if caching is enabled
+
+        Args:
+            kind (str): Kind of the value, `find` or `count`
+            fetch (Callable): Function returning the value, and `_id`s of documents
+                in the value by collection, None if not applicable
+        """
+        cache = self._query_cache()
+        if cache is None:
+            return fetch()[0]
+        key = self._cache_key(kind)
+        value = cache.get(key)
+        if value is None:
+            collections = self._cache_collections()
+            version = cache.version(collections)
+            value, ids = fetch()
+            cache.set(key, value, collections, version, self._cache_ttl, ids)
+        return value
+
+    def build_raw_rs(self):
+        """Iterate over raw results, the cursor is closed when the iteration
+        finishes or the iterator is closed. With caching enabled, results are
+        read from the query cache, decoded afresh for each iteration. Results of
+        replicated classes are matched locally when possible
+        """
+        replica = self._replica()
+        if replica is not None:
+            docs = replica.find(self)
+            if docs is not None:
+                yield from docs
+                return
+
+        if self._query_cache() is None:
+            yield from self._iter_cursor()
+            return
+
+        def _fetch():
+            docs = list(self._iter_cursor())
+            return b''.join(bson.encode(doc) for doc in docs), \
+                {self.ele_cls.db.name: [doc.get('_id') for doc in docs]}
+
+        # cached as encoded bytes, each reader gets its own copies to hydrate
+        yield from bson.decode_all(self._through_cache('find', _fetch))
 
+    def _iter_cursor(self):
+        cursor = self._open_cursor()
+        self._cursors.append(cursor)
+        try:
+            if self._read_ahead:
+                yield from read_ahead(cursor, *self._read_ahead)
+            else:
+                yield from cursor
+        finally:
+            cursor.close()
+            if cursor in self._cursors:
+                self._cursors.remove(cursor)
+
+    def _build_query(self):
+        """Build up the query sent to the server, i.e. arguments of `find`, or an aggregator
+        for extended queries and random sampling
+        """
+
+        def _lookup(aggregation, field, projected=False):
+            lookup = {
+                'from_': ext_fields[field].db.name,
+                'localField': field,
+                'foreignField': '_id',
+                'as_': field
+            }
+            sub_projection = self._sub_projection(field) if projected else None
+            if sub_projection:
+                lookup['pipeline'] = [{'$project': sub_projection}]
+            aggregation.lookup(**lookup)
+
+        # client-joined fields are resolved by batched queries in __iter__
+        client_joined = self._client_joined_fields()
+        projection = self._main_projection()
+
+        ext_fields = self.ele_cls.extended_fields
+        ext_before = self._filtered_reference_fields()
+        lazy = self._lazy_fields()
+        ext_after = [_ for _ in ext_fields if _ not in ext_before and _ not in client_joined
+                     and _ not in lazy and self._is_projected(_)]
+        aggregation = None
+        if ext_before or ext_after:
+            # extended query
+            aggregation = self.ele_cls.aggregator
+            for field in ext_before:
+                _lookup(aggregation, field)
+            if self.mongo_cond():
+                aggregation.match(self.mongo_cond())
+            for field in ext_after:
+                _lookup(aggregation, field, True)
+
+        limit = self._limit
+        if self._sort == [('random', 1)]:
+            if aggregation is None:
+                aggregation = self.ele_cls.aggregator.match(self.mongo_cond())
+            aggregation.sample(size=limit)
+            limit = None
+
+        if aggregation is None:
+            query = {'filter': self.mongo_cond(), 'projection': projection}
+            if self._sort is not None:
+                query['sort'] = self._sort
             if self._skip is not None:
-                result_set = result_set.skip(self._skip)
-            if self._limit is not None:
-                result_set = result_set.limit(self._limit)
+                query['skip'] = self._skip
+            if limit is not None:
+                query['limit'] = limit
+            return query
 
-            yield from result_set
+        if self._sort is not None and self._sort != [('random', 1)]:
+            aggregation.sort(SON(self._sort))
+        if self._skip is not None:
+            aggregation.skip(self._skip)
+        if limit is not None:
+            aggregation.limit(limit)
+        if projection:
+            aggregation.project(projection)
+        aggregation.raw(True)
+        aggregation.session(self._get_session())
+        aggregation.options(
+            batch_size=self._cursor_options.get('batch_size'),
+            max_time_ms=self._cursor_options.get('max_time_ms'))
+        return aggregation
+
+    def _command(self, query):
+        """The find or aggregate command for the query from `_build_query`"""
+        if isinstance(query, MongoAggregator):
+            return query._command()
+        command = SON([('find', self.ele_cls.db.name), ('filter', query['filter'] or {})])
+        if query['projection']:
+            command['projection'] = query['projection']
+        if 'sort' in query:
+            command['sort'] = SON(query['sort'])
+        for key in ('skip', 'limit'):
+            if query.get(key):
+                command[key] = query[key]
+        if self._cursor_options.get('max_time_ms'):
+            command['maxTimeMS'] = self._cursor_options['max_time_ms']
+        return command
+
+    def _open_cursor(self):
+        """Build up raw pymongo cursor, or command cursor for aggregations. Queries are
+        checked by the scan guard of the connection if any
+        """
+        query = self._build_query()
+        guard = getattr(self.ele_cls._binding, 'scan_guard', None)
+        if guard is not None:
+            guard.inspect(self.ele_cls.db, self._command(query), self._get_session())
+        if isinstance(query, MongoAggregator):
+            return query.cursor()
+        return self.ele_cls.db.find(session=self._get_session(), **query, **self._cursor_options)
+
+    def explain(self, verbosity='executionStats'):
+        """Explain the query sent to the server by `build_raw_rs`, including `$lookup`
+        stages of extended queries. Replicas and the query cache are not consulted.
+
+        Args:
+            verbosity (str, optional): Verbosity, see `mongoexplain.explain`.
+                Defaults to 'executionStats'.
+
+        Returns:
+            Dict: Summarized plan, see `mongoexplain.summarize`
+        """
+        query = self._build_query()
+        return explain(self.ele_cls.db, self._command(query), verbosity, self._get_session())
 
     def __iter__(self):
-        for result in self.build_raw_rs():
-            yield self.ele_cls().fill_dict(result)
+        client_joined = self._client_joined_fields()
+        if not client_joined:
+            for result in self.build_raw_rs():
+                yield self._hydrate(result)
+            return
+
+        results = self.build_raw_rs()
+        while True:
+            chunk = list(itertools.islice(results, self._prefetch_size))
+            if not chunk:
+                break
+            yield from self._resolve_references(chunk, client_joined)
+
+    async def __aiter__(self):
+        """Iterate over results without blocking the event loop. Results are fetched
+        in batches in the thread pool of the connection, the next batch being fetched
+        while the current one is consumed"""
+        run_async = self.ele_cls._binding.run_async
+        batch_size = self._cursor_options.get('batch_size') or self._prefetch_size
+        results = iter(self)
+
+        def _fetch():
+            return list(itertools.islice(results, batch_size))
+
+        pending = asyncio.ensure_future(run_async(_fetch))
+        try:
+            while True:
+                batch = await pending
+                if not batch:
+                    break
+                pending = asyncio.ensure_future(run_async(_fetch))
+                for obj in batch:
+                    yield obj
+        finally:
+            # wait for the batch in progress before closing the cursor
+            await asyncio.gather(pending, return_exceptions=True)
+            await run_async(results.close)
+
+    def _hydrate(self, result, ele_cls=None, projection=None):
+        """Create an object from a raw result
+
+        Args:
+            result (dict): Raw result
+            ele_cls (type, optional): Element class. Defaults to that of the result set.
+            projection (dict, optional): Projection used when fetching the result.
+                Defaults to that of the result set.
+        """
+        main = ele_cls is None
+        if main:
+            ele_cls, projection = self.ele_cls, self._projection
+        obj = ele_cls().fill_dict(result)
+        if projection:
+            obj._projection = projection
+        if main and ele_cls.extended_fields:
+            self._hydrate_joined(obj, result)
+        return obj
+
+    def _hydrate_joined(self, obj, result):
+        """Set documents joined by `$lookup` as objects, partially loaded if projected,
+        keeping their ids as the original values of the reference fields"""
+        json_fields = self.ele_cls.schema.json_fields
+        for field, ref_cls in self.ele_cls.extended_fields.items():
+            docs = result.get(field)
+            if isinstance(docs, dict):
+                docs = [docs]
+            elif not isinstance(docs, list) or not docs or \
+                    not all(isinstance(_, dict) for _ in docs):
+                continue
+            sub_projection = self._sub_projection(field)
+            objs = [self._hydrate(doc, ref_cls, sub_projection) for doc in docs]
+            if json_fields[field][1]:
+                # collection of references
+                obj._orig[field] = [_.id for _ in objs]
+                setattr(obj, field, objs)
+            else:
+                obj._orig[field] = objs[0].id
+                setattr(obj, field, objs[0])
+
+    def _resolve_references(self, chunk, fields):
+        """Hydrate a chunk of raw results, resolving referenced objects in fields
+        with one `$in` query per field
+
+        Args:
+            chunk (list): Raw results
+            fields (Iterable[str]): Reference fields to resolve
+
+        Returns:
+            list: Hydrated objects
+        """
+        objs = [self._hydrate(result) for result in chunk]
+        ext_fields = self.ele_cls.extended_fields
+
+        for field in fields:
+            ids = set()
+            for result in chunk:
+                val = result.get(field)
+                if isinstance(val, ObjectId):
+                    ids.add(val)
+                elif isinstance(val, list):
+                    ids.update(_ for _ in val if isinstance(_, ObjectId))
+            if not ids:
+                continue
+
+            ref_cls = ext_fields[field]
+            sub_projection = self._sub_projection(field)
+            loaded = {
+                doc['_id']: self._hydrate(doc, ref_cls, sub_projection)
+                for doc in ref_cls.db.find({'_id': {'$in': list(ids)}}, sub_projection,
+                                           session=self._get_session())
+            }
+
+            for obj, result in zip(objs, chunk):
+                val = result.get(field)
+                if isinstance(val, ObjectId):
+                    if val in loaded:
+                        setattr(obj, field, loaded[val])
+                elif isinstance(val, list):
+                    setattr(obj, field, [
+                        loaded[_] if isinstance(_, ObjectId) else _
+                        for _ in val if not isinstance(_, ObjectId) or _ in loaded
+                    ])
+
+        return objs
 
     def __len__(self):
         return self.count()
 
-    def first(self):
+    def first(self, *fields):
         """Returns only first result. None if no matched results.
+        Only one document is requested from the server.
+
+        Args:
+            fields (str): Fetch only the given fields, see `only`
         """
-        for r in self:
-            return r
+        result_set = self.only(*fields) if fields else self
+        with result_set.limit(1) as result_set:
+            for r in result_set:
+                return r
+
+    async def afirst(self, *fields):
+        """Returns only first result without blocking the event loop, see `first`"""
+        return await self.ele_cls._binding.run_async(self.first, *fields)
 
     def update(self, updt, **update_kwargs):
         """Perform update on current result set.
@@ -133,13 +526,25 @@ class MongoResultSet:
         updt = MongoOperand(updt)()
         update_kwargs = {MongoOperand.get_repr(
             k): v for k, v in update_kwargs.items()}
-        return self.ele_cls.db.update_many(self.mongo_cond(), updt, **update_kwargs)
+        try:
+            return self.ele_cls.db.update_many(self.mongo_cond(), updt, **update_kwargs)
+        finally:
+            self._written()
 
     def remove(self):
         """Remove all matched results.
         """
         assert self.mongo_cond is not None, 'Must use pure MongoOperand objects'
-        return self.ele_cls.db.delete_many(self.mongo_cond())
+        try:
+            return self.ele_cls.db.delete_many(self.mongo_cond())
+        finally:
+            self._written()
+
+    def _written(self):
+        """Invalidate cached results after writing to the collection"""
+        binding = self.ele_cls._binding
+        if binding is not None:
+            binding.invalidate_cache(self.ele_cls.db.name)
     
     def delete(self):
         """Delete all matched results. Alias for `remove`.
@@ -150,46 +555,337 @@ class MongoResultSet:
         """Sort all matched results
         """
         sorts = MongoField.parse_sort(*sort_args, **sort_kwargs)
-        return MongoResultSet(self.ele_cls, self.mongo_cond, sort=sorts)
+        return self._derive(sort=sorts)
 
     def skip(self, offset):
         """Skip offset
         """
-        return MongoResultSet(self.ele_cls, self.mongo_cond, sort=self._sort, limit=self._limit, skip=offset)
+        return self._derive(skip=offset)
 
     def limit(self, size):
         """Limit result count
         """
-        return MongoResultSet(self.ele_cls, self.mongo_cond, sort=self._sort, limit=size, skip=self._skip)
+        return self._derive(limit=size)
+
+    def _keyset_sort(self):
+        """Sorting keys for pagination, with `_id` as the tiebreaker"""
+        assert self._sort != [('random', 1)], 'Cannot paginate results in random order'
+        sorts = [(key, direction) for key, direction in (self._sort or [])]
+        for key, _ in sorts:
+            # values of reference fields are replaced when joined, and not kept as sorted
+            assert key.split('.')[0] not in self.ele_cls.extended_fields, \
+                f'Cannot paginate by reference field `{key}`'
+        if not any(key == '_id' for key, _ in sorts):
+            sorts.append(('_id', 1))
+        return sorts
+
+    @staticmethod
+    def _keyset_predicate(sorts, values):
+        """Condition for results after the given values of sorting keys"""
+        clauses = []
+        for i, (key, direction) in enumerate(sorts):
+            clause = {prev: val for (prev, _), val in zip(sorts[:i], values)}
+            if values[i] is None:
+                if direction < 0:
+                    # nothing is sorted after null in descending order
+                    continue
+                clause[key] = {'$ne': None}
+            else:
+                clause[key] = {'$gt' if direction > 0 else '$lt': values[i]}
+                if direction < 0 and key != '_id':
+                    # nulls are sorted last in descending order, but never compared
+                    clauses.append(dict(clause, **{key: None}))
+            clauses.append(clause)
+        return {'$or': clauses} if clauses else {'_id': {'$in': []}}
+
+    @staticmethod
+    def _sort_value(obj, key):
+        """Value of the sorting key in the raw document of the object"""
+        val = obj._orig
+        for part in key.split('.'):
+            if not isinstance(val, dict):
+                return None
+            val = val.get(part)
+        if key == '_id' and val is None:
+            val = obj.id
+        return val
+
+    def paginate(self, page_size: int, after: Optional[str] = None) -> Tuple[List, Optional[str]]:
+        """Fetch a page of results by seeking past the last result of the previous page,
+        instead of skipping. Each page costs O(page_size) with an index on the sorting keys
+        (and `_id`, which is used as the tiebreaker).
+
+        Args:
+            page_size (int): Number of results in a page
+            after (str, optional): Continuation token returned with the previous page.
+                Defaults to None, i.e. the first page.
+
+        Returns:
+            Tuple[List, Optional[str]]: Results, and the continuation token for the next page,
+                None if this is the last page
+        """
+        sorts = self._keyset_sort()
+        keys = [list(_) for _ in sorts]
+        cond = self.mongo_cond()
+
+        if after:
+            try:
+                token = bson.decode(base64.urlsafe_b64decode(after))
+            except Exception as ex:
+                raise ValueError('Invalid continuation token') from ex
+            if token.get('k') != keys:
+                raise ValueError('Continuation token does not match the sorting')
+            predicate = self._keyset_predicate(sorts, token['v'])
+            cond = {'$and': [cond, predicate]} if cond else predicate
+
+        result_set = self._derive(mongo_cond=MongoOperand(cond), sort=sorts,
+                                  skip=None, limit=page_size + 1)
+        projection = result_set._projection
+        if projection and any(projection.values()):
+            result_set = result_set.only(*[key for key, _ in sorts])
+        elif projection:
+            # sorting keys are read from results, keep them from being excluded
+            projection = {field: flag for field, flag in projection.items()
+                          if not any(field == key or field.startswith(key + '.') or
+                                     key.startswith(field + '.') for key, _ in sorts)}
+            result_set = result_set._derive(projection=projection or None)
+
+        results = [_ for _ in result_set]
+        if len(results) <= page_size:
+            return results, None
+
+        results = results[:page_size]
+        values = [self._sort_value(results[-1], key) for key, _ in sorts]
+        token = base64.urlsafe_b64encode(bson.encode({'k': keys, 'v': values})).decode('ascii')
+        return results, token
+
+    def parallel(self, n, method='sample', resume=None) -> ParallelScan:
+        """Scan results with n cursors in parallel threads, each over a range of `_id`.
+        Iterate over the returned scan to get results in no particular order, or hand
+        partitions to a worker with `run`
+
+        Args:
+            n (int): Number of partitions and threads
+            method (str, optional): `sample` or `time`, see `ParallelScan`. Defaults to 'sample'.
+            resume (List[Dict], optional): Checkpoint from `ParallelScan.checkpoint`
+        """
+        return ParallelScan(self, n, method, resume)
+
+    def prefetch(self, *fields, chunk_size=100):
+        """Resolve referenced objects in batches instead of one query per reference.
+        Results are read in chunks, and for each field one `{'_id': {'$in': [...]}}`
+        query is issued per chunk.
+
+        Args:
+            fields (str): Reference fields to prefetch
+            chunk_size (int, optional): Number of results per chunk. Defaults to 100.
+        """
+        ext_fields = self.ele_cls.extended_fields
+        for field in fields:
+            assert field in ext_fields, f'`{field}` is not a reference field of {self.ele_cls.__name__}'
+        return self._derive(prefetch=tuple(fields), prefetch_size=chunk_size)
+
+    def join(self, strategy):
+        """Select how reference fields are joined
+
+        Args:
+            strategy (str): `lookup` to join every reference field with `$lookup` on the server,
+                `client` to keep `find` for the main query and resolve references with batched
+                `$in` queries, using `$lookup` only for fields the condition refers to.
+                Defaults to the `_join_strategy` of the element class.
+        """
+        assert strategy in ('lookup', 'client'), 'strategy must be `lookup` or `client`'
+        return self._derive(join=strategy)
+
+    def session(self, session):
+        """Run queries in the session, instead of the one bound by
+        `MongoConnection.session` or an implicit session
+
+        Args:
+            session (pymongo.client_session.ClientSession): Session
+        """
+        return self._derive(session=session)
+
+    def _set_cursor_option(self, key, val):
+        options = dict(self._cursor_options)
+        if val is None:
+            options.pop(key, None)
+        else:
+            options[key] = val
+        return self._derive(cursor_options=options)
+
+    def batch_size(self, size):
+        """Set number of documents returned in each batch from the server
+
+        Args:
+            size (int): Batch size, None to use the server default
+        """
+        return self._set_cursor_option('batch_size', size)
+
+    def max_time_ms(self, ms):
+        """Set time limit for processing the query on the server
+
+        Args:
+            ms (int): Time limit in milliseconds, None for no limit
+        """
+        return self._set_cursor_option('max_time_ms', ms)
+
+    def no_cursor_timeout(self, flag=True):
+        """Prevent the server from closing idle cursors, make sure to close the result set
+        (or fully iterate over it) when using this. Not applicable to aggregations
+
+        Args:
+            flag (bool, optional): Defaults to True.
+        """
+        return self._set_cursor_option('no_cursor_timeout', flag or None)
+
+    def read_ahead(self, depth=2, batch_size=100):
+        """Fetch results on a background thread while iterating, keeping up to `depth`
+        batches buffered, so that processing results does not wait for round trips to
+        the server. The cursor is read in the background thread, along with the session
+        it is opened with
+
+        Args:
+            depth (int, optional): Number of batches buffered. Defaults to 2.
+            batch_size (int, optional): Number of results in each batch, also used as
+                the batch size of the cursor. Defaults to 100.
+        """
+        return self._derive(read_ahead=(depth, batch_size)).batch_size(batch_size)
+
+    def cached(self, flag=True, ttl=None):
+        """Read results and counts through the query cache of the connection, regardless
+        of the `_cached` setting of the element class. Queries in sessions are never cached
+
+        Args:
+            flag (bool, optional): Whether to cache. Defaults to True.
+            ttl (float, optional): Seconds before cached results expire.
+                Defaults to None, using `ttl` of the cache.
+        """
+        return self._derive(cached=flag, cache_ttl=ttl)
+
+    def close(self):
+        """Close cursors opened and not yet exhausted by iterating over the result set"""
+        for cursor in list(self._cursors):
+            cursor.close()
+        self._cursors.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _project(self, fields, flag):
+        projection = dict(self._projection or {})
+        assert not projection or bool(any(projection.values())) == bool(flag), \
+            'Cannot mix inclusion and exclusion in projection'
+        projection.update({MongoOperand.get_repr(field): flag for field in fields})
+        return self._derive(projection=projection)
+
+    def only(self, *fields):
+        """Fetch only the given fields. Objects will be partially loaded, other fields
+        are loaded lazily on access, and are not written back when saving.
+
+        Args:
+            fields (str): Field names, `<reference field>.<field>` to project referenced documents
+        """
+        return self._project(fields, 1)
+
+    def exclude(self, *fields):
+        """Fetch all fields except the given ones. Objects will be partially loaded,
+        excluded fields are loaded lazily on access, and are not written back when saving.
+
+        Args:
+            fields (str): Field names, `<reference field>.<field>` to project referenced documents
+        """
+        return self._project(fields, 0)
 
     def count(self):
         """Count all matched results, regardless of offset and limit info.
         """
+        replica = self._replica()
+        if replica is not None:
+            count = replica.count(self)
+            if count is not None:
+                return count
+        return self._through_cache('count', lambda: (self._count(), None))
+
+    def _count(self):
+        kwargs = {}
+        if self._cursor_options.get('max_time_ms'):
+            kwargs['maxTimeMS'] = self._cursor_options['max_time_ms']
         if self.mongo_cond():
-            return self.ele_cls.db.count_documents(self.mongo_cond())
+            return self.ele_cls.db.count_documents(self.mongo_cond(), session=self._get_session(),
+                                                   **kwargs)
         else:
-            return self.ele_cls.db.estimated_document_count()
+            # estimated count does not support sessions
+            return self.ele_cls.db.estimated_document_count(**kwargs)
+
+    async def acount(self):
+        """Count all matched results without blocking the event loop, see `count`"""
+        return await self.ele_cls._binding.run_async(self.count)
 
     def as_list(self):
         """Fetch all results in a list
         """
-        return list(self)
+        # not list(self), which counts the results first with __len__
+        return list(iter(self))
 
-    def as_dict(self, expand=True, allowed_fields=None, filtered_fields=None):
-        """Fetch all results in a list of dicts
+    def as_dict(self, expand=True, allowed_fields=None, filtered_fields=None, depth=None):
+        """Fetch all results in a list of dicts, only fetching the allowed fields when
+        no projection is specified. Expanded references are converted once and shared
+        among results, see `DbObject.as_dict`
         """
 
+        memo = {} if expand else None
+
         def _can_include(key: str):
             if allowed_fields and key not in allowed_fields: return False
             if filtered_fields and key in filtered_fields: return False
             return True
 
         def _select(res):
-            res = res.as_dict(expand)
+            res = res.as_dict(expand, depth, memo)
             if allowed_fields or filtered_fields:
                 res = {k: v for k, v in res.items() if _can_include(k)}
             return res
 
+        result_set = self
+        if not self._projection:
+            if allowed_fields:
+                result_set = self.only(*[_ for _ in allowed_fields if _can_include(_)])
+            elif filtered_fields:
+                result_set = self.exclude(*filtered_fields)
+
         return [
-            _select(res) for res in self
+            _select(res) for res in result_set
         ]
+
+    def iter_json(self, ndjson=False, expand=True, depth=None, **encoder_kwargs) -> Iterator[str]:
+        """Serialize results into JSON while iterating over the cursor,
+        only one document is held in memory at a time
+
+        Args:
+            ndjson (bool, optional): Yield one line for each document (NDJSON),
+                otherwise chunks of a JSON array. Defaults to False.
+            expand (bool, optional): Expand referenced objects, see `DbObject.as_dict`.
+                Defaults to True.
+            depth (int, optional): Levels of references to expand. Defaults to None.
+            encoder_kwargs (dict): Arguments for `json.JSONEncoder`
+
+        Yields:
+            str: JSON chunks
+        """
+        encoder_kwargs.setdefault('default', converters.to_json)
+        encoder = json.JSONEncoder(**encoder_kwargs)
+
+        if ndjson:
+            for res in self:
+                yield encoder.encode(res.as_dict(expand, depth)) + '\n'
+            return
+
+        sep = '['
+        for res in self:
+            yield sep + encoder.encode(res.as_dict(expand, depth))
+            sep = ','
+        yield '[]' if sep == '[' else ']'
@@ -0,0 +1,551 @@
+"""Benchmarks for PyMongoWrapper
+
+Usage: python bench.py [connection string] [benchmark names...]
+The connection string defaults to mongodb://localhost:27017/pymongowrapper_bench,
+and the database will be dropped before running each benchmark. Pass memory://<database>
+to run against the in-memory backend, without a server.
+"""
+
+import asyncio
+import copy
+import datetime
+import sys
+import time
+import tracemalloc
+
+from bson import ObjectId
+
+from PyMongoWrapper import F, converters
+from PyMongoWrapper.dbo import MongoConnection, DbObject, DbObjectCollection
+from PyMongoWrapper.mongoexplain import ScanGuard
+
+
+CONNSTR = 'mongodb://localhost:27017/pymongowrapper_bench'
+
+
+def _timeit(name, func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:<40} {best * 1000:10.2f} ms')
+    return best
+
+
+def _memory(name, func):
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    result = func()
+    blocks = sys.getallocatedblocks() - blocks
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<40} {peak / 1024:10.1f} KiB peak {blocks:10d} blocks')
+    return result
+
+
+def _connect(connstr=None):
+    conn = MongoConnection(connstr or CONNSTR)
+    for name in conn.db.list_collection_names():
+        conn.db.drop_collection(name)
+    return conn
+
+
+def bench_join_strategies(connstr=None, n_posts=5000, n_authors=100):
+    conn = _connect(connstr)
+
+    class Author(conn.DbObject):
+        name = str
+
+    class Tag(conn.DbObject):
+        name = str
+
+    class Post(conn.DbObject):
+        title = str
+        author = Author
+        tags = DbObjectCollection(Tag)
+
+    authors = [Author(name=f'author{i}').save() for i in range(n_authors)]
+    tags = [Tag(name=f'tag{i}').save() for i in range(20)]
+    Post.db.insert_many([
+        {'title': f'post{i}', 'author': authors[i % n_authors].id,
+         'tags': [tags[i % 20].id, tags[(i * 7) % 20].id]}
+        for i in range(n_posts)
+    ])
+    Post.ensure_index('title')
+
+    for strategy in ('lookup', 'client'):
+        _timeit(f'iterate all ({strategy})',
+                lambda: list(Post.query({}).join(strategy)))
+        _timeit(f'sorted page ({strategy})',
+                lambda: list(Post.query({}).join(strategy).sort('title').limit(50)))
+        _timeit(f'filter on reference ({strategy})',
+                lambda: list(Post.query({'author.name': 'author1'}).join(strategy)))
+
+
+def bench_copy_on_write(connstr=None, n_items=100000):
+
+    class Doc(DbObject):
+        title = str
+        items = list
+        meta = dict
+
+    raw = {
+        '_id': ObjectId(),
+        'title': 'doc',
+        'items': [{'index': i, 'values': [i, i + 1]} for i in range(n_items)],
+        'meta': {'tags': ['a', 'b'], 'counts': {str(i): i for i in range(1000)}},
+    }
+
+    def _read():
+        doc = Doc().fill_dict(raw)
+        return doc.title, len(doc.items), doc.meta['tags'][0]
+
+    def _modify():
+        doc = Doc().fill_dict(raw)
+        doc.items[0]['index'] = -1
+        doc.meta['tags'].append('c')
+        return doc._save_requests()
+
+    _memory('deepcopy of the document (reference)', lambda: copy.deepcopy(raw))
+    _memory('hydrate and read fields', _read)
+    _memory('modify and build save requests', _modify)
+    _timeit('hydrate and read fields', _read)
+    _timeit('modify and build save requests', _modify)
+
+
+def bench_compact_collection(connstr=None, n_items=100000):
+
+    class Elem(DbObject):
+        pass
+
+    elements = [Elem(id=ObjectId()) for _ in range(n_items)]
+    ids = [_.id for _ in elements]
+
+    coll = _memory('build collection', lambda: DbObjectCollection(
+        Elem, elements, allow_duplicates=False))
+    _memory('list of elements (reference)', lambda: list(elements))
+    _timeit('build collection',
+            lambda: DbObjectCollection(Elem, elements, allow_duplicates=False))
+    _timeit('append without duplicates',
+            lambda: [coll.append(_) for _ in elements[:1000]])
+    _timeit('membership by ObjectId',
+            lambda: [_ in coll for _ in ids[::100]])
+    _timeit('remove by ObjectId',
+            lambda: DbObjectCollection(Elem, elements).remove(ids[-1]), repeat=1)
+    _timeit('lazy collection of ids',
+            lambda: DbObjectCollection(Elem, ids, lazy=True))
+
+    unsaved = [Elem() for _ in range(n_items // 10)]
+
+    def _append_unsaved():
+        coll = DbObjectCollection(Elem, allow_duplicates=False)
+        for _ in unsaved:
+            coll.append(_)
+        for _ in ids[:1000]:
+            coll.append(Elem(id=_))
+
+    _timeit('append unsaved without duplicates', _append_unsaved)
+
+
+def bench_typed_storage(connstr=None, n_items=1000000):
+
+    values = [i / 7 for i in range(n_items)]
+    packed = DbObjectCollection(float, values, storage='binary').id
+
+    _memory('list storage', lambda: DbObjectCollection(float, values))
+    _memory('array storage', lambda: DbObjectCollection(float, values, storage='array'))
+    _memory('read from packed binary',
+            lambda: DbObjectCollection(float, packed, storage='binary'))
+    _timeit('list storage', lambda: DbObjectCollection(float, values), repeat=1)
+    _timeit('array storage',
+            lambda: DbObjectCollection(float, values, storage='array'))
+    _timeit('read from packed binary',
+            lambda: DbObjectCollection(float, packed, storage='binary'))
+    _timeit('sum over packed binary',
+            lambda: sum(DbObjectCollection(float, packed, storage='binary')))
+
+
+def bench_converters(connstr=None, n_items=100000):
+    from dateutil.parser import parse as dtparse
+
+    start = datetime.datetime(2020, 1, 1)
+    iso = [(start + datetime.timedelta(minutes=i)).isoformat() for i in range(n_items)]
+    repeated = [iso[i % 100] for i in range(n_items)]
+    fuzzy = [(start + datetime.timedelta(minutes=i)).strftime('%b %d %Y %H:%M')
+             for i in range(n_items // 10)]
+    oids = [str(ObjectId()) for _ in range(n_items)]
+    hexes = [_[:16] for _ in oids]
+
+    _timeit('datetime, dateutil (reference)', lambda: [dtparse(_) for _ in iso], repeat=1)
+    _timeit('datetime, iso', lambda: [converters.to_datetime(_) for _ in iso])
+    _timeit('datetime, repeated iso', lambda: [converters.to_datetime(_) for _ in repeated])
+    _timeit('datetime, non-iso', lambda: [converters.to_datetime(_) for _ in fuzzy])
+    _timeit('ObjectId from str', lambda: [converters.to_objectid(_) for _ in oids])
+    _timeit('bytes from hex', lambda: [converters.to_bytes(_) for _ in hexes])
+    _timeit('int from str', lambda: [converters.to_int(_) for _ in ['1.0'] * n_items])
+
+    class Doc(DbObject):
+        created = datetime.datetime
+        ref = ObjectId
+        digest = bytes
+
+    docs = [{'created': iso[i], 'ref': oids[i], 'digest': hexes[i]} for i in range(n_items)]
+
+    def _hydrate():
+        for doc in docs:
+            obj = Doc().fill_dict(doc)
+            obj.created, obj.ref, obj.digest
+
+    _timeit('hydrate documents with string values', _hydrate)
+
+
+def bench_expand(connstr=None, n_posts=500, n_authors=10):
+    conn = _connect(connstr)
+
+    class Author(conn.DbObject):
+        name = str
+        _join_strategy = 'client'
+
+    class Tag(conn.DbObject):
+        name = str
+
+    class Post(conn.DbObject):
+        title = str
+        author = Author
+        tags = DbObjectCollection(Tag)
+        _join_strategy = 'client'
+
+    authors = [Author(name=f'author{i}').save() for i in range(n_authors)]
+    tags = [Tag(name=f'tag{i}').save() for i in range(20)]
+    for i in range(n_posts):
+        Post(title=f'post{i}', author=authors[i % n_authors],
+             tags=[tags[i % 20], tags[(i * 7) % 20]]).save()
+
+    posts = list(Post.query({}))
+    memo = {}
+    _timeit('expand page, memo per post', lambda: [_.as_dict(True) for _ in posts])
+    _timeit('expand page, shared memo',
+            lambda: (memo.clear(), [_.as_dict(True, memo=memo) for _ in posts]))
+    _timeit('expand page, depth 0', lambda: [_.as_dict(True, 0) for _ in posts])
+    _timeit('query and expand page', lambda: Post.query({}).as_dict())
+
+
+def bench_json_stream(connstr=None, n_docs=20000):
+    import json
+    from PyMongoWrapper.dbo import create_dbo_json_encoder
+
+    conn = _connect(connstr)
+
+    class Doc(conn.DbObject):
+        title = str
+        created = datetime.datetime
+        values = list
+
+    Doc.db.insert_many([
+        {'title': f'doc{i}', 'created': datetime.datetime(2020, 1, 1),
+         'values': list(range(20))}
+        for i in range(n_docs)
+    ])
+    encoder = create_dbo_json_encoder(json.JSONEncoder)
+
+    def _stream():
+        size = 0
+        for chunk in Doc.query({}).iter_json():
+            size += len(chunk)
+        return size
+
+    _memory('json.dumps(as_dict())',
+            lambda: len(json.dumps(Doc.query({}).as_dict(), cls=encoder)))
+    _memory('iter_json', _stream)
+    _timeit('json.dumps(as_dict())',
+            lambda: json.dumps(Doc.query({}).as_dict(), cls=encoder))
+    _timeit('iter_json', _stream)
+
+
+def bench_json_decode(connstr=None, n_docs=50000):
+    import json
+    import re
+    from dateutil.parser import isoparse
+    from PyMongoWrapper.dbo import create_dbo_json_decoder
+
+    class Doc(DbObject):
+        title = str
+        created = datetime.datetime
+        ref = ObjectId
+
+    text = json.dumps([
+        {'_id': str(ObjectId()), 'title': f'document number {i}', 'summary': 'lorem ipsum ' * 5,
+         'created': datetime.datetime(2020, 1, 1, i % 24).isoformat(), 'ref': str(ObjectId()),
+         'tags': ['a', 'b', 'c']}
+        for i in range(n_docs)
+    ])
+
+    def _hook(d):
+        # the decoder hook before converters, for reference
+        for k, v in d.items():
+            if isinstance(v, str) and re.match(
+                    r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(|[+-]\d{1,2}:\d{2})?Z?$', v):
+                d[k] = isoparse(v)
+        return d
+
+    _timeit('plain json.loads', lambda: json.loads(text))
+    _timeit('regex hook (reference)', lambda: json.loads(text, object_hook=_hook))
+    _timeit('dbo json decoder',
+            lambda: json.loads(text, cls=create_dbo_json_decoder(json.JSONDecoder)))
+    _timeit('schema-guided dbo json decoder',
+            lambda: json.loads(text, cls=create_dbo_json_decoder(json.JSONDecoder, Doc)))
+
+
+def bench_sessions(connstr=None, n_queries=2000):
+    conn = _connect(connstr)
+
+    class Doc(conn.DbObject):
+        name = str
+
+    ids = [Doc(name=f'doc{i}').save().id for i in range(100)]
+
+    def _explicit_sessions():
+        # a new session for each query, as result sets used to do
+        for i in range(n_queries):
+            with conn.db.client.start_session() as session:
+                list(Doc.query({'_id': ids[i % 100]}).session(session))
+
+    def _implicit_sessions():
+        for i in range(n_queries):
+            list(Doc.query({'_id': ids[i % 100]}))
+
+    def _bound_session():
+        with conn.session():
+            for i in range(n_queries):
+                list(Doc.query({'_id': ids[i % 100]}))
+
+    _timeit('session per query (reference)', _explicit_sessions)
+    _timeit('implicit sessions', _implicit_sessions)
+    _timeit('bound session', _bound_session)
+
+
+def bench_first(connstr=None, n_docs=10000, n_queries=2000):
+    conn = _connect(connstr)
+
+    class Doc(conn.DbObject):
+        name = str
+        payload = list
+
+    ids = [_.inserted_id for _ in [Doc.db.insert_one(
+        {'name': f'doc{i}', 'payload': list(range(50))}) for i in range(n_docs)]]
+
+    def _iterate_all():
+        # iterating over the whole cursor, as first() used to do
+        for i in range(n_queries // 100):
+            for _ in Doc.query({'name': {'$gte': 'doc'}}):
+                break
+
+    _timeit('first by _id', lambda: [Doc.first({'_id': ids[i % n_docs]})
+                                     for i in range(n_queries)])
+    _timeit('first by condition', lambda: [Doc.first({'name': f'doc{i % n_docs}'})
+                                           for i in range(n_queries)])
+    _timeit('first with projection', lambda: [Doc.query({'name': f'doc{i % n_docs}'}).first('name')
+                                              for i in range(n_queries)])
+    _timeit('break out of iteration (reference, 1/100)', _iterate_all)
+    _timeit('first of a range (1/100)', lambda: [Doc.query({'name': {'$gte': 'doc'}}).first()
+                                                 for i in range(n_queries // 100)])
+
+
+def bench_pagination(connstr=None, n_docs=50000, page_size=20):
+    conn = _connect(connstr)
+
+    class Doc(conn.DbObject):
+        score = int
+        name = str
+
+    Doc.db.insert_many([{'score': i % 1000, 'name': f'doc{i}'} for i in range(n_docs)])
+    Doc.ensure_index('-score', 'id')
+    rs = Doc.query({}).sort('-score')
+
+    for page in (1, 100, 1000, 2000):
+        _timeit(f'skip to page {page}',
+                lambda: rs.skip((page - 1) * page_size).limit(page_size).as_list())
+
+    tokens = {}
+    after = None
+    for page in range(1, 2001):
+        if page in (1, 100, 1000, 2000):
+            tokens[page] = after
+        _, after = rs.paginate(page_size, after)
+
+    for page, after in tokens.items():
+        _timeit(f'seek to page {page}', lambda: rs.paginate(page_size, after))
+
+
+def bench_parallel_scan(connstr=None, n_docs=200000):
+    conn = _connect(connstr)
+
+    class Doc(conn.DbObject):
+        n = int
+        payload = str
+
+    for i in range(0, n_docs, 10000):
+        Doc.db.insert_many([{'n': j, 'payload': 'x' * 200} for j in range(i, i + 10000)])
+
+    _timeit('single cursor', lambda: sum(1 for _ in Doc.query({})), repeat=1)
+    for n in (2, 4, 8):
+        _timeit(f'parallel({n}), merged', lambda: sum(1 for _ in Doc.query({}).parallel(n)), repeat=1)
+        _timeit(f'parallel({n}), workers',
+                lambda: sum(Doc.query({}).parallel(n, 'time').run(
+                    lambda p, it: sum(1 for _ in it))), repeat=1)
+
+
+def bench_read_ahead(connstr=None, n_docs=100000):
+    conn = _connect(connstr)
+
+    class Doc(conn.DbObject):
+        n = int
+        payload = str
+
+    for i in range(0, n_docs, 10000):
+        Doc.db.insert_many([{'n': j, 'payload': 'x' * 200} for j in range(i, i + 10000)])
+
+    def _consume(rs):
+        for doc in rs:
+            doc.as_dict()
+
+    _timeit('plain cursor', lambda: _consume(Doc.query({})), repeat=1)
+    for depth, batch_size in ((1, 100), (2, 100), (4, 1000)):
+        _timeit(f'read_ahead({depth}, {batch_size})',
+                lambda: _consume(Doc.query({}).read_ahead(depth, batch_size)), repeat=1)
+
+
+def bench_async(connstr=None, n_queries=500):
+    conn = _connect(connstr)
+
+    class Doc(conn.DbObject):
+        n = int
+
+    Doc.db.insert_many([{'n': i} for i in range(n_queries)])
+
+    _timeit('first, sequential', lambda: [Doc.first({'n': i}) for i in range(n_queries)], repeat=1)
+
+    async def _concurrent():
+        return await asyncio.gather(*[Doc.query({'n': i}).afirst() for i in range(n_queries)])
+
+    _timeit('afirst, gathered', lambda: asyncio.run(_concurrent()), repeat=1)
+    conn.close()
+
+
+def bench_gather(connstr=None, n_docs=100000):
+    conn = _connect(connstr)
+
+    class Doc(conn.DbObject):
+        n = int
+
+    for i in range(0, n_docs, 10000):
+        Doc.db.insert_many([{'n': j} for j in range(i, i + 10000)])
+
+    queries = [Doc.query({'n': {'$gte': k * n_docs // 10}}).count for k in range(10)]
+    _timeit('10 counts, sequential', lambda: [q() for q in queries])
+    _timeit('10 counts, gathered', lambda: conn.gather(*queries))
+    conn.close()
+
+
+def bench_query_cache(connstr=None, n_docs=1000, n_queries=2000):
+    from PyMongoWrapper.mongocache import QueryCache
+
+    conn = _connect(connstr)
+    conn.query_cache = QueryCache(ttl=60)
+
+    class Category(conn.DbObject):
+        name = str
+        rank = int
+
+    Category.db.insert_many([{'name': f'cat{i}', 'rank': i % 10} for i in range(n_docs)])
+
+    def _queries(rs):
+        for i in range(n_queries):
+            rs.query({'rank': i % 10}).sort('name').limit(20).as_list()
+            rs.query({'rank': i % 10}).count()
+
+    _timeit('uncached', lambda: _queries(Category), repeat=1)
+    Category._cached = True
+    _timeit('cached', lambda: _queries(Category), repeat=1)
+    print(conn.query_cache.stats)
+
+
+def bench_replica(connstr=None, n_docs=500, n_queries=2000):
+    conn = _connect(connstr)
+
+    class Setting(conn.DbObject):
+        name = str
+        group = str
+        value = int
+
+    Setting.db.insert_many([{'name': f's{i}', 'group': f'g{i % 20}', 'value': i}
+                            for i in range(n_docs)])
+
+    def _lookups():
+        for i in range(n_queries):
+            Setting.first({'name': f's{i % n_docs}'})
+            Setting.query({'group': f'g{i % 20}', 'value': {'$gte': 100}}).as_list()
+
+    _timeit('server', _lookups, repeat=1)
+    replica = Setting.replicate(keys=('name', 'group'))
+    _timeit('replicated', _lookups, repeat=1)
+    print(f'local queries: {replica.local_queries}, fallbacks: {replica.fallbacks}')
+    conn.close()
+
+
+def bench_ensure_index(connstr=None, n_calls=1000):
+    conn = _connect(connstr)
+
+    class Event(conn.DbObject):
+        name = str
+        at = datetime.datetime
+        _indexes = ['name', ('-at', 'name'), {'keys': 'at', 'expireAfterSeconds': 3600}]
+
+    conn.sync_indexes()
+
+    def _uncached():
+        # fetching index information on every call, as ensure_index used to do
+        for _ in range(n_calls):
+            keys = [('at', -1), ('name', 1)]
+            if not any(_['key'] == keys for _ in Event.db.index_information().values()):
+                Event.db.create_index(keys)
+
+    _timeit('index_information per call (reference)', _uncached)
+    _timeit('ensure_index, cached', lambda: [Event.ensure_index('-at', 'name')
+                                             for _ in range(n_calls)])
+    _timeit('sync_indexes, cached', lambda: [conn.sync_indexes(Event) for _ in range(n_calls)])
+    conn.close()
+
+
+def bench_scan_guard(connstr=None, n_docs=5000, n_queries=500):
+    conn = _connect(connstr)
+
+    class Item(conn.DbObject):
+        n = int
+        _indexes = ['n']
+
+    conn.sync_indexes(Item)
+    Item.db.insert_many([{'n': i} for i in range(n_docs)])
+
+    def _queries():
+        for i in range(n_queries):
+            list(Item.query(F.n == i))
+
+    _timeit('indexed queries, no guard', _queries)
+    conn.scan_guard = ScanGuard(threshold=n_docs // 2)
+    _timeit('indexed queries, guarded', _queries)
+    print(f'query shapes explained: {conn.scan_guard.explained}')
+    _timeit('explain per query (reference)', lambda: [Item.query(F.n == i).explain('queryPlanner')
+                                                     for i in range(n_queries)])
+    conn.close()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    connstr = args.pop(0) if args and '://' in args[0] else None
+    for k, func in dict(globals()).items():
+        if k.startswith('bench_') and hasattr(func, '__call__') and (not args or k[6:] in args):
+            print(f"\n\n{k.upper().replace('_', ' ')}\n{'=' * len(k)}\n")
+            func(connstr)
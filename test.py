@@ -1,11 +1,17 @@
+import asyncio
+import contextlib
 import math
+import os
 from antlr4 import *
 from PyMongoWrapper import QExprInterpreter, Fn, F, \
     MongoOperand, QExprEvaluator, MongoConcating, \
     AntlrQExprParser
 import json
 import datetime
+import gc
+import weakref
 import click
+from collections import namedtuple
 from decimal import Decimal
 from bson import ObjectId, Binary, SON
 
@@ -53,6 +59,26 @@ def _test(got, should_be=None, approx=None):
         return False
 
 
+Call = namedtuple('Call', 'collection method args kwargs')
+
+
+@contextlib.contextmanager
+def _calls(collections, *methods):
+    """Record calls to methods of the collections, as a list of `Call`"""
+    calls = []
+    for collection in collections:
+        for method in methods:
+            setattr(collection, method, lambda *args, call=getattr(collection, method),
+                    name=collection.name, method=method, **kwargs:
+                    calls.append(Call(name, method, args, kwargs)) or call(*args, **kwargs))
+    try:
+        yield calls
+    finally:
+        for collection in collections:
+            for method in methods:
+                delattr(collection, method)
+
+
 def test_query_parser():
 
     def _groupby(_id, **params):
@@ -397,7 +423,8 @@ def test_querify():
 
 def test_dbobject():
 
-    from PyMongoWrapper.dbo import DbObject, DbObjectCollection
+    from PyMongoWrapper.dbo import DbObject, DbObjectCollection, \
+        create_dbo_json_encoder, create_dbo_json_decoder
 
     class Elem(DbObject):
         pass
@@ -457,12 +484,914 @@ def test_dbobject():
     _test(Test().fill_dict(
         {'keywords': ['a', 'b', 'c']}).as_dict()['keywords'].__class__.__name__, 'list')
 
+    _test(Test(pdate='2020-01-02T03:04:05Z').pdate,
+          datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc))
+    _test(Test(pdate='Jan 2 2020').pdate, datetime.datetime(2020, 1, 2))
+
+    # initializers of dynamically created classes are not cached for the process
+    def _dynamic_class():
+        class Dynamic(DbObject):
+            name = str
+
+        class Holder(DbObject):
+            dynamic = Dynamic
+
+        Holder(dynamic={'name': 'a'})
+        return weakref.ref(Dynamic)
+
+    dynamic_ref = _dynamic_class()
+    gc.collect()
+    _test(dynamic_ref() is None, True)
+
     _test(MongoOperand([Fn.set(keywords='a')])
           (), [{'$set': {'keywords': 'a'}}])
 
     oid = ObjectId('0'*24)
     _test(len(Test(nodups=[Elem(id=oid), Elem(id=oid)]).nodups), 1)
 
+    t = Test(nodups=[Elem(id=oid)])
+    t.nodups.append(Elem(id=oid))
+    _test((len(t.nodups), oid in t.nodups, ObjectId() in t.nodups), (1, True, False))
+
+    # unsaved elements are keyed by identity until they get ids
+    unsaved = [Elem(), Elem()]
+    t = Test(nodups=unsaved + unsaved)
+    _test((len(t.nodups), unsaved[0] in t.nodups, Elem() in t.nodups), (2, True, False))
+    unsaved[1].id = oid
+    t.nodups.append(Elem(id=oid))
+    _test((len(t.nodups), oid in t.nodups, unsaved[1] in t.nodups), (2, True, True))
+
+    _test(Test.schema.describe()['elements'], {
+          'type': 'DbObjectCollection', 'element_type': 'Elem', 'reference': 'elem'})
+
+    class Vec(DbObject):
+        values = DbObjectCollection(float, storage='binary')
+
+    packed = Vec(values=[1, 0.5]).as_dict()['values']
+    _test((packed.subtype, len(packed)), (0x80, 16))
+    v = Vec().fill_dict({'values': packed})
+    _test(list(v.values), [1.0, 0.5])
+    v.values.append(2)
+    _test(v.as_dict(True)['values'], [1.0, 0.5, 2.0])
+
+    raw = {'_id': oid, 'keywords': ['a'], 'meta': {'images': [{'width': 1}]}}
+    t = Test().fill_dict(raw)
+    t.meta['images'][0]['width'] = 2
+    _test(raw['meta']['images'][0]['width'], 1)
+    _test(t.as_dict()['meta']['images'][0]['width'], 2)
+
+    ele = Elem(id=ObjectId())
+    ele.me = ele
+    _test(ele.as_dict(True)['me'], ele.id)
+    d = Test(elements=[ele, ele]).as_dict(True)
+    _test(d['elements'][0] is d['elements'][1], True)
+
+    _test(json.loads(json.dumps(Test(title='a', pdate=datetime.datetime(2020, 1, 2), keywords=[],
+                                     elements=[Elem(id=oid, data=b'\x01')]),
+                                cls=create_dbo_json_encoder(json.JSONEncoder))),
+          {'title': 'a', 'pdate': '2020-01-02T00:00:00', 'keywords': [], 'content': '',
+           'elements': [{'_id': '0' * 24, 'data': '01'}], 'nodups': []})
+
+    text = '{"_id": "%s", "title": "2020-01-02T00:00:00", "pdate": "2020-01-02T00:00:00"}' % oid
+    _test(json.loads(text, cls=create_dbo_json_decoder(json.JSONDecoder))['title'],
+          datetime.datetime(2020, 1, 2))
+    _test(json.loads(text, cls=create_dbo_json_decoder(json.JSONDecoder, Test)),
+          {'_id': oid, 'title': '2020-01-02T00:00:00', 'pdate': datetime.datetime(2020, 1, 2)})
+
+    # values shared with the loaded document are copied on write, and exported as plain containers
+    raw = {'_id': ObjectId(), 'title': 'cow', 'tags': [{'a': [1]}], 'meta': {'n': {'k': 1}}}
+    t = Test().fill_dict(raw)
+    t.tags[0]['a'].append(2)
+    t.meta['n']
+    d = t.as_dict(True)
+    _test((type(d['tags']), type(d['tags'][0]['a']), type(d['meta']), type(d['meta']['n'])),
+          (list, list, dict, dict))
+    _test((d['tags'], raw['tags']), ([{'a': [1, 2]}], [{'a': [1]}]))
+    _test(type(t.as_dict()['tags']), list)
+
+    Test.set_field('extra', Elem)
+    _test('extra' in Test.extended_fields, True)
+    Test.set_field('extra', None)
+    _test('extra' in Test.extended_fields, False)
+
+
+def test_memory_backend():
+    import pymongo.errors
+    from PyMongoWrapper.dbo import MongoConnection
+    conn = MongoConnection('memory://test')
+
+    class Author(conn.DbObject):
+        name = str
+
+    class Post(conn.DbObject):
+        title = str
+        tags = list
+        views = int
+        author = Author
+
+    authors = [Author(name=name).save() for name in ('a', 'b')]
+    for i in range(10):
+        Post(title=f'p{i}', tags=['even' if i % 2 == 0 else 'odd'], views=i,
+             author=authors[i % 2]).save()
+
+    _test(Post.query({'tags': 'even', 'views': {'$gte': 4}}).count(), 3)
+    _test([_.title for _ in Post.query({}).sort('-views').skip(1).limit(2)], ['p8', 'p7'])
+    _test(Post.query({'title': 'p3'}).join('client').first().author.name, 'b')
+    _test(len(list(Post.aggregator.lookup(from_='author', localField='author',
+                                          foreignField='_id', as_='joined')
+                   .match({'joined.name': 'a'}))), 5)
+    _test([(_.id, _.n) for _ in Post.aggregator.group(_id='$tags', n=Fn.sum('$views')).sort(_id=1)],
+          [(['even'], 20), (['odd'], 25)])
+
+    Post.query({'views': {'$lt': 5}}).update({'$inc': {'views': 100}})
+    _test(Post.query({'views': {'$gt': 100}}).count(), 4)
+    Post.query({'tags': 'odd'}).delete()
+    _test(Post.query({}).count(), 5)
+
+    Author.db.create_index('name', unique=True)
+    try:
+        Author(name='a').save()
+        _test('duplicate saved', 'DuplicateKeyError')
+    except pymongo.errors.DuplicateKeyError as ex:
+        _test((ex.code, Author.query({}).count()), (11000, 2))
+    conn.close()
+
+
+def test_prefetch():
+    from PyMongoWrapper.dbo import MongoConnection, DbObjectCollection
+    conn = MongoConnection('memory://test')
+
+    class Author(conn.DbObject):
+        name = str
+
+    class Tag(conn.DbObject):
+        name = str
+
+    class Post(conn.DbObject):
+        title = str
+        author = Author
+        tags = DbObjectCollection(Tag)
+
+    for cls in (Author, Tag, Post):
+        cls.db.drop()
+    authors = [Author(name=f'a{i}').save() for i in range(3)]
+    tags = [Tag(name=f't{i}').save() for i in range(4)]
+    for i in range(10):
+        Post(title=f'p{i}', author=authors[i % 3], tags=tags[i % 4:i % 4 + 2]).save()
+
+    def _joined(posts):
+        return [(_.title, _.author.name, [tag.name for tag in _.tags]) for _ in posts]
+
+    with _calls([Author.db, Tag.db], 'find') as calls:
+        expected = _joined(Post.query({}).sort('title').join('lookup'))
+        _test(calls, [])
+        # one query per reference field for each chunk of results
+        _test(_joined(Post.query({}).sort('title').prefetch('author', 'tags', chunk_size=4)),
+              expected)
+        _test(sorted(_.collection for _ in calls), ['author'] * 3 + ['tag'] * 3)
+        calls.clear()
+        _test(_joined(Post.query({}).sort('title').prefetch('author')), expected)
+        _test([_.collection for _ in calls], ['author'])
+    conn.close()
+
+
+def test_join_strategies():
+    from PyMongoWrapper.dbo import MongoConnection, DbObjectCollection
+    conn = MongoConnection('memory://test')
+
+    class Author(conn.DbObject):
+        name = str
+
+    class Tag(conn.DbObject):
+        name = str
+
+    class Post(conn.DbObject):
+        title = str
+        author = Author
+        tags = DbObjectCollection(Tag)
+
+    for cls in (Author, Tag, Post):
+        cls.db.drop()
+    authors = [Author(name=f'a{i}').save() for i in range(3)]
+    tags = [Tag(name=f't{i}').save() for i in range(4)]
+    for i in range(10):
+        Post(title=f'p{i}', author=authors[i % 3], tags=tags[i % 4:i % 4 + 2]).save()
+    Post(title='orphan').save()
+    # dangling references are dropped by both strategies
+    Tag.db.delete_one({'_id': tags[3].id})
+
+    def _joined(result_set):
+        return [(_.title, _.author.name, [tag.name for tag in _.tags]) for _ in result_set]
+
+    for cond in ({}, F['author.name'] == 'a1', F['tags.name'] == 't2'):
+        lookup = _joined(Post.query(cond).sort('title').join('lookup'))
+        client = _joined(Post.query(cond).sort('title').join('client'))
+        _test((client == lookup, len(lookup) > 0), (True, True))
+    _test(_joined(Post.query(F.title.regex('^(p3|orphan)$')).sort('title').join('client')),
+          [('orphan', '', []), ('p3', 'a0', [])])
+    conn.close()
+
+
+def test_session():
+    from PyMongoWrapper.dbo import MongoConnection
+    conn = MongoConnection('memory://test')
+
+    class Item(conn.DbObject):
+        n = int
+
+    Item.db.drop()
+
+    def _sessions(calls):
+        return [_.kwargs.get('session') for _ in calls]
+
+    # queries and saves within the context run in the bound session
+    with _calls([Item.db], 'find', 'count_documents', 'insert_one', 'update_one') as calls:
+        with conn.session() as session:
+            item = Item(n=0).save()
+            item.n = 1
+            item.save()
+            _test((len(list(Item.query({}))), Item.query(F.n > 0).count()), (1, 1))
+            _test(_sessions(calls), [session] * 4)
+            with conn.db.client.start_session() as other:
+                calls.clear()
+                list(Item.query({}).session(other))
+                _test(_sessions(calls), [other])
+        _test((session.has_ended, conn.current_session), (True, None))
+        calls.clear()
+        list(Item.query({}))
+        _test(_sessions(calls), [None])
+
+    # cursors left open by partial iteration are closed with the result set
+    for i in range(2, 10):
+        Item(n=i).save()
+    with Item.query({}).batch_size(2) as result_set:
+        results = iter(result_set)
+        next(results)
+        cursor, = result_set._cursors
+        _test(cursor.alive, True)
+    _test((cursor.alive, result_set._cursors), (False, []))
+    result_set = Item.query({})
+    _test((len(list(result_set)), result_set._cursors), (9, []))
+    conn.close()
+
+
+def test_first():
+    from PyMongoWrapper.dbo import MongoConnection, DbObjectCollection
+    conn = MongoConnection('memory://test')
+
+    class Tag(conn.DbObject):
+        name = str
+
+    class Post(conn.DbObject):
+        title = str
+        tags = DbObjectCollection(Tag)
+
+    class ClientPost(Post):
+        _collection = 'post'
+        _join_strategy = 'client'
+
+    Tag.db.drop()
+    Post.db.drop()
+    tags = [Tag(name=f't{i}').save() for i in range(3)]
+    posts = [Post(title=f'p{i}', tags=tags[i:]).save() for i in range(3)]
+
+    def _limits(calls):
+        return [(_.method, _.kwargs.get('limit')) for _ in calls]
+
+    # objects loaded by id with find_one equal those from the query, limited to one result
+    with _calls([Post.db], 'find', 'find_one', 'aggregate') as calls:
+        for cls in (Tag, ClientPost, Post):
+            for obj in (tags if cls is Tag else posts):
+                calls.clear()
+                fast = cls.first({'_id': obj.id})
+                fast_calls = _limits(calls)
+                calls.clear()
+                slow = cls.query({'_id': obj.id}).first()
+                _test((fast.as_dict(True), type(fast)), (slow.as_dict(True), type(slow)))
+            if cls is ClientPost:
+                _test((fast_calls[0], _limits(calls)), (('find_one', None), [('find', 1)]))
+            elif cls is Post:
+                _test([method for method, _ in fast_calls + _limits(calls)],
+                      ['aggregate', 'aggregate'])
+        _test((Tag.first({'_id': ObjectId()}), ClientPost.first({'_id': ObjectId()})),
+              (None, None))
+        _test(ClientPost.first({'_id': posts[1].id}).tags[1].name, 't2')
+    conn.close()
+
+
+def test_paginate():
+    from PyMongoWrapper import MongoResultSet
+    from PyMongoWrapper.dbo import MongoConnection
+
+    # pages continue after the last values of the sorting keys
+    oid = ObjectId('0' * 24)
+    _test(MongoResultSet._keyset_predicate([('title', 1), ('_id', -1)], ['a', oid]),
+          {'$or': [{'title': {'$gt': 'a'}}, {'title': 'a', '_id': {'$lt': oid}}]})
+
+    conn = MongoConnection('memory://test')
+
+    class Owner(conn.DbObject):
+        name = str
+
+    class Item(conn.DbObject):
+        n = int
+        group = str
+        meta = dict
+        owner = Owner
+
+    Owner.db.drop()
+    Item.db.drop()
+    owners = [Owner(name=f'o{i}').save() for i in range(2)]
+    for i in range(23):
+        # few distinct values, so that pages end within ties
+        Item(n=i, group=['a', 'b', 'c'][i % 3] if i % 5 else None, meta={'k': i % 4},
+             owner=owners[i % 2]).save()
+
+    def _pages(result_set, page_size):
+        pages, token = [], None
+        while True:
+            page, token = result_set.paginate(page_size, token)
+            pages.append([_.n for _ in page])
+            if token is None:
+                return pages
+
+    # pages follow the order of the query with `_id` as the tiebreaker
+    for sort in (('group',), ('-group',), ('group', '-n'), ('-_id',)):
+        keys = sort if '-_id' in sort else sort + ('_id',)
+        for cond in ({}, F.n > 4):
+            expected = [_.n for _ in Item.query(cond).sort(*keys)]
+            pages = _pages(Item.query(cond).sort(*sort), 4)
+            _test((sum(pages, []), max(len(_) for _ in pages)), (expected, 4))
+    _test(Item.query({}).limit(5).sort('n')._limit, 5)
+    _test(sum(_pages(Item.query({}).sort('-group').only('n'), 10), []),
+          [_.n for _ in Item.query({}).sort('-group', '_id')])
+    # sorting keys are kept from exclusion, but cannot go through reference fields
+    for excluded, sort in (('group', 'group'), ('meta', 'meta.k'), ('meta.k', '-meta')):
+        _test(sum(_pages(Item.query({}).sort(sort).exclude(excluded, 'owner'), 5), []),
+              [_.n for _ in Item.query({}).sort(sort, '_id')])
+    for sort in ('owner.name', 'owner'):
+        try:
+            Item.query({}).sort(sort).paginate(5)
+            _test(f'paginated by {sort}', 'AssertionError')
+        except AssertionError:
+            _test(True, True)
+    page, token = Item.query({}).sort('n').paginate(5)
+    try:
+        Item.query({}).sort('group').paginate(5, token)
+        _test('token accepted', 'ValueError')
+    except ValueError:
+        _test(True, True)
+    conn.close()
+
+
+def test_parallel_scan():
+    from collections import Counter
+    from PyMongoWrapper.dbo import MongoConnection
+    from PyMongoWrapper.mongoparallel import ScanPartition
+    conn = MongoConnection('memory://test')
+
+    class Item(conn.DbObject):
+        n = int
+
+    # partitions continue after the last result seen
+    oid = ObjectId('0' * 24)
+    part = ScanPartition(0, oid, None)
+    _test(part.condition(), {'_id': {'$gte': oid}})
+    part.advance(Item(id=ObjectId('1' * 24)))
+    _test(part.condition(), {'_id': {'$gt': ObjectId('1' * 24)}})
+
+    Item.db.drop()
+    start = datetime.datetime(2024, 1, 1)
+    # ids spread over time, so that both methods split into several partitions
+    Item.db.insert_many([{'_id': ObjectId.from_datetime(start + datetime.timedelta(minutes=i)), 'n': i}
+                         for i in range(200)])
+
+    for method in ('sample', 'time'):
+        for cond, expected in (({}, range(200)), ({'n': {'$mod': [3, 0]}}, range(0, 200, 3))):
+            scan = Item.query(cond).parallel(4, method)
+            counts = Counter(_.n for _ in scan)
+            _test((sorted(counts), set(counts.values()), scan.progress),
+                  (list(expected), {1}, {'processed': len(expected), 'done': 4, 'partitions': 4}))
+
+    # partitions handed to workers, and resumed from a checkpoint
+    scan = Item.query({}).parallel(4)
+    _test(sorted(sum(scan.run(lambda partition, results: [_.n for _ in results]), [])),
+          list(range(200)))
+    scan = Item.query({}).parallel(4)
+    seen = []
+    for obj in scan:
+        seen.append(obj.n)
+        if len(seen) == 50:
+            break
+    resumed = Item.query({}).parallel(4, resume=scan.checkpoint())
+    rest = [_.n for _ in resumed]
+    # only the result in progress when the checkpoint was taken is scanned again
+    _test((sorted(set(seen + rest)), set(seen) & set(rest), len(rest) + len(seen)),
+          (list(range(200)), {seen[-1]}, 201))
+    conn.close()
+
+
+def test_read_ahead():
+    from PyMongoWrapper.dbo import MongoConnection
+    from PyMongoWrapper.mongoparallel import read_ahead
+
+    # batches are buffered in a background thread, stopped when iteration stops early
+    _test(list(read_ahead(iter(range(250)), 2, 100)), list(range(250)))
+    ahead = read_ahead(iter(range(250)), 1, 10)
+    _test([next(ahead), next(ahead)], [0, 1])
+    ahead.close()
+
+    conn = MongoConnection('memory://test')
+
+    class Item(conn.DbObject):
+        n = int
+
+    Item.db.drop()
+    Item.db.insert_many([{'n': i} for i in range(25)])
+    _test([_.n for _ in Item.query(F.n > 2).sort('n').read_ahead(2, 10)], list(range(3, 25)))
+    conn.close()
+
+
+def test_query_cache():
+    from PyMongoWrapper.dbo import MongoConnection
+    from PyMongoWrapper.mongocache import QueryCache, fingerprint, normalize_cond
+
+    # conditions equal up to the order of operators share fingerprints
+    _test(fingerprint(normalize_cond({'a': 1, 'b': {'$lt': 2, '$gt': 0}})),
+          fingerprint(normalize_cond({'b': {'$gt': 0, '$lt': 2}, 'a': 1})))
+    _test(fingerprint(normalize_cond({'a': {'x': 1, 'y': 2}})) ==
+          fingerprint(normalize_cond({'a': {'y': 2, 'x': 1}})), False)
+
+    # least recently used entries are evicted, writes racing with reads are not cached
+    cache = QueryCache(maxsize=2)
+    cache.set('a', 1, ['x'])
+    cache.set('b', 2, ['y'])
+    cache.get('a')
+    cache.set('c', 3, ['y'])
+    _test((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+    version = cache.version(['y'])
+    cache.invalidate('y')
+    _test((cache.get('c'), cache.set('c', 3, ['y'], version)), (None, False))
+    _test(cache.stats['hits'], 3)
+
+    conn = MongoConnection('memory://test', query_cache=QueryCache())
+    cache = conn.query_cache
+
+    class Author(conn.DbObject):
+        name = str
+
+    class Post(conn.DbObject):
+        _cached = True
+        title = str
+        views = int
+        author = Author
+
+    Author.db.drop()
+    Post.db.drop()
+    author = Author(name='a').save()
+    for i in range(5):
+        Post(title=f'p{i}', views=i, author=author).save()
+
+    def _titles():
+        return [(_.title, _.views, _.author.name) for _ in Post.query(F.views > 1).sort('views')]
+
+    # repeated queries are served from the cache
+    expected = _titles()
+    Post.query(F.views > 1).count()
+    hits = cache.hits
+    with _calls([Post.db, Author.db], 'find', 'aggregate', 'count_documents') as calls:
+        _test((_titles(), Post.query(F.views > 1).count(), cache.hits, calls),
+              (expected, 3, hits + 2, []))
+
+    # saves, result set updates and deletions drop cached results
+    post = Post.first(F.title == 'p2')
+    post.views = 10
+    post.save()
+    _test(_titles()[-1], ('p2', 10, 'a'))
+    Post(title='p5', views=5, author=author).save()
+    _test(Post.query(F.views > 1).count(), 4)
+    Post.query(F.title == 'p3').update({'$set': {'views': 0}})
+    _test([_[0] for _ in _titles()], ['p4', 'p5', 'p2'])
+    Post.query(F.title == 'p4').delete()
+    _test((Post.query(F.views > 1).count(), len(_titles())), (2, 2))
+    # as do writes to joined collections
+    author.name = 'b'
+    author.save()
+    _test({_[2] for _ in _titles()}, {'b'})
+    with conn.unit_of_work():
+        Post(title='p6', views=6, author=author).save()
+    _test(_titles()[-1], ('p2', 10, 'b'))
+    _test(Post.query(F.views > 1).count(), 3)
+
+    # results joined differently are cached apart, and readers get their own copies
+    result_sets = [Post.query(F.views > 1).sort('views'),
+                   Post.query(F.views > 1).sort('views').join('client'),
+                   Post.query(F.views > 1).sort('views').prefetch('author')]
+    _test(len({_._cache_key('find') for _ in result_sets}), 3)
+    for result_set in result_sets * 2:
+        posts = list(result_set)
+        _test([(_.title, _.author.name) for _ in posts], [('p5', 'b'), ('p6', 'b'), ('p2', 'b')])
+        posts[0]._orig['title'] = 'changed'
+        posts[0].author._orig['name'] = 'changed'
+    conn.close()
+
+
+def test_invalidation_listener():
+    from PyMongoWrapper.dbo import MongoConnection
+    from PyMongoWrapper.mongocache import InvalidationListener, QueryCache
+    conn = MongoConnection('memory://test', query_cache=QueryCache())
+    cache = conn.query_cache
+    ns = {'db': 'test', 'coll': 'posts'}
+    for per_id in (False, True):
+        listener = InvalidationListener(conn, per_id=per_id)
+        cache.set('a', b'', ['posts'], ids={'posts': [1, 2]})
+        cache.set('b', b'', ['posts'], ids={'posts': [3]})
+        cache.set('count', 3, ['posts'])
+        # updates may make other documents match, unless per_id is given
+        listener.process_event({'operationType': 'update', 'ns': ns, 'documentKey': {'_id': 2}})
+        _test((cache.get('a'), cache.get('b'), cache.get('count')),
+              (None, b'' if per_id else None, None))
+    cache.set('b', b'', ['posts'], ids={'posts': [3]})
+    listener.process_event({'operationType': 'delete', 'ns': ns, 'documentKey': {'_id': 2}})
+    _test(cache.get('b'), b'')
+    listener.process_event({'operationType': 'insert', 'ns': ns, 'documentKey': {'_id': 4}})
+    _test(cache.get('b') is None, True)
+    conn.close()
+
+
+def test_unit_of_work():
+    from PyMongoWrapper.dbo import MongoConnection, DbObjectCollection, UnitOfWorkError
+    conn = MongoConnection('memory://test')
+
+    class Author(conn.DbObject):
+        name = str
+
+    class Tag(conn.DbObject):
+        name = str
+
+    class Post(conn.DbObject):
+        title = str
+        author = Author
+        tags = DbObjectCollection(Tag)
+
+    writes = []
+
+    def _count_writes(coll):
+        bulk_write = coll.bulk_write
+
+        def _bulk_write(requests, *args, **kwargs):
+            writes.append((coll.name, len(requests)))
+            return bulk_write(requests, *args, **kwargs)
+
+        coll.bulk_write = _bulk_write
+
+    for cls in (Author, Tag, Post):
+        cls.db.drop()
+        _count_writes(cls.db)
+
+    # unsaved references are registered while flushing, one bulk write per collection
+    with conn.unit_of_work():
+        author = Author(name='a')
+        for i in range(2):
+            Post(title=f'p{i}', author=author, tags=[Tag(name=f't{i}'), Tag(name=f'u{i}')]).save()
+        _test(Post.query({}).count(), 0)
+    _test(sorted(writes), [('author', 1), ('post', 2), ('tag', 4)])
+    _test((Post.query({}).count(), Tag.query({}).count(), Post.first({'title': 'p1'}).author.name),
+          (2, 4, 'a'))
+
+    # changes are discarded on exceptions
+    writes.clear()
+    try:
+        with conn.unit_of_work():
+            Post(title='p2', author=author).save()
+            author.name = 'b'
+            author.save()
+            raise ValueError()
+    except ValueError:
+        pass
+    _test((writes, Post.query({}).count(), Author.first({}).name), ([], 2, 'a'))
+
+    Tag.db.create_index('name', unique=True)
+    try:
+        with conn.unit_of_work():
+            Tag(name='t0').save()
+            Tag(name='y').save()
+        _test('duplicate saved', 'UnitOfWorkError')
+    except UnitOfWorkError as ex:
+        _test(([obj.name for obj, _ in ex.failures], ex.failures[0][1].get('code'), Tag.query({}).count()),
+              (['t0', 'y'], 11000, 4))
+    conn.close()
+
+
+def test_projection():
+    from PyMongoWrapper.dbo import MongoConnection, DbObjectCollection
+    conn = MongoConnection('memory://test')
+
+    class Tag(conn.DbObject):
+        name = str
+        color = str
+
+    class Post(conn.DbObject):
+        title = str
+        body = str
+        tags = DbObjectCollection(Tag)
+
+    Tag.db.drop()
+    Post.db.drop()
+    Post(title='p', body='b', tags=[Tag(name=f't{i}', color='red').save() for i in range(3)]).save()
+
+    for join in ('lookup', 'client'):
+        p = Post.query({}).join(join).only('title', 'tags.name').first()
+        _test(('body' in p._orig, [_.name for _ in p.tags][:2], p.tags[0]._projection, p.tags[0].id is None),
+              (False, ['t0', 't1'], {'name': 1}, False))
+        p.save()
+        _test((Tag.query({}).count(), Post.db.find_one({})["tags"] == [_.id for _ in p.tags]), (3, True))
+        # partially loaded fields are loaded on access, other fields are not written back
+        tag = p.tags[1]
+        _test(tag.color, 'red')
+        tag = p.tags[2]
+        tag.name = f'{join}2'
+        tag.save()
+        _test((Tag.db.find_one({'_id': tag.id}) or {}).get('color'), 'red')
+
+    p = Post.query({}).exclude('body', 'tags.color').first()
+    _test(('body' in p._orig, 'color' in p.tags[0]._orig, p.tags[0].name), (False, False, 't0'))
+    p.title = 'q'
+    p.save()
+    _test((Post.db.find_one({}) or {}).get('body'), 'b')
+    _test((p.body, p.tags[0].color), ('b', 'red'))
+    conn.close()
+
+
+def test_lazy_collection():
+    from PyMongoWrapper.dbo import MongoConnection, DbObjectCollection
+    conn = MongoConnection('memory://test')
+
+    class Elem(conn.DbObject):
+        name = str
+
+    class Holder(conn.DbObject):
+        elements = DbObjectCollection(Elem, lazy=True)
+
+    Elem.db.drop()
+    Holder.db.drop()
+    elems = [Elem(name=f'e{i}').save() for i in range(3)]
+    Holder(elements=elems).save()
+    Elem.db.delete_one({'_id': elems[2].id})
+
+    with _calls([Elem.db], 'find') as queries:
+        # ids are kept until elements are accessed, then loaded with one query
+        holder = Holder.first({})
+        elements = holder.elements
+        _test((elems[1].id in elements, len(elements), len(queries)), (True, 3, 0))
+        _test(all(isinstance(_, ObjectId) for _ in elements._orig), True)
+        holder.save()
+        _test((Holder.db.find_one({})['elements'], len(queries)), ([_.id for _ in elems], 0))
+
+        # missing elements are dropped
+        _test([_.name for _ in elements], ['e0', 'e1'])
+        _test((len(queries), len(elements), elements[1].name), (1, 2, 'e1'))
+    conn.close()
+
+
+def test_replica():
+    from PyMongoWrapper.dbo import MongoConnection
+    from PyMongoWrapper.mongoreplica import ReplicaMatcher, localize
+
+    # conditions are rewritten into one operator per clause, None when not supported
+    _test(localize({'a': 1, 'b': {'$gte': 2, '$lt': 5}}),
+          {'$and': [{'a': 1}, {'b': {'$gte': 2}}, {'b': {'$lt': 5}}]})
+    _test(localize({'a': {'$regex': 'x'}}) is None, True)
+    matcher = ReplicaMatcher()
+    doc = {'a': 1, 'tags': ['x', 'y'], 's': 'abc'}
+    _test([matcher.match(localize(cond), doc) for cond in (
+        {'a': 1}, {'a': '1'}, {'s': {'$gt': 1}}, {'tags': {'$in': ['y', 'z']}},
+        {'missing': None}, {'missing': {'$lt': 5}}, {'$or': [{'a': 2}, {'s': 'abc'}]}
+    )], [True, False, False, True, True, False, True])
+
+    conn = MongoConnection('memory://test')
+
+    class Setting(conn.DbObject):
+        name = str
+        value = int
+
+    Setting.db.drop()
+    for i in range(3):
+        Setting(name=f's{i}', value=i).save()
+    replica = Setting.replicate(keys=('name',), refresh_interval=0)
+
+    # writes mark the replica stale, reloaded once on the next query
+    with _calls([Setting.db], 'find') as loads:
+        setting = Setting.first(F.name == 's1')
+        setting.value = 10
+        setting.save()
+        Setting(name='s3', value=3).save()
+        Setting.query(F.name == 's0').update({'$set': {'value': 5}})
+        _test(len(loads), 0)
+        _test([(_.name, _.value) for _ in Setting.query(F.value > 2).sort('name')],
+              [('s0', 5), ('s1', 10), ('s3', 3)])
+        _test((Setting.query({}).count(), len(loads)), (4, 1))
+        setting.delete()
+        _test((Setting.first(F.name == 's1'), Setting.query({}).count(), len(loads)),
+              (None, 3, 2))
+    _test(replica.fallbacks, 0)
+
+    # values of different BSON types neither equal nor sort among each other
+    Setting.db.drop()
+    Setting.db.insert_many([{'name': f'v{i}', 'value': v}
+                            for i, v in enumerate([True, 1, 2.0, 2, None, 'a', [3, 1]])])
+    replica.invalidate()
+    for cond, sort in (({'value': 1}, 'name'), ({'value': {'$in': [2, True]}}, 'name'),
+                       ({'name': {'$in': ['v0', 'v1']}}, 'name'), ({'value': {'$gte': 1}}, 'name'),
+                       ({}, 'value'), ({}, '-value'), ({'value': 3}, 'name')):
+        direction = -1 if sort.startswith('-') else 1
+        server = [_['name'] for _ in Setting.db.find(cond, sort=[(sort.lstrip('-'), direction)])]
+        _test([_.name for _ in Setting.query(cond).sort(sort)], server)
+    _test(replica.fallbacks, 0)
+
+    # subclasses are not served by the replica of their parent
+    class Extended(Setting):
+        _collection = 'setting'
+
+    local_queries = replica.local_queries
+    _test((Extended.query(F.name == 'v1').count(), Extended.first(F.name == 'v2').value,
+           replica.local_queries), (1, 2.0, local_queries))
+    conn.close()
+
+
+def test_indexes():
+    import pymongo
+    from PyMongoWrapper.dbo import MongoConnection
+    conn = MongoConnection('memory://test')
+
+    class Event(conn.DbObject):
+        name = str
+        slug = str
+        at = datetime.datetime
+        priority = int
+        _indexes = ['name', ('-priority', 'at'), {'keys': 'slug', 'unique': True},
+                    {'keys': 'at', 'expireAfterSeconds': 3600},
+                    {'keys': 'priority', 'partialFilterExpression': {'priority': {'$gt': 5}}}]
+
+    class Tag(conn.DbObject):
+        name = str
+        _indexes = [pymongo.IndexModel([('name', 1)], unique=True)]
+
+    _test(conn.sync_indexes(), {'event': ['name_1', 'priority_-1_at_1', 'slug_1', 'at_1', 'priority_1'],
+                                'tag': ['name_1']})
+    info = Event.db.index_information()
+    _test((info['slug_1']['unique'], info['at_1']['expireAfterSeconds'],
+           info['priority_1']['partialFilterExpression']), (True, 3600, {'priority': {'$gt': 5}}))
+    _test(Event.sync_indexes(), [])
+
+    # index information is cached by the connection
+    Event.db.index_information = None
+    Event.ensure_index('-priority', 'at')
+    Event.ensure_index('name', unique=False)
+    Event.ensure_index('at', '-name')
+    del Event.db.index_information
+    _test(conn.index_information('event', refresh=True) == Event.db.index_information(), True)
+    _test('at_1_name_-1' in conn.index_information('event'), True)
+    conn.close()
+
+
+def test_explain():
+    import warnings
+    from PyMongoWrapper.dbo import MongoConnection
+    from PyMongoWrapper.mongoexplain import ScanGuard, CollectionScanError, CollectionScanWarning
+    conn = MongoConnection('memory://test')
+
+    class Author(conn.DbObject):
+        name = str
+
+    class Book(conn.DbObject):
+        title = str
+        year = int
+        author = Author
+        _indexes = ['year']
+
+    Author.db.drop()
+    Book.db.drop()
+    conn.sync_indexes(Book)
+    for i in range(20):
+        Book(title=f'b{i}', year=2000 + i, author=Author(name=f'a{i}').save()).save()
+
+    plan = Book.query(F.year == 2003).only('title').explain()
+    _test((plan['index'], plan['collscan'], plan['docs_examined'], plan['returned']),
+          ('year_1', False, 1, 1))
+    plan = Book.query(F.title == 'b3').only('title').explain()
+    _test((plan['index'], plan['scanned'], plan['docs_examined'], plan['returned']),
+          (None, ['book'], 20, 1))
+    _test(plan['time_ms'] is not None, True)
+
+    # filtering by referenced fields joins with $lookup, by the _id index
+    plan = Book.query(F['author.name'] == 'a3').explain()
+    _test((plan['indexes'], plan['scanned'], plan['returned']), (['_id_'], ['book'], 1))
+    plan = Book.aggregator.match({'year': {'$in': [2016, 2017]}}).lookup(
+        from_='author', localField='author', foreignField='_id', as_='author').explain()
+    _test((plan['indexes'], plan['collscan'], plan['returned']), (['year_1', '_id_'], False, 2))
+
+    conn.scan_guard = ScanGuard(threshold=10)
+    _test(len(list(Book.query(F.year == 2003).only('title'))), 1)
+    try:
+        list(Book.query(F.title == 'b3').only('title'))
+        _test('not raised', 'raised')
+    except CollectionScanError:
+        pass
+    conn.scan_guard = ScanGuard(threshold=10, action='warn')
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        for title in ('b3', 'b4'):
+            _test(len(list(Book.query(F.title == title).only('title'))), 1)
+    _test([_.category for _ in caught], [CollectionScanWarning] * 2)
+    _test(conn.scan_guard.explained, 1)
+
+    # collection sizes are estimated once per size_ttl, not for every query
+    for size_ttl, expected in ((60, 1), (0, 3)):
+        conn.scan_guard = ScanGuard(threshold=10, action='warn', size_ttl=size_ttl)
+        with _calls([Book.db], 'estimated_document_count') as counted, \
+                warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for title in ('b3', 'b4', 'b5'):
+                list(Book.query(F.title == title).only('title'))
+        _test(len(counted), expected)
+    conn.close()
+
+
+def test_session_threads():
+    import threading
+    import time
+    from PyMongoWrapper.dbo import MongoConnection
+    conn = MongoConnection('memory://test')
+    lock = threading.Lock()
+    running, concurrency = [0], []
+
+    def _item():
+        with lock:
+            running[0] += 1
+            concurrency.append(running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return conn.current_session
+
+    async def _run():
+        return await asyncio.gather(*[conn.run_async(_item) for _ in range(4)])
+
+    # a session is used by one thread at a time
+    with conn.session() as session:
+        _test(conn.gather(*[_item] * 4), [session] * 4)
+        _test(asyncio.run(_run()), [session] * 4)
+        _test(conn.gather(lambda: conn.gather(_item, _item)), [[session, session]])
+    _test(max(concurrency), 1)
+    _test(conn.gather(_item, _item), [None, None])
+    conn.close()
+
+
+def test_async():
+    import time
+    from concurrent.futures import TimeoutError as FutureTimeoutError
+    from PyMongoWrapper.dbo import MongoConnection, BatchSave
+    connstr = os.environ.get('MONGO_URI', 'memory://test')
+    conn = MongoConnection(connstr)
+
+    class AsyncTest(conn.DbObject):
+        n = int
+
+    AsyncTest.db.drop()
+
+    async def _run():
+        await asyncio.gather(*[AsyncTest(n=i).asave() for i in range(10)])
+        _test(await AsyncTest.query({}).acount(), 10)
+        _test((await AsyncTest.query({'n': 3}).afirst()).n, 3)
+        _test((await AsyncTest.afirst({'n': 4})).n, 4)
+        _test([_.n async for _ in AsyncTest.query({}).sort('n').batch_size(3)], list(range(10)))
+        async with BatchSave(5, AsyncTest) as batch:
+            for i in range(10, 22):
+                await batch.aadd({'n': i})
+        _test(await AsyncTest.query({'n': {'$gte': 10}}).acount(), 12)
+
+    try:
+        asyncio.run(_run())
+        count, first, error = conn.gather(AsyncTest.query({'n': {'$lt': 5}}).count,
+                                          AsyncTest.query({'n': 7}).first,
+                                          lambda: 1 / 0, timeout=5)
+        _test((count, first.n, type(error)), (5, 7, ZeroDivisionError))
+
+        # limits set on result sets are kept without a timeout
+        result_set = AsyncTest.query({}).max_time_ms(50)
+        for item in (result_set, result_set.count):
+            _test(conn._gather_call(item, None).__self__._cursor_options, {'max_time_ms': 50})
+        _test(conn._gather_call(result_set, 10).__self__._cursor_options, {'max_time_ms': 10})
+        # the timeout applies to the whole call, not to each item in turn
+        start = time.monotonic()
+        results = conn.gather(*[lambda: time.sleep(0.5)] * 3, timeout=0.1)
+        _test((time.monotonic() - start < 0.3, {type(_) for _ in results}),
+              (True, {FutureTimeoutError}))
+    finally:
+        AsyncTest.db.drop()
+        conn.close()
+
 
 if __name__ == '__main__':
     for k, func in dict(globals()).items():